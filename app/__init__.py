@@ -7,6 +7,7 @@ from flask_marshmallow import Marshmallow
 from flask_cors import CORS
 from logging.handlers import RotatingFileHandler
 from app.config import config
+from app.caching import ResponseCache
 import logging
 from flask_jwt_extended import JWTManager, get_jwt, verify_jwt_in_request
 from flask_jwt_extended import unset_jwt_cookies, unset_access_cookies
@@ -18,6 +19,7 @@ migrate = Migrate()
 cors = CORS()
 ma = Marshmallow()
 jwt = JWTManager()
+cache = ResponseCache()
 # csrf = CSRFProtect()
 
 
@@ -56,6 +58,7 @@ def create_app(config_name: str | None = None) -> Flask:
     cors.init_app(app)
     ma.init_app(app)
     jwt.init_app(app)
+    cache.init_app(app)
     # csrf.init_app(app)
 
     # register blueprints
@@ -1,9 +1,11 @@
 from flask import current_app, render_template, request, jsonify, Request
 from datetime import datetime
-from app import db
+from app import db, cache
+from app.caching import BOOK_DUMP_TAGS
 from app.api.authors import authors
 from app.models import Author
 from app.schemas.books import AuthorSchema
+from app.api.etags import author_etag, authors_etag, not_modified, with_etag
 
 
 # ----------- AUTHOR ROUTES -----------
@@ -35,20 +37,32 @@ def create_author():
 
 
 @authors.route('', methods=['GET'])
+@cache.cached(*BOOK_DUMP_TAGS)
 def get_authors():
     """Retrieve a list of authors with filtering, pagination, and sorting"""
+    etag = authors_etag(db.session)
+    response = not_modified(etag)
+    if response is not None:
+        return response
     authors = db.session.execute(db.select(Author)).scalars()
-    return jsonify([AuthorSchema().dump(author) for author in authors])
+    return with_etag(jsonify([AuthorSchema().dump(author) for author in authors]), etag)
 
 
 @authors.route('/<int:author_id>', methods=['GET'])
+@cache.cached("author:{author_id}", *BOOK_DUMP_TAGS)
 def get_author(author_id):
     """Retrieve a single author by its ID"""
+    etag = author_etag(db.session, author_id)
+    if etag is None:
+        return jsonify({"error": "Author not found"}), 404
+    response = not_modified(etag)
+    if response is not None:
+        return response
     author = db.session.execute(
         db.select(Author).where(Author.id == author_id)).scalar()
     if not author:
         return jsonify({"error": "Author not found"}), 404
-    return jsonify(AuthorSchema().dump(author))
+    return with_etag(jsonify(AuthorSchema().dump(author)), etag)
 
 
 @authors.route('/<int:author_id>', methods=['PUT'])
@@ -92,8 +106,15 @@ def delete_author(author_id):
 
 
 @authors.route('/<int:author_id>/books', methods=['GET'])
+@cache.cached("author:{author_id}", "book:*")
 def get_books_by_author(author_id):
     """Get all books by a specific author"""
+    etag = author_etag(db.session, author_id)
+    if etag is None:
+        return jsonify({"error": "Author not found"}), 404
+    response = not_modified(etag)
+    if response is not None:
+        return response
     # Query the author by ID
     author = db.session.execute(
         db.select(Author).where(Author.id == author_id)
@@ -106,7 +127,7 @@ def get_books_by_author(author_id):
     books = author.books
 
     # Return the books as JSON
-    return jsonify([
+    return with_etag(jsonify([
         {
             "id": book.id,
             "title": book.title,
@@ -116,4 +137,4 @@ def get_books_by_author(author_id):
             "number_of_pages": book.number_of_pages,
         }
         for book in books
-    ])
+    ]), etag)
@@ -0,0 +1,107 @@
+# Compact "book cards" for the listing routes.
+#
+# A card is a fixed, read-only subset of the book JSON: the columns in CARD_COLUMNS, the
+# cover URL and the id and name of the book's authors, series, genres and publishers. Cards
+# are built straight from row tuples instead of hydrating Book objects and running them
+# through a BookSchema. The listing query selects CARD_COLUMNS, and ``dump_cards`` fetches
+# the names and covers of a whole page with one query each. The converters are resolved
+# once, when this module is imported.
+import sqlalchemy as sa
+from app import db
+from app.models import Book, Author, Genre, Series, Publisher, Cover
+from app.models.books import book_authors, book_genres, book_series, book_publishers
+
+# Columns of a card, in the order of the rows ``dump_cards`` takes. ``version`` is only
+# selected for the ETags (see app.api.etags) and is not dumped.
+CARD_COLUMNS = (
+    Book.id, Book.title, Book.subtitle, Book.isbn_10, Book.isbn_13,
+    Book.current_price, Book.previous_price, Book.rating, Book.rating_avg, Book.rating_count,
+    Book.version,
+)
+
+# Collections shown on a card as [{"id": ..., "name": ...}], with the association linking them to the books
+CARD_COLLECTIONS = {
+    "authors": (Author, book_authors, "author_id"),
+    "series": (Series, book_series, "series_id"),
+    "genres": (Genre, book_genres, "genre_id"),
+    "publishers": (Publisher, book_publishers, "publisher_id"),
+}
+
+
+def _decimal(value):
+    # Same format as the ``fields.Decimal(as_string=True)`` fields of BookSchema
+    return None if value is None else str(value)
+
+
+def _compile(columns):
+    """Pair each dumped column with its position in the row and its converter."""
+    fields = []
+    for position, column in enumerate(columns):
+        if column.key == "version":
+            continue
+        converter = _decimal if isinstance(column.type, sa.Numeric) and column.type.asdecimal else None
+        fields.append((column.key, position, converter))
+    return tuple(fields)
+
+
+CARD_FIELDS = _compile(CARD_COLUMNS)
+
+
+def card_query():
+    """A select() of the card columns of every book, to filter and order like a Book query."""
+    return sa.select(*CARD_COLUMNS)
+
+
+def _collections(book_ids):
+    """The card collections of the given books, as {book_id: {collection: [{"id", "name"}]}}."""
+    parts = [
+        sa.select(
+            sa.literal(collection).label("collection"),
+            association.c.book_id,
+            model.id,
+            model.name,
+        )
+        .join(model, model.id == association.c[column])
+        .where(association.c.book_id.in_(book_ids))
+        for collection, (model, association, column) in CARD_COLLECTIONS.items()
+    ]
+    rows = db.session.execute(sa.union_all(*parts).order_by("collection", "book_id", "id"))
+    collections = {}
+    for collection, book_id, item_id, name in rows:
+        collections.setdefault(book_id, {}).setdefault(collection, []).append({"id": item_id, "name": name})
+    return collections
+
+
+def _cover_urls(book_ids):
+    """The URL of the primary cover (or the first cover) of each of the given books."""
+    rows = db.session.execute(
+        sa.select(Cover.book_id, Cover.url)
+        .where(Cover.book_id.in_(book_ids))
+        .order_by(Cover.book_id, sa.case((Cover.is_primary == sa.true(), 0), else_=1), Cover.id)
+    )
+    urls = {}
+    for book_id, url in rows:
+        urls.setdefault(book_id, url)
+    return urls
+
+
+def dump_cards(rows):
+    """
+    Dump rows of ``card_query()`` into cards, keeping their order.
+
+    Costs two queries per page (collections and covers), whatever the number of rows.
+    """
+    book_ids = [row[0] for row in rows]
+    if not book_ids:
+        return []
+    collections = _collections(book_ids)
+    cover_urls = _cover_urls(book_ids)
+    cards = []
+    for row in rows:
+        card = {key: row[position] if converter is None else converter(row[position]) for key, position, converter in CARD_FIELDS}
+        related = collections.get(row[0], {})
+        for collection in CARD_COLLECTIONS:
+            card[collection] = related.get(collection, [])
+        card["cover_url"] = cover_urls.get(row[0])
+        cards.append(card)
+    return cards
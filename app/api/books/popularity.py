@@ -0,0 +1,213 @@
+# Best-seller ranking behind /api/books/popular.
+#
+# Every order item adds its quantity and revenue to a per-day ``BookSales`` bucket and to the
+# ``BookPopularity`` counters of its book, in the same flush that inserts it. The 7 and 30 day
+# counters are moved forward by ``flask api refresh-popularity`` (meant to run daily): it
+# recomputes them from the last 30 days of buckets and drops the older buckets, so neither
+# the job nor the endpoint ever aggregates the order_item table.
+# ``flask api refresh-popularity --rebuild`` recomputes everything from the order items.
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import click
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from flask.cli import with_appcontext
+from app import db
+from app.models import Order, OrderItem, BookSales, BookPopularity
+from app.api import api
+
+# Length of each window in days (None = all time)
+WINDOWS = {"7d": 7, "30d": 30, "all": None}
+METRICS = ("quantity", "revenue")
+
+UPSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def ranking_column(window, metric):
+    """The BookPopularity column ranking the books by ``metric`` over ``window``."""
+    if window not in WINDOWS or metric not in METRICS:
+        raise ValueError(f"Unknown popularity ranking: {metric} over {window}")
+    return getattr(BookPopularity, f"{metric}_{window}")
+
+
+def _increment(connection, table, keys, rows):
+    """Add the non-key values of ``rows`` to the matching rows of ``table``, inserting the missing ones."""
+    columns = [column for column in rows[0] if column not in keys]
+    upsert = UPSERTS.get(connection.dialect.name)
+    if upsert is not None:
+        statement = upsert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: table.c[column] + statement.excluded[column] for column in columns}
+        )
+        connection.execute(statement, rows)
+        return
+    update = table.update().where(*[table.c[key] == sa.bindparam(f"key_{key}") for key in keys]).values(
+        **{column: table.c[column] + sa.bindparam(f"add_{column}") for column in columns}
+    )
+    for row in rows:
+        result = connection.execute(update, {
+            **{f"key_{key}": row[key] for key in keys},
+            **{f"add_{column}": row[column] for column in columns},
+        })
+        if result.rowcount == 0:
+            connection.execute(table.insert(), row)
+
+
+def record_sales(connection, sales, today=None):
+    """
+    Add sales to the daily buckets and the popularity counters.
+
+    Args:
+        connection: The connection to write with.
+        sales (list): (book_id, day, quantity, revenue) tuples, negative for removed sales.
+        today (date): The day the rolling windows end on, today by default.
+    """
+    today = today or date.today()
+    buckets, counters = {}, {}
+    for book_id, day, quantity, revenue in sales:
+        bucket = buckets.setdefault((book_id, day), {"book_id": book_id, "day": day, "quantity": 0, "revenue": Decimal(0)})
+        bucket["quantity"] += quantity
+        bucket["revenue"] += revenue
+        counter = counters.setdefault(book_id, {
+            "book_id": book_id, **{f"{metric}_{window}": 0 for metric in METRICS for window in WINDOWS}
+        })
+        for window, days in WINDOWS.items():
+            if days is None or today - day < timedelta(days=days):
+                counter[f"quantity_{window}"] += quantity
+                counter[f"revenue_{window}"] += revenue
+    # Sales older than the longest window only count towards the all-time counters
+    oldest = today - timedelta(days=max(days for days in WINDOWS.values() if days))
+    buckets = [bucket for bucket in buckets.values() if bucket["day"] > oldest]
+    if buckets:
+        _increment(connection, BookSales.__table__, ["book_id", "day"], buckets)
+    if counters:
+        _increment(connection, BookPopularity.__table__, ["book_id"], list(counters.values()))
+
+
+def refresh_popularity(connection, today=None):
+    """Move the rolling windows forward to ``today`` and drop the buckets that fell out of them."""
+    today = today or date.today()
+    sales = BookSales.__table__
+    popularity = BookPopularity.__table__
+    windowed = {column: 0 for column in (f"{metric}_{window}" for metric in METRICS for window, days in WINDOWS.items() if days)}
+    expressions = []
+    for window, days in WINDOWS.items():
+        if days:
+            recent = sales.c.day > today - timedelta(days=days)
+            expressions += [
+                sa.func.sum(sa.case((recent, sales.c.quantity), else_=0)).label(f"quantity_{window}"),
+                sa.func.sum(sa.case((recent, sales.c.revenue), else_=0)).label(f"revenue_{window}"),
+            ]
+    oldest = today - timedelta(days=max(days for days in WINDOWS.values() if days))
+    rows = connection.execute(
+        sa.select(sales.c.book_id, *expressions).where(sales.c.day > oldest).group_by(sales.c.book_id)
+    ).mappings().all()
+    connection.execute(popularity.update().where(sa.or_(*[popularity.c[column] != 0 for column in windowed])).values(**windowed))
+    if rows:
+        connection.execute(
+            popularity.update().where(popularity.c.book_id == sa.bindparam("sales_book_id")).values(
+                **{column: sa.bindparam(f"sales_{column}") for column in windowed}
+            ),
+            [{f"sales_{key}": value for key, value in row.items()} for row in rows]
+        )
+    connection.execute(sales.delete().where(sales.c.day <= oldest))
+    return len(rows)
+
+
+def rebuild_popularity(connection, today=None):
+    """Recompute the buckets and counters from every order item."""
+    connection.execute(BookSales.__table__.delete())
+    connection.execute(BookPopularity.__table__.delete())
+    order_item = OrderItem.__table__
+    order = Order.__table__
+    rows = connection.execute(
+        sa.select(
+            order_item.c.book_id,
+            sa.func.date(order.c.date),
+            sa.func.sum(order_item.c.quantity),
+            sa.func.sum(order_item.c.quantity * order_item.c.price),
+        )
+        .select_from(order_item.join(order, order.c.id == order_item.c.order_id))
+        .group_by(order_item.c.book_id, sa.func.date(order.c.date))
+    ).all()
+    sales = [
+        (book_id, day if isinstance(day, date) else date.fromisoformat(day), quantity, Decimal(str(revenue or 0)))
+        for book_id, day, quantity, revenue in rows
+    ]
+    if sales:
+        record_sales(connection, sales, today)
+    return len({book_id for book_id, *_ in sales})
+
+
+SALE_ATTRIBUTES = ("order_id", "book_id", "quantity", "price")
+
+
+def _committed(item, key):
+    """The value ``key`` had in the database before the pending changes of ``item``."""
+    history = so.attributes.get_history(item, key)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(item, key)
+
+
+def _flushed_sales(session):
+    """(order_id, book_id, quantity, price, sign) of the sales added (1) and taken back (-1) by a flush."""
+    sales = []
+    for item in session.new:
+        if isinstance(item, OrderItem):
+            sales.append((item.order_id, item.book_id, item.quantity, item.price, 1))
+    for item in session.deleted:
+        if isinstance(item, OrderItem):
+            sales.append((*(_committed(item, key) for key in SALE_ATTRIBUTES), -1))
+    for item in session.dirty:
+        if isinstance(item, OrderItem) and item not in session.deleted and any(
+            so.attributes.get_history(item, key).has_changes() for key in SALE_ATTRIBUTES
+        ):
+            # The committed sale is replaced by the new one
+            sales.append((*(_committed(item, key) for key in SALE_ATTRIBUTES), -1))
+            sales.append((item.order_id, item.book_id, item.quantity, item.price, 1))
+    return sales
+
+
+@event.listens_for(so.Session, "after_flush")
+def _record_flushed_sales(session, flush_context):
+    flushed = _flushed_sales(session)
+    if not flushed:
+        return
+    connection = session.connection()
+    # Use the loaded orders when possible, the order may have been deleted along with its items
+    dates = {}
+    for order_id in {order_id for order_id, *_ in flushed}:
+        order = session.identity_map.get(session.identity_key(Order, order_id))
+        if order is None:
+            order = next((obj for obj in session.deleted if isinstance(obj, Order) and obj.id == order_id), None)
+        if order is not None and "date" in order.__dict__:
+            dates[order_id] = order.__dict__["date"]
+    missing = {order_id for order_id, *_ in flushed} - set(dates)
+    if missing:
+        dates.update(connection.execute(sa.select(Order.id, Order.date).where(Order.id.in_(missing))).all())
+    sales = []
+    for order_id, book_id, quantity, price, sign in flushed:
+        ordered_at = dates.get(order_id)
+        if ordered_at is None or quantity is None:
+            continue
+        day = ordered_at.date() if isinstance(ordered_at, datetime) else ordered_at
+        sales.append((book_id, day, sign * quantity, sign * Decimal(str(price)) * quantity))
+    if sales:
+        record_sales(connection, sales)
+
+
+@api.cli.command(name='refresh-popularity')
+@click.option('--rebuild', is_flag=True, default=False, help='Recompute everything from the order items')
+@with_appcontext
+def refresh_popularity_command(rebuild):
+    """Move the 7 and 30 day best-seller windows forward (run daily)."""
+    with db.engine.begin() as connection:
+        if rebuild:
+            count = rebuild_popularity(connection)
+        else:
+            count = refresh_popularity(connection)
+    click.echo(f'Refreshed the popularity of {count} books')
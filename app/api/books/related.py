@@ -0,0 +1,219 @@
+# Precomputed related books behind /api/books/related/<id>.
+#
+# Two books are related when they share authors or genres: each shared author is worth
+# AUTHOR_WEIGHT points and each shared genre GENRE_WEIGHT points. The best RELATED_LIMIT
+# related books of every book are stored in the ``related_books`` table, so the endpoint is a
+# single indexed lookup, and ``Book.related_computed_at`` records when the list was computed
+# (an empty list may be computed too). When the authors or genres of a book change, its list
+# is recomputed right away; the lists of the books sharing those authors or genres, or a
+# deleted author or genre, are marked stale. The endpoint never writes: it scores a stale list
+# on the spot until ``flask api refresh-related-books --stale`` (run periodically) stores it
+# again. Without ``--stale`` the command recomputes every list.
+#
+# An import writes many books sharing the same genres, so keeping the lists on every flush
+# would rewrite each genre once per book. Inside ``deferred_related`` the flushes only collect
+# what changed, and the lists are marked stale and refreshed once at the end.
+import heapq
+from contextlib import contextmanager
+from itertools import chain
+import click
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from flask.cli import with_appcontext
+from app import db
+from app.models import Book, Author, Genre
+from app.models.books import book_authors, book_genres, related_books
+from app.api import api
+
+AUTHOR_WEIGHT = 3
+GENRE_WEIGHT = 1
+RELATED_LIMIT = 100
+
+REFRESH_BATCH_SIZE = 200
+
+
+def _shared(association, column, weight, book_ids):
+    """One (book_id, related_book_id, weight) row per author or genre shared by two books."""
+    source = association.alias(f"source_{column}")
+    target = association.alias(f"target_{column}")
+    return (
+        sa.select(
+            source.c.book_id,
+            target.c.book_id.label("related_book_id"),
+            sa.literal(weight, sa.Integer).label("weight"),
+        )
+        .select_from(source.join(target, target.c[column] == source.c[column]))
+        .where(source.c.book_id.in_(book_ids), target.c.book_id != source.c.book_id)
+    )
+
+
+def _scores(book_ids):
+    """Select the (book_id, related_book_id, score) of every pair of related books, for the given books."""
+    shared = sa.union_all(
+        _shared(book_authors, "author_id", AUTHOR_WEIGHT, book_ids),
+        _shared(book_genres, "genre_id", GENRE_WEIGHT, book_ids),
+    ).subquery("shared")
+    return (
+        sa.select(shared.c.book_id, shared.c.related_book_id, sa.func.sum(shared.c.weight).label("score"))
+        .group_by(shared.c.book_id, shared.c.related_book_id)
+    )
+
+
+def compute_related(connection, book_ids):
+    """
+    Score the related books of the given books.
+
+    Returns:
+        dict: The best RELATED_LIMIT (related_book_id, score) pairs of each book, best first.
+    """
+    candidates = {book_id: [] for book_id in book_ids}
+    for book_id, related_book_id, score in connection.execute(_scores(book_ids)):
+        candidates[book_id].append((related_book_id, score))
+    return {
+        book_id: heapq.nsmallest(RELATED_LIMIT, scores, key=lambda item: (-item[1], item[0]))
+        for book_id, scores in candidates.items()
+    }
+
+
+def refresh_related(connection, book_ids):
+    """Recompute and store the related books of the given books."""
+    book = Book.__table__
+    book_ids = sorted(set(book_ids) - {None})
+    for start in range(0, len(book_ids), REFRESH_BATCH_SIZE):
+        batch = book_ids[start:start + REFRESH_BATCH_SIZE]
+        connection.execute(related_books.delete().where(related_books.c.book_id.in_(batch)))
+        rows = [
+            {"book_id": book_id, "related_book_id": related_book_id, "score": score}
+            for book_id, scores in compute_related(connection, batch).items()
+            for related_book_id, score in scores
+        ]
+        if rows:
+            connection.execute(related_books.insert(), rows)
+        connection.execute(book.update().where(book.c.id.in_(batch)).values(related_computed_at=sa.func.now()))
+
+
+def refresh_stale_related(connection):
+    """Recompute and store the stale lists, and those never computed. Returns how many."""
+    book = Book.__table__
+    book_ids = connection.execute(sa.select(book.c.id).where(book.c.related_computed_at.is_(None))).scalars().all()
+    refresh_related(connection, book_ids)
+    return len(book_ids)
+
+
+def books_sharing(author_ids=(), genre_ids=(), exclude=()):
+    """Select the ids of the books having any of the given authors or genres, but the ``exclude`` ones."""
+    return sa.union(
+        sa.select(book_authors.c.book_id)
+        .where(book_authors.c.author_id.in_(author_ids), book_authors.c.book_id.notin_(exclude)),
+        sa.select(book_genres.c.book_id)
+        .where(book_genres.c.genre_id.in_(genre_ids), book_genres.c.book_id.notin_(exclude)),
+    )
+
+
+def invalidate_related(connection, book_ids):
+    """Mark the lists of the given books (ids, or a select of them) stale, until the next refresh."""
+    book = Book.__table__
+    connection.execute(related_books.delete().where(related_books.c.book_id.in_(book_ids)))
+    connection.execute(book.update().where(book.c.id.in_(book_ids)).values(related_computed_at=None))
+
+
+@contextmanager
+def deferred_related(session):
+    """
+    Collect the related-books changes of the flushes inside the block instead of applying them,
+    then mark the affected lists stale and refresh every stale list once, without committing.
+    """
+    changes = {"books": set(), "authors": set(), "genres": set()}
+    session.info["related_deferred"] = changes
+    try:
+        yield
+        session.flush()
+    finally:
+        session.info.pop("related_deferred", None)
+    connection = session.connection()
+    author_ids, genre_ids = sorted(changes["authors"]), sorted(changes["genres"])
+    for start in range(0, max(len(author_ids), len(genre_ids)), REFRESH_BATCH_SIZE):
+        end = start + REFRESH_BATCH_SIZE
+        invalidate_related(connection, books_sharing(author_ids[start:end], genre_ids[start:end]))
+    book_ids = sorted(changes["books"] - {None})
+    for start in range(0, len(book_ids), REFRESH_BATCH_SIZE):
+        invalidate_related(connection, book_ids[start:start + REFRESH_BATCH_SIZE])
+    refresh_stale_related(connection)
+
+
+@event.listens_for(so.Session, "before_flush")
+def _collect_deleted_authors_and_genres(session, flush_context, instances):
+    # The association rows of deleted authors and genres are gone after the flush, so remember their books now
+    author_ids = [obj.id for obj in session.deleted if isinstance(obj, Author)]
+    genre_ids = [obj.id for obj in session.deleted if isinstance(obj, Genre)]
+    if author_ids or genre_ids:
+        book_ids = session.connection().execute(books_sharing(author_ids, genre_ids)).scalars().all()
+        session.info.setdefault("related_stale_book_ids", set()).update(book_ids)
+
+
+@event.listens_for(so.Session, "after_flush")
+def _refresh_flushed_books(session, flush_context):
+    stale_book_ids = session.info.pop("related_stale_book_ids", set())
+    book_ids, author_ids, genre_ids = set(), set(), set()
+    for book in chain(session.new, session.dirty):
+        if not isinstance(book, Book):
+            continue
+        authors = so.attributes.get_history(book, "authors")
+        genres = so.attributes.get_history(book, "genres")
+        if book in session.new or authors.added or authors.deleted or genres.added or genres.deleted:
+            book_ids.add(book.id)
+            author_ids.update(author.id for author in chain(authors.added, authors.deleted))
+            genre_ids.update(genre.id for genre in chain(genres.added, genres.deleted))
+    deferred = session.info.get("related_deferred")
+    if deferred is not None:
+        deferred["books"].update(book_ids, stale_book_ids)
+        deferred["authors"].update(author_ids)
+        deferred["genres"].update(genre_ids)
+        return
+    connection = session.connection()
+    if author_ids or genre_ids:
+        invalidate_related(connection, books_sharing(author_ids, genre_ids, exclude=book_ids))
+    stale_book_ids -= book_ids | {book.id for book in session.deleted if isinstance(book, Book)}
+    if stale_book_ids:
+        invalidate_related(connection, sorted(stale_book_ids))
+    if book_ids:
+        refresh_related(connection, book_ids)
+
+
+@event.listens_for(so.Session, "after_rollback")
+def _discard_stale_books(session):
+    session.info.pop("related_stale_book_ids", None)
+
+
+def related_books_query(book_id, stored=True):
+    """The related books of ``book_id``, best first: its stored list, or scored on the spot while the list is stale."""
+    if stored:
+        ranking = related_books
+        query = sa.select(Book).join(related_books, related_books.c.related_book_id == Book.id)
+    else:
+        scores = _scores([book_id]).subquery("scores")
+        ranking = (
+            sa.select(scores)
+            .order_by(scores.c.score.desc(), scores.c.related_book_id)
+            .limit(RELATED_LIMIT)
+            .subquery("ranking")
+        )
+        query = sa.select(Book).join(ranking, ranking.c.related_book_id == Book.id)
+    return query.where(ranking.c.book_id == book_id).order_by(ranking.c.score.desc(), Book.id)
+
+
+@api.cli.command(name='refresh-related-books')
+@click.option('--stale', is_flag=True, help='Only the books whose list is stale or was never computed')
+@with_appcontext
+def refresh_related_books(stale):
+    """Recompute the related books of every book, or of the stale ones."""
+    connection = db.session.connection()
+    if stale:
+        count = refresh_stale_related(connection)
+    else:
+        book_ids = connection.execute(sa.select(Book.__table__.c.id)).scalars().all()
+        refresh_related(connection, book_ids)
+        count = len(book_ids)
+    db.session.commit()
+    click.echo(f'Refreshed the related books of {count} books')
@@ -0,0 +1,210 @@
+# Full-text search index for books.
+#
+# Production (Postgres) keeps a ``book_search`` table with a weighted tsvector and a GIN index,
+# dev/tests (SQLite) keep an FTS5 virtual table with the same name. Both are fed accent-folded
+# text so "García Márquez" and "garcia marquez" match each other, and both are kept up to date
+# from the session whenever books or authors are written.
+import re
+import unicodedata
+from itertools import chain
+import click
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from flask.cli import with_appcontext
+from app import db
+from app.models import Book, Author, Product
+from app.models.books import book_authors
+from app.api import api
+
+SEARCH_TABLE = "book_search"
+
+# Relative weight of each indexed column (title, authors, description)
+SQLITE_WEIGHTS = (10.0, 5.0, 1.0)
+POSTGRES_WEIGHTS = {"title": "A", "authors": "B", "description": "C"}
+
+REINDEX_BATCH_SIZE = 500
+
+
+def fold(text):
+    """Lowercase ``text`` and strip its accents ("García" -> "garcia")."""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    """Split ``text`` into accent-folded word tokens."""
+    return re.findall(r"\w+", fold(text))
+
+
+# ----------- INDEX DDL -----------
+
+def create_search_index(target, connection, **kw):
+    if connection.dialect.name == "postgresql":
+        connection.execute(sa.text(
+            f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+            "book_id INTEGER PRIMARY KEY REFERENCES book(id) ON DELETE CASCADE, "
+            "document tsvector NOT NULL)"
+        ))
+        connection.execute(sa.text(
+            f"CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_document ON {SEARCH_TABLE} USING GIN (document)"
+        ))
+    else:
+        connection.execute(sa.text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} "
+            "USING fts5(title, authors, description, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+
+def drop_search_index(target, connection, **kw):
+    connection.execute(sa.text(f"DROP TABLE IF EXISTS {SEARCH_TABLE}"))
+
+
+event.listen(db.metadata, "after_create", create_search_index)
+event.listen(db.metadata, "before_drop", drop_search_index)
+
+
+# ----------- INDEX MAINTENANCE -----------
+
+def _documents(connection, book_ids):
+    """Build the folded (title, authors, description) document of each book."""
+    book_table = Book.__table__
+    product_table = Product.__table__
+    author_table = Author.__table__
+    rows = connection.execute(
+        sa.select(book_table.c.id, book_table.c.title, book_table.c.subtitle, product_table.c.description)
+        .select_from(book_table.join(product_table, product_table.c.id == book_table.c.id))
+        .where(book_table.c.id.in_(book_ids))
+    ).all()
+    names = {}
+    for book_id, name in connection.execute(
+        sa.select(book_authors.c.book_id, author_table.c.name)
+        .select_from(book_authors.join(author_table, author_table.c.id == book_authors.c.author_id))
+        .where(book_authors.c.book_id.in_(book_ids))
+    ):
+        names.setdefault(book_id, []).append(name)
+    return [
+        {
+            "book_id": book_id,
+            "title": fold(" ".join(filter(None, [title, subtitle]))),
+            "authors": fold(" ".join(names.get(book_id, []))),
+            "description": fold(description),
+        }
+        for book_id, title, subtitle, description in rows
+    ]
+
+
+def reindex_books(connection, book_ids):
+    """Refresh the search documents of the given books, dropping the ones that no longer exist."""
+    book_ids = sorted(set(book_ids) - {None})
+    for start in range(0, len(book_ids), REINDEX_BATCH_SIZE):
+        batch = book_ids[start:start + REINDEX_BATCH_SIZE]
+        documents = _documents(connection, batch)
+        if connection.dialect.name == "postgresql":
+            connection.execute(sa.text(f"DELETE FROM {SEARCH_TABLE} WHERE book_id IN :ids").bindparams(
+                sa.bindparam("ids", expanding=True)), {"ids": batch})
+            if documents:
+                connection.execute(sa.text(
+                    f"INSERT INTO {SEARCH_TABLE} (book_id, document) VALUES (:book_id, "
+                    f"setweight(to_tsvector('simple', :title), '{POSTGRES_WEIGHTS['title']}') || "
+                    f"setweight(to_tsvector('simple', :authors), '{POSTGRES_WEIGHTS['authors']}') || "
+                    f"setweight(to_tsvector('simple', :description), '{POSTGRES_WEIGHTS['description']}'))"
+                ), documents)
+        else:
+            connection.execute(sa.text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN :ids").bindparams(
+                sa.bindparam("ids", expanding=True)), {"ids": batch})
+            if documents:
+                connection.execute(sa.text(
+                    f"INSERT INTO {SEARCH_TABLE} (rowid, title, authors, description) "
+                    "VALUES (:book_id, :title, :authors, :description)"
+                ), documents)
+
+
+def rebuild_search_index(connection):
+    """Recreate the search index from scratch."""
+    drop_search_index(None, connection)
+    create_search_index(None, connection)
+    book_ids = connection.execute(sa.select(Book.__table__.c.id)).scalars().all()
+    reindex_books(connection, book_ids)
+    return len(book_ids)
+
+
+@event.listens_for(so.Session, "before_flush")
+def _collect_deleted_authors(session, flush_context, instances):
+    # The association rows of deleted authors are gone after the flush, so remember their books now
+    author_ids = [obj.id for obj in session.deleted if isinstance(obj, Author)]
+    if author_ids:
+        book_ids = session.connection().execute(
+            sa.select(book_authors.c.book_id).where(book_authors.c.author_id.in_(author_ids))
+        ).scalars().all()
+        session.info.setdefault("search_book_ids", set()).update(book_ids)
+
+
+@event.listens_for(so.Session, "after_flush")
+def _reindex_flushed_books(session, flush_context):
+    book_ids = session.info.pop("search_book_ids", set())
+    author_ids = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Book):
+            book_ids.add(obj.id)
+        elif isinstance(obj, Author) and obj not in session.deleted:
+            author_ids.add(obj.id)
+    connection = session.connection()
+    if author_ids:
+        book_ids.update(connection.execute(
+            sa.select(book_authors.c.book_id).where(book_authors.c.author_id.in_(author_ids))
+        ).scalars().all())
+    if book_ids:
+        reindex_books(connection, book_ids)
+
+
+# ----------- QUERIES -----------
+
+def ranked_books(title=None, author=None, keywords=None):
+    """
+    Match books against the search index.
+
+    Args:
+        title (str): Words that must appear in the title.
+        author (str): Words that must appear in an author's name.
+        keywords (str): Words that must appear anywhere (title, authors or description).
+
+    Returns:
+        A subquery with ``book_id`` and ``rank`` columns (lower rank = more relevant),
+        or None when no search words were given.
+    """
+    terms = [(None, token) for token in tokenize(keywords)]
+    terms += [("title", token) for token in tokenize(title)]
+    terms += [("authors", token) for token in tokenize(author)]
+    if not terms:
+        return None
+
+    if db.session.get_bind().dialect.name == "postgresql":
+        query = " & ".join(
+            f"{token}:*{POSTGRES_WEIGHTS[column] if column else ''}" for column, token in terms
+        )
+        statement = sa.text(
+            f"SELECT book_id, -ts_rank(document, to_tsquery('simple', :query)) AS rank "
+            f"FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('simple', :query)"
+        ).bindparams(query=query)
+    else:
+        match = " AND ".join(
+            f'{column} : "{token}"*' if column else f'"{token}"*' for column, token in terms
+        )
+        weights = ", ".join(str(weight) for weight in SQLITE_WEIGHTS)
+        statement = sa.text(
+            f"SELECT rowid AS book_id, bm25({SEARCH_TABLE}, {weights}) AS rank "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match"
+        ).bindparams(match=match)
+    return statement.columns(book_id=sa.Integer, rank=sa.Float).subquery("ranked_books")
+
+
+@api.cli.command(name='reindex-search')
+@with_appcontext
+def reindex_search():
+    """Rebuild the full-text search index of the books."""
+    with db.engine.begin() as connection:
+        count = rebuild_search_index(connection)
+    click.echo(f'Indexed {count} books')
@@ -0,0 +1,319 @@
+# In-memory index behind /api/books/suggestions.
+#
+# Each worker keeps sorted arrays of the normalized book titles, ISBNs and author names (plus
+# their word tokens) so autocomplete never touches the database. Writes to books, authors,
+# covers and photos mark the affected rows as stale when the session commits, and the next
+# suggestion request reloads just those rows. Changes made by other workers are picked up by
+# the periodic full rebuild (SUGGESTION_INDEX_TTL seconds).
+#
+# A partial ISBN matches from its start (the SQL suggestions matched it anywhere): ISBNs are
+# typed or scanned from their first digit, and a prefix is a range of the sorted array.
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from itertools import chain
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from flask import current_app
+from app.models import Book, Author, Cover, AuthorPhoto
+from app.api.books.search import fold, tokenize
+
+BOOK_LIMIT = 10
+AUTHOR_LIMIT = 5
+
+# Relevance scores, same weights the SQL suggestions used
+ISBN_SCORE = 10
+BOOK_EXACT_SCORE = 10
+AUTHOR_EXACT_SCORE = 11
+PREFIX_SCORE = 5
+CONTAINS_SCORE = 3
+
+_END = "\U0010ffff"
+
+
+def _prefix_range(entries, prefix):
+    """Return the slice bounds of the (key, id) entries whose key starts with ``prefix``."""
+    return bisect_left(entries, (prefix,)), bisect_left(entries, (prefix + _END,))
+
+
+def _primary_urls(session, model, owner_column, owner_ids=None):
+    """Map each owner to its primary image url (or its first one), like Book.primary_cover / Author.photo_url."""
+    urls = {}
+    query = sa.select(owner_column, model.url, model.is_primary).order_by(owner_column, model.id)
+    if owner_ids is not None:
+        query = query.where(owner_column.in_(owner_ids))
+    for owner_id, url, is_primary in session.execute(query):
+        if owner_id not in urls or (is_primary and not urls[owner_id][1]):
+            urls[owner_id] = (url, bool(is_primary))
+    return {owner_id: url for owner_id, (url, _) in urls.items()}
+
+
+class _Catalog:
+    """Sorted name and token arrays for one kind of entity (books or authors)."""
+
+    def __init__(self, with_isbns=False):
+        self.with_isbns = with_isbns
+        self.entries = {}
+        self.names = []
+        self.tokens = []
+        self.isbns = []
+
+    def keys(self, entry):
+        """Yield the (array name, key) pairs under which ``entry`` is indexed."""
+        yield "names", entry["folded"]
+        for token in set(tokenize(entry["folded"])):
+            yield "tokens", token
+        if self.with_isbns:
+            for isbn in {entry["isbn_10"], entry["isbn_13"]} - {None}:
+                yield "isbns", isbn
+
+    def add(self, entry):
+        entity_id = entry["payload"]["id"]
+        self.remove(entity_id)
+        self.entries[entity_id] = entry
+        for array, key in self.keys(entry):
+            insort(getattr(self, array), (key, entity_id))
+
+    def remove(self, entity_id):
+        entry = self.entries.pop(entity_id, None)
+        if entry is None:
+            return
+        for array, key in self.keys(entry):
+            entries = getattr(self, array)
+            position = bisect_left(entries, (key, entity_id))
+            if position < len(entries) and entries[position] == (key, entity_id):
+                del entries[position]
+
+    def load(self, entries):
+        self.entries = {entry["payload"]["id"]: entry for entry in entries}
+        arrays = {"names": [], "tokens": [], "isbns": []}
+        for entry in entries:
+            for array, key in self.keys(entry):
+                arrays[array].append((key, entry["payload"]["id"]))
+        for array, keys in arrays.items():
+            setattr(self, array, sorted(keys))
+
+    def name_matches(self, query):
+        """Entities whose name starts with the query, in name order (exact matches come first)."""
+        start, end = _prefix_range(self.names, query)
+        for position in range(start, end):
+            yield self.names[position][1]
+
+    def contains_matches(self, query):
+        """Entities whose name contains the query at a word boundary."""
+        words = tokenize(query)
+        if not words:
+            return
+        start, end = _prefix_range(self.tokens, words[0])
+        seen = set()
+        for position in range(start, end):
+            entity_id = self.tokens[position][1]
+            if entity_id not in seen and query in self.entries[entity_id]["folded"]:
+                seen.add(entity_id)
+                yield entity_id
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.entries)
+        for entry in self.entries.values():
+            size += sys.getsizeof(entry) + sum(sys.getsizeof(value) for value in entry.values())
+            size += sum(sys.getsizeof(value) for value in entry["payload"].values())
+        for array in (self.names, self.tokens, self.isbns):
+            size += sys.getsizeof(array) + sum(sys.getsizeof(item) + sys.getsizeof(item[0]) for item in array)
+        return size
+
+
+class SuggestionIndex:
+    """Per-worker prefix index of book titles, ISBNs and author names."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.books = _Catalog(with_isbns=True)
+        self.authors = _Catalog()
+        self.built_at = None
+        self._stale_books = set()
+        self._stale_authors = set()
+
+    # ----------- LOADING -----------
+
+    @staticmethod
+    def _book_entries(session, book_ids=None):
+        query = sa.select(Book.id, Book.title, Book.isbn_10, Book.isbn_13)
+        covers = _primary_urls(session, Cover, Cover.book_id, book_ids)
+        if book_ids is not None:
+            query = query.where(Book.id.in_(book_ids))
+        return [
+            {
+                "folded": " ".join(fold(title).split()),
+                "isbn_10": isbn_10,
+                "isbn_13": isbn_13,
+                "payload": {"id": book_id, "title": title, "cover_url": covers.get(book_id)},
+            }
+            for book_id, title, isbn_10, isbn_13 in session.execute(query)
+        ]
+
+    @staticmethod
+    def _author_entries(session, author_ids=None):
+        query = sa.select(Author.id, Author.name)
+        photos = _primary_urls(session, AuthorPhoto, AuthorPhoto.author_id, author_ids)
+        if author_ids is not None:
+            query = query.where(Author.id.in_(author_ids))
+        return [
+            {
+                "folded": " ".join(fold(name).split()),
+                "payload": {"id": author_id, "name": name, "photo_url": photos.get(author_id)},
+            }
+            for author_id, name in session.execute(query)
+        ]
+
+    def build(self, session):
+        """Load every book and author."""
+        books = self._book_entries(session)
+        authors = self._author_entries(session)
+        with self._lock:
+            self._stale_books.clear()
+            self._stale_authors.clear()
+            self.books.load(books)
+            self.authors.load(authors)
+            self.built_at = time.monotonic()
+        current_app.logger.info(
+            "Suggestion index built: %d books, %d authors, %.1f KiB",
+            len(books), len(authors), self.memory_usage() / 1024
+        )
+
+    def refresh(self, session, ttl=None):
+        """Build the index if it is missing or older than ``ttl`` seconds, otherwise reload the stale rows."""
+        if self.built_at is None or (ttl is not None and time.monotonic() - self.built_at > ttl):
+            self.build(session)
+            return
+        with self._lock:
+            book_ids, self._stale_books = self._stale_books, set()
+            author_ids, self._stale_authors = self._stale_authors, set()
+        if book_ids:
+            books = {entry["payload"]["id"]: entry for entry in self._book_entries(session, book_ids)}
+            with self._lock:
+                for book_id in book_ids:
+                    if book_id in books:
+                        self.books.add(books[book_id])
+                    else:
+                        self.books.remove(book_id)
+        if author_ids:
+            authors = {entry["payload"]["id"]: entry for entry in self._author_entries(session, author_ids)}
+            with self._lock:
+                for author_id in author_ids:
+                    if author_id in authors:
+                        self.authors.add(authors[author_id])
+                    else:
+                        self.authors.remove(author_id)
+
+    def mark_stale(self, book_ids=(), author_ids=()):
+        with self._lock:
+            self._stale_books.update(book_ids)
+            self._stale_authors.update(author_ids)
+
+    def clear(self):
+        with self._lock:
+            self.books = _Catalog(with_isbns=True)
+            self.authors = _Catalog()
+            self.built_at = None
+            self._stale_books.clear()
+            self._stale_authors.clear()
+
+    # ----------- QUERIES -----------
+
+    def suggest_books(self, query, limit=BOOK_LIMIT):
+        folded = " ".join(fold(query).split())
+        scores = {}
+        with self._lock:
+            books = self.books
+            # ISBN exact matches
+            start, end = bisect_left(books.isbns, (query,)), bisect_left(books.isbns, (query, sys.maxsize))
+            for position in range(start, end):
+                entry = books.entries[books.isbns[position][1]]
+                scores[entry["payload"]["id"]] = ISBN_SCORE * ((entry["isbn_10"] == query) + (entry["isbn_13"] == query))
+            # Title exact and prefix matches (exact titles sort first)
+            for count, book_id in enumerate(books.name_matches(folded)):
+                if count >= limit:
+                    break
+                title = books.entries[book_id]["folded"]
+                scores[book_id] = scores.get(book_id, 0) + PREFIX_SCORE + CONTAINS_SCORE + (BOOK_EXACT_SCORE if title == folded else 0)
+            # Title contains matches
+            for book_id in books.contains_matches(folded):
+                if len(scores) >= limit:
+                    break
+                if book_id not in scores:
+                    scores[book_id] = CONTAINS_SCORE
+            # Partial ISBN matches, from the start of the ISBN
+            start, end = _prefix_range(books.isbns, query)
+            for position in range(start, end):
+                if len(scores) >= limit:
+                    break
+                scores.setdefault(books.isbns[position][1], 0)
+            payloads = {book_id: books.entries[book_id]["payload"] for book_id in scores}
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        return [{**payloads[book_id], 'score': score} for book_id, score in ranked]
+
+    def suggest_authors(self, query, limit=AUTHOR_LIMIT):
+        folded = " ".join(fold(query).split())
+        scores = {}
+        with self._lock:
+            authors = self.authors
+            for count, author_id in enumerate(authors.name_matches(folded)):
+                if count >= limit:
+                    break
+                name = authors.entries[author_id]["folded"]
+                scores[author_id] = PREFIX_SCORE + CONTAINS_SCORE + (AUTHOR_EXACT_SCORE if name == folded else 0)
+            for author_id in authors.contains_matches(folded):
+                if len(scores) >= limit:
+                    break
+                scores.setdefault(author_id, CONTAINS_SCORE)
+            payloads = {author_id: authors.entries[author_id]["payload"] for author_id in scores}
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        return [{**payloads[author_id], 'score': score} for author_id, score in ranked]
+
+    # ----------- STATS -----------
+
+    def memory_usage(self):
+        """Approximate size of the index in bytes."""
+        with self._lock:
+            return self.books.memory_usage() + self.authors.memory_usage()
+
+    def stats(self):
+        return {
+            "books": len(self.books.entries),
+            "authors": len(self.authors.entries),
+            "memory_bytes": self.memory_usage(),
+            "age_seconds": None if self.built_at is None else round(time.monotonic() - self.built_at, 1),
+        }
+
+
+suggestion_index = SuggestionIndex()
+
+
+# ----------- CHANGE TRACKING -----------
+
+@event.listens_for(so.Session, "after_flush")
+def _collect_suggestion_changes(session, flush_context):
+    changes = session.info.setdefault("suggestion_changes", (set(), set()))
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Book):
+            changes[0].add(obj.id)
+        elif isinstance(obj, Cover):
+            changes[0].add(obj.book_id)
+        elif isinstance(obj, Author):
+            changes[1].add(obj.id)
+        elif isinstance(obj, AuthorPhoto):
+            changes[1].add(obj.author_id)
+
+
+@event.listens_for(so.Session, "after_commit")
+def _publish_suggestion_changes(session):
+    book_ids, author_ids = session.info.pop("suggestion_changes", (set(), set()))
+    if book_ids or author_ids:
+        suggestion_index.mark_stale(book_ids - {None}, author_ids - {None})
+
+
+@event.listens_for(so.Session, "after_rollback")
+def _discard_suggestion_changes(session):
+    session.info.pop("suggestion_changes", None)
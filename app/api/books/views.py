@@ -2,20 +2,112 @@ from urllib.parse import unquote
 from sqlalchemy import or_
 from marshmallow.exceptions import ValidationError
 from flask import request, jsonify
-from flask import current_app, render_template, request, jsonify, Request
+from flask import current_app, render_template, request, jsonify, Request, abort
 from datetime import datetime
 from flask_login import login_required
-from app import db
+from app import db, cache
 from app.models import Book, Author, Genre, Series
 from app.api.books import books
 from app.schemas import BookSchema, AuthorSchema
-from app.models import OrderItem
+from app.models import BookPopularity
+from app.api.loaders import book_loader_options
+from app.api.pagination import keyset_paginate, order_clauses, InvalidCursor
+from app.api.etags import book_etag, collection_etag, items_etag, not_modified, with_etag
+from app.api.books.search import ranked_books
+from app.api.books.suggestions import suggestion_index
+from app.api.books.related import related_books_query
+from app.api.books.popularity import ranking_column
+from app.api.books.cards import card_query, dump_cards
 from sqlalchemy import func, case, desc
 
 book_schema = BookSchema()
 
 DEFAULT_PER_PAGE = 10  # Default number of items per page
 
+# Entities whose data shows up in the listing routes (see app.caching)
+BOOK_LIST_TAGS = ("book:*", "author:*", "genre:*", "series:*", "publisher:*")
+
+
+def book_cache_tags(book):
+    """Tags of the entities embedded in a book's full dump."""
+    related = {
+        "author": book.authors, "genre": book.genres, "series": book.series,
+        "publisher": book.publishers, "language": book.languages, "provider": book.providers,
+    }
+    return [f"{kind}:{item.id}" for kind, items in related.items() for item in items]
+
+
+# Best rated first (``sort_by=rating``), as (expression, descending) pairs
+RATING_ORDER = [(Book.rating_avg, True), (Book.rating_count, True), (Book.id, True)]
+
+
+def filter_by_rating(query):
+    """Apply the ``min_rating`` parameter of the listing routes."""
+    min_rating = request.args.get("min_rating", type=float)
+    if min_rating is not None:
+        query = query.filter(Book.rating_avg >= min_rating)
+    return query
+
+
+def keyset_response(query, order_by, per_page, dump=dump_cards, not_found_message=None):
+    """
+    Serve a page in cursor mode (``?cursor=`` on the listing routes).
+
+    Cursor pages skip the total count and seek past the previous page instead of using OFFSET,
+    so deep pages cost the same as the first one.
+
+    Args:
+        dump: Turns the items of the page into JSON, book cards by default.
+    """
+    cursor = request.args.get("cursor")
+    per_page = max(1, min(per_page, 100))
+    try:
+        items, next_cursor = keyset_paginate(query, order_by, cursor=cursor, per_page=per_page, salt=request.endpoint)
+    except InvalidCursor:
+        return jsonify({"error": "Invalid cursor"}), 400
+    if not items and not cursor and not_found_message:
+        return jsonify({"message": not_found_message}), 404
+    etag = items_etag(items, request.full_path, next_cursor)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    return with_etag(jsonify({
+        "books": dump(items),
+        "cursor": {
+            "next": next_cursor,
+            "per_page": per_page,
+            "has_next": next_cursor is not None
+        }
+    }), etag)
+
+
+def offset_response(query, order_by, page, per_page):
+    """
+    Serve a page of book cards in offset mode, with an ETag covering every book of the listing.
+
+    The ETag comes from the same aggregate query that counts the books, so a client that already
+    has the page gets its 304 before any book is loaded.
+    """
+    page = max(page, 1)
+    per_page = max(1, min(per_page, 100))
+    etag, total = collection_etag(db.session, query, request.full_path)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    rows = db.session.execute(query.order_by(*order_by).limit(per_page).offset((page - 1) * per_page)).all()
+    pages = -(-total // per_page)
+    return with_etag(jsonify({
+        "books": dump_cards(rows),
+        "pagination": {
+            "page": page,
+            "per_page": per_page,
+            "total": total,
+            "pages": pages,
+            "has_next": page < pages,
+            "has_prev": page > 1
+        }
+    }), etag)
+
 
 # TODO: use longin required for create, update, delete routes
 
@@ -64,41 +156,34 @@ def update_book(book_id):
 
 
 @books.route("", methods=["GET"])
+@cache.cached(*BOOK_LIST_TAGS)
 def get_books():
     # Extract query parameters
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("limit", DEFAULT_PER_PAGE, type=int)
 
-    # Create pagination object
-    pagination = db.paginate(
-        db.select(Book),
-        page=page,
-        per_page=per_page,
-        max_per_page=100,  # Optional: limit maximum items per page
-        error_out=False    # Don't raise 404 when page is out of range
-    )
+    query = filter_by_rating(card_query())
+    order_by = RATING_ORDER if request.args.get("sort_by") == "rating" else [(Book.id, False)]
 
-    simple_book_schema = BookSchema(only=["id", "title", "subtitle", "isbn_10", "isbn_13", "authors", "series", "genres", "publishers", "current_price", "cover_url", "previous_price", "rating"])
+    if "cursor" in request.args:
+        return keyset_response(query, order_by, per_page)
 
-    # Return JSON response with pagination information
-    return jsonify({
-        "books": [simple_book_schema.dump(book) for book in pagination.items],
-        "pagination": {
-            "page": pagination.page,
-            "per_page": pagination.per_page,
-            "total": pagination.total,
-            "pages": pagination.pages,
-            "has_next": pagination.has_next,
-            "has_prev": pagination.has_prev
-        }
-    })
+    return offset_response(query, order_clauses(order_by), page, per_page)
 
 
 @books.route("/<int:book_id>", methods=["GET"])
+@cache.cached("book:{book_id}")
 def get_book(book_id):
     """Retrieve a single book by its ID"""
+    etag = book_etag(db.session, book_id)
+    if etag is None:
+        abort(404)
+    response = not_modified(etag)
+    if response is not None:
+        return response
     book = db.get_or_404(Book, book_id)
-    return jsonify(book_schema.dump(book)), 200
+    cache.tag(*book_cache_tags(book))
+    return with_etag(jsonify(book_schema.dump(book)), etag), 200
 
 
 @books.route("/<int:book_id>", methods=["DELETE"])
@@ -125,24 +210,32 @@ def search_books():
     page = request.args.get('page', 1, type=int)
     limit = request.args.get('limit', DEFAULT_PER_PAGE, type=int)
 
-    # sort_by = request.args.get('sort_by', 'relevance', type=str)
+    sort_by = request.args.get('sort_by', 'relevance', type=str)
 
     current_app.logger.info(f"Searching for books with title: {title}, ISBN: {isbn}, author: {author_name}, query: {keywords}")
 
     # Build the query
-    query = db.select(Book)
-    if title:
-        query = query.filter(Book.title.ilike(f'%{title}%'))
+    query = filter_by_rating(db.select(Book).options(*book_loader_options()))
     if isbn:
         query = query.filter((Book.isbn_10 == isbn) | (Book.isbn_13 == isbn))
-    if author_name:
-        query = query.join(Book.authors).filter(Author.name.ilike(f'%{author_name}%'))
-    if keywords:
-        query = query.join(Book.authors).filter(
-            (Book.title.ilike(f'%{keywords}%')) |
-            (Book.description.ilike(f'%{keywords}%')) |
-            (Author.name.ilike(f'%{keywords}%'))
+    # Title, author and keyword filters go through the full-text index, best matches first
+    ranked = ranked_books(title=title, author=author_name, keywords=keywords)
+    order_by = [(Book.id, False)]
+    if ranked is not None:
+        query = query.join(ranked, ranked.c.book_id == Book.id)
+        order_by = [(ranked.c.rank, False), (Book.id, False)]
+    elif title or author_name or keywords:
+        return jsonify({"message": "No books found matching the search criteria"}), 404
+    if sort_by == 'rating':
+        order_by = RATING_ORDER
+
+    if "cursor" in request.args:
+        return keyset_response(
+            query, order_by, limit, dump=lambda items: book_schema.dump(items, many=True),
+            not_found_message="No books found matching the search criteria"
         )
+
+    query = query.order_by(*order_clauses(order_by))
     # Create pagination object
     pagination = db.paginate(
         query,
@@ -191,60 +284,13 @@ def suggestions():
 
 
 def suggest_books(query):
-    # Create a search pattern with wildcards for partial matches
-    search_pattern = f"%{query}%"
-
-    # Search in multiple fields with relevance scoring
-    book_results = db.session.query(
-        Book,
-        # Calculate relevance score
-        (
-            # Exact ISBN matches get highest score (10)
-            func.cast(Book.isbn_10 == query, db.Integer) * 10 +
-            func.cast(Book.isbn_13 == query, db.Integer) * 10 +
-            # Exact title matches get highest score (10)
-            func.cast(func.lower(Book.title) == query.lower(), db.Integer) * 10 +
-            # Title starts with query gets high score (5)
-            func.cast(func.lower(Book.title).like(f"{query.lower()}%"), db.Integer) * 5 +
-            # Title contains query gets medium score (3)
-            func.cast(func.lower(Book.title).like(search_pattern), db.Integer) * 3
-        ).label('relevance_score')
-    ).filter(
-        or_(
-            func.lower(Book.title).like(search_pattern),
-            Book.isbn_10.like(search_pattern),
-            Book.isbn_13.like(search_pattern),
-        )
-    ).order_by(
-        # Order by relevance score (descending)
-        db.desc('relevance_score')
-    ).limit(10).all()  # Limit to 10 results for performance
-
-    # Format the results
-    return [{**BookSchema(only=["id", "title", "cover_url"]).dump(book), 'score': score} for book, score in book_results]
+    suggestion_index.refresh(db.session, ttl=current_app.config['SUGGESTION_INDEX_TTL'])
+    return suggestion_index.suggest_books(query)
 
 
 def suggest_authors(query):
-    search_pattern = f"%{query}%"
-
-    author_results = db.session.query(
-        Author,
-        # Calculate relevance score
-        (
-            # Exact name matches get highest score (10)
-            func.cast(func.lower(Author.name) == query.lower(), db.Integer) * 11 +
-            # Name starts with query gets high score (5)
-            func.cast(func.lower(Author.name).like(f"{query.lower()}%"), db.Integer) * 5 +
-            # Name contains query gets medium score (3)
-            func.cast(func.lower(Author.name).like(search_pattern), db.Integer) * 3
-        ).label('relevance_score')
-    ).filter(
-        func.lower(Author.name).like(search_pattern)
-    ).order_by(
-        db.desc('relevance_score')
-    ).limit(5).all()  # Limit to 5 author results
-
-    return [{**AuthorSchema(only=["id", "name", "photo_url"]).dump(author), 'score': score}for author, score in author_results]
+    suggestion_index.refresh(db.session, ttl=current_app.config['SUGGESTION_INDEX_TTL'])
+    return suggestion_index.suggest_authors(query)
 
 
 @books.route('/<int:book_id>/authors', methods=['PUT'])
@@ -362,42 +408,41 @@ def remove_series_from_book(book_id, series_id):
 
 @books.route('/popular', methods=['GET'])
 def get_popular_books():
-    """Get the most popular books"""
-    # Get the top 10 most popular books
-    popular_books = db.session.query(Book).join(OrderItem).group_by(OrderItem.book_id).order_by(func.count(OrderItem.book_id).desc()).limit(10).all()
+    """Get the best-selling books over the last 7 days, 30 days or all time (``window``), by units sold or revenue (``metric``)"""
+    window = request.args.get('window', 'all', type=str)
+    metric = request.args.get('metric', 'quantity', type=str)
+    limit = max(1, min(request.args.get('limit', DEFAULT_PER_PAGE, type=int), 100))
+    try:
+        ranking = ranking_column(window, metric)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Read from the maintained popularity counters (see app.api.books.popularity)
+    popular_books = db.session.execute(
+        card_query()
+        .join(BookPopularity, BookPopularity.book_id == Book.id)
+        .where(ranking > 0)
+        .order_by(ranking.desc(), Book.id)
+        .limit(limit)
+    ).all()
     if not popular_books:
         return jsonify({"message": "No popular books found"}), 404
-    return jsonify([book_schema.dump(book) for book in popular_books]), 200
+    return jsonify(dump_cards(popular_books)), 200
 
 
 # TODO: add a test for this route
 @books.route('/latest', methods=['GET'])
+@cache.cached(*BOOK_LIST_TAGS)
 def get_latest_books():
     # Extract query parameters
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("limit", DEFAULT_PER_PAGE, type=int)
 
-    pagination = db.session.query(Book).filter(Book.publish_date.isnot(None)).order_by(Book.publish_date.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-
-    for book in pagination.items:
-        current_app.logger.info(f"Book: {book.title}, ID: {book.id}, Publish Date: {book.publish_date}")
+    query = filter_by_rating(card_query().filter(Book.publish_date.isnot(None)))
 
-    simple_book_schema = BookSchema(only=["id", "title", "subtitle", "isbn_10", "isbn_13", "authors", "series", "genres", "publishers", "current_price", "cover_url", "previous_price", "rating"])
+    if "cursor" in request.args:
+        return keyset_response(query, [(Book.publish_date, True), (Book.id, True)], per_page)
 
-    # Return JSON response with pagination information
-    return jsonify({
-        "books": [simple_book_schema.dump(book) for book in pagination.items],
-        "pagination": {
-            "page": pagination.page,
-            "per_page": pagination.per_page,
-            "total": pagination.total,
-            "pages": pagination.pages,
-            "has_next": pagination.has_next,
-            "has_prev": pagination.has_prev
-        }
-    })
+    return offset_response(query, [Book.publish_date.desc()], page, per_page)
 
 
 @books.route('/related/<int:book_id>', methods=['GET'])
@@ -416,56 +461,24 @@ def get_related_books(book_id):
         # Get the source book
         book = db.get_or_404(Book, book_id)
 
-        # Extract authors and genres
-        author_ids = [author.id for author in book.authors]
-        genre_ids = [genre.id for genre in book.genres]
-
-        if not author_ids and not author_ids:
+        # The related books are precomputed (see app.api.books.related), a stale list is scored without storing it
+        query = related_books_query(book_id, stored=book.related_computed_at is not None)
+        paginated_books = db.paginate(query.options(*book_loader_options()), page=page, per_page=per_page, error_out=False)
+        if not paginated_books.total and not book.authors and not book.genres:
             return jsonify({"message": "Source book has no authors or genres to match", "data": []}), 200
 
-        # Fixed case() syntax for newer SQLAlchemy versions
-        # Define the scoring expressions
-        author_score = func.sum(case((Author.id.in_(author_ids), 3), else_=0))
-        genre_score = func.sum(case((Genre.id.in_(genre_ids), 1), else_=0))
-
-        # Get book IDs with scores first
-        score_query = (db.session.query(
-            Book.id.label('book_id'),
-            (author_score + genre_score).label('relevance_score'))
-            .outerjoin(Book.authors)
-            .outerjoin(Book.genres)
-            .filter(
-                (Book.id != book_id) &
-                ((Author.id.in_(author_ids)) | (Genre.id.in_(genre_ids)))
-        )
-            .group_by(Book.id)
-            .order_by(desc('relevance_score'))
-        )
-
-        # Get paginated results
-        paginated_scores = score_query.paginate(page=page, per_page=per_page)
-        book_ids = [result.book_id for result in paginated_scores.items]
-        scores_by_id = {result.book_id: result.relevance_score for result in paginated_scores.items}
-
-        # Load full Book objects separately
-        books = db.session.query(Book).filter(Book.id.in_(book_ids)).all()
-
-        # Sort books in the same order as the scores
-        books.sort(key=lambda b: scores_by_id.get(b.id, 0), reverse=True)
-
-        # Create your own pagination metadata since we're not using the ORM's pagination on the books
         pagination = {
-            "total": paginated_scores.total,
-            "pages": paginated_scores.pages,
+            "total": paginated_books.total,
+            "pages": paginated_books.pages,
             "page": page,
             "per_page": per_page,
-            "has_next": paginated_scores.has_next,
-            "has_prev": paginated_scores.has_prev
+            "has_next": paginated_books.has_next,
+            "has_prev": paginated_books.has_prev
         }
 
         # Prepare response with pagination metadata
         response = {
-            "books": [book_schema.dump(b) for b in books],
+            "books": [book_schema.dump(b) for b in paginated_books.items],
             "pagination": pagination
         }
 
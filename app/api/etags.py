@@ -0,0 +1,154 @@
+# Strong ETags for the book and author resources.
+#
+# Products and authors carry a ``version`` counter that is bumped whenever something shown in
+# their JSON changes: their own columns and collections, the covers and reviews of a book,
+# the photos of an author, and the names of the authors and taxonomies a book embeds. The
+# views build their ETag from these counters with a couple of narrow queries and answer
+# ``If-None-Match`` with a 304 before loading relationships or serializing anything.
+import hashlib
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from flask import current_app, request
+from app.models import Product, Book, Author, AuthorPhoto, Cover, Review, Genre, Series, Publisher, Language, Provider
+from app.models.books import book_authors, book_genres, book_series, book_publishers, book_languages, book_providers
+
+# Association table (and its column) linking each taxonomy embedded in the book JSON to its books
+TAXONOMY_BOOKS = {
+    Genre: (book_genres, "genre_id"),
+    Series: (book_series, "series_id"),
+    Publisher: (book_publishers, "publisher_id"),
+    Language: (book_languages, "language_id"),
+    Provider: (book_providers, "provider_id"),
+}
+
+
+def make_etag(*parts):
+    """Hash ``parts`` into an ETag value."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already has ``etag``, otherwise None."""
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def book_etag(session, book_id):
+    """ETag of a book's full JSON, or None if the book doesn't exist."""
+    version = session.execute(sa.select(Product.version).where(Product.id == book_id)).scalar()
+    return None if version is None else make_etag("book", book_id, version)
+
+
+def collection_etag(session, query, *parts):
+    """
+    ETag of a listing, from aggregates of the versions and ids of every row ``query`` matches.
+
+    One aggregate query stands in for the listing's COUNT(*): versions only go up and new rows
+    get new ids, so the sums change whenever a row of the listing changes, joins or leaves it.
+
+    Returns:
+        tuple: The ETag and the number of rows.
+    """
+    rows = query.order_by(None).subquery()
+    total, versions, ids = session.execute(
+        sa.select(sa.func.count(), sa.func.sum(rows.c.version), sa.func.sum(rows.c.id))
+    ).one()
+    return make_etag("collection", total, versions, ids, *parts), total
+
+
+def items_etag(items, *parts):
+    """ETag of a list of loaded books or authors, or of row tuples that include their version."""
+    return make_etag("items", [tuple(item) if isinstance(item, tuple) else (item.id, item.version) for item in items], *parts)
+
+
+def author_etag(session, author_id):
+    """ETag of an author's JSON (which embeds the author's books), or None if the author doesn't exist."""
+    version = session.execute(sa.select(Author.version).where(Author.id == author_id)).scalar()
+    if version is None:
+        return None
+    books = session.execute(
+        sa.select(book_authors.c.book_id, Product.version)
+        .join(Product, Product.id == book_authors.c.book_id)
+        .where(book_authors.c.author_id == author_id)
+        .order_by(book_authors.c.book_id)
+    ).all()
+    return make_etag("author", author_id, version, [tuple(book) for book in books])
+
+
+def authors_etag(session):
+    """ETag of the list of every author and their books."""
+    authors = session.execute(sa.select(sa.func.count(Author.id), sa.func.sum(Author.version), sa.func.max(Author.id))).one()
+    books = session.execute(
+        sa.select(sa.func.count(), sa.func.sum(Product.version))
+        .select_from(book_authors)
+        .join(Product, Product.id == book_authors.c.book_id)
+    ).one()
+    return make_etag("authors", tuple(authors), tuple(books))
+
+
+# ----------- VERSION BUMPS -----------
+
+def _changed(session):
+    """Yield the new, modified and deleted objects of a flush."""
+    yield from session.new
+    yield from (obj for obj in session.dirty if session.is_modified(obj))
+    yield from session.deleted
+
+
+@event.listens_for(so.Session, "after_flush")
+def _bump_versions(session, flush_context):
+    book_ids, author_ids, taxonomies = set(), set(), {}
+    for obj in _changed(session):
+        if isinstance(obj, Book) and obj not in session.new:
+            book_ids.add(obj.id)
+        elif isinstance(obj, (Cover, Review)):
+            book_ids.add(obj.book_id)
+        elif isinstance(obj, Author) and obj not in session.new:
+            author_ids.add(obj.id)
+        elif isinstance(obj, AuthorPhoto):
+            author_ids.add(obj.author_id)
+        elif type(obj) in TAXONOMY_BOOKS and obj not in session.new:
+            taxonomies.setdefault(type(obj), set()).add(obj.id)
+    if not (book_ids or author_ids or taxonomies):
+        return
+    connection = session.connection()
+    # The books embedding a changed author or taxonomy change too
+    embedding = [sa.select(book_authors.c.book_id).where(book_authors.c.author_id.in_(author_ids))]
+    for model, ids in taxonomies.items():
+        table, column = TAXONOMY_BOOKS[model]
+        embedding.append(sa.select(table.c.book_id).where(table.c[column].in_(ids)))
+    book_ids.update(connection.execute(sa.union(*embedding)).scalars())
+    book_ids.discard(None)
+    author_ids.discard(None)
+    product = Product.__table__
+    author = Author.__table__
+    if book_ids:
+        connection.execute(product.update().where(product.c.id.in_(book_ids)).values(version=product.c.version + 1))
+    if author_ids:
+        connection.execute(author.update().where(author.c.id.in_(author_ids)).values(version=author.c.version + 1))
+    session.info.setdefault("bumped_versions", []).append((book_ids, author_ids))
+
+
+@event.listens_for(so.Session, "after_flush_postexec")
+def _expire_versions(session, flush_context):
+    # The loaded objects still hold the old versions, reload them on next access
+    for book_ids, author_ids in session.info.pop("bumped_versions", []):
+        for model, ids in ((Book, book_ids), (Author, author_ids)):
+            for identity in ids:
+                obj = session.identity_map.get(session.identity_key(model, identity))
+                if obj is not None:
+                    session.expire(obj, ["version"])
+
+
+@event.listens_for(so.Session, "after_rollback")
+def _discard_versions(session):
+    session.info.pop("bumped_versions", None)
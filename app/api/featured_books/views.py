@@ -1,6 +1,7 @@
 from flask import jsonify, request
 from datetime import datetime
-from app import db
+from app import db, cache
+from app.caching import BOOK_DUMP_TAGS
 from app.models import FeaturedBook, Book
 from app.schemas import FeaturedBookSchema
 from app.api.featured_books import featured_books
@@ -31,6 +32,7 @@ def create_featured_book():
 
 
 @featured_books.route('', methods=['GET'])
+@cache.cached("featured_book:*", *BOOK_DUMP_TAGS)
 def get_featured_books():
     """Retrieve a list of featured_books with filtering, pagination, and sorting"""
     # TODO: get only the featured_books that are not expired
@@ -39,6 +41,7 @@ def get_featured_books():
 
 
 @featured_books.route('/<int:featured_book_id>', methods=['GET'])
+@cache.cached("featured_book:{featured_book_id}", *BOOK_DUMP_TAGS)
 def get_featured_book(featured_book_id):
     """Retrieve a single featured_book by its ID"""
     featured_book = db.session.execute(db.select(FeaturedBook).filter_by(id=featured_book_id)).scalar()
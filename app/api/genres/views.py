@@ -1,5 +1,5 @@
 from flask import jsonify, request
-from app import db
+from app import db, cache
 from app.api.genres import genres
 from app.models import Genre
 
@@ -19,6 +19,7 @@ def create_genre():
 
 
 @genres.route('', methods=['GET'])
+@cache.cached("genre:*")
 def get_genres():
     """Retrieve a list of genres with filtering, pagination, and sorting"""
     genres = db.session.execute(db.select(Genre)).scalars()
@@ -26,6 +27,7 @@ def get_genres():
 
 
 @genres.route('/<int:genre_id>', methods=['GET'])
+@cache.cached("genre:{genre_id}")
 def get_genre(genre_id):
     """Retrieve a single genre by its ID"""
     genre = db.session.execute(
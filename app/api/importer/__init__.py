@@ -0,0 +1 @@
+# Catalog import engine behind ``flask api populate`` (see app.api.populate for the command).
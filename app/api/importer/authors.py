@@ -0,0 +1,115 @@
+# Lookup indexes over the authors file, built once per import.
+#
+# ``find_authors_by_id`` and ``find_authors_by_name`` scan the whole authors DataFrame for
+# every id or name of every book. AuthorIndex gives the same answers from hash maps: one per
+# id column (value -> first row) and, for the name columns, one on the lowercased names plus
+# a trigram index for the case-insensitive substring match. A name is looked up by
+# intersecting the posting lists of its trigrams and checking the few rows that remain.
+# Names that pandas would read as regular expressions go through the original scan.
+import pandas as pd
+from app.api.importer.rows import find_authors_by_id, find_authors_by_name
+
+ID_COLUMNS = ("id_cdl", "key_ol")
+NAME_COLUMNS = ("name_cdl", "name_alejandria")
+
+NGRAM = 3
+REGEX_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class NameIndex:
+    """Case-insensitive substring lookups over one column, answering with the first matching row."""
+
+    def __init__(self, labels, values):
+        self.labels = labels
+        self.values = [value.lower() if isinstance(value, str) else None for value in values]
+        self.exact = {}
+        self.postings = {}
+        self._posting_sets = {}
+        for position, value in enumerate(self.values):
+            if value is None:
+                continue
+            self.exact.setdefault(value, position)
+            for gram in ngrams(value):
+                self.postings.setdefault(gram, []).append(position)
+
+    def first(self, name):
+        """Label of the first row containing ``name``, or None."""
+        name = name.lower()
+        best = self.exact.get(name)
+        grams = ngrams(name)
+        if grams:
+            postings = sorted((self.postings.get(gram, []) for gram in grams), key=len)
+            if not postings[0]:
+                return None
+            others = [self._posting_set(gram) for gram in grams if self.postings[gram] is not postings[0]]
+            candidates = (position for position in postings[0] if all(position in other for other in others))
+        else:
+            # Names shorter than a trigram match too many rows for an index to help
+            candidates = range(len(self.values))
+        for position in candidates:
+            if best is not None and position >= best:
+                break
+            value = self.values[position]
+            if value is not None and name in value:
+                best = position
+                break
+        return None if best is None else self.labels[best]
+
+    def _posting_set(self, gram):
+        if gram not in self._posting_sets:
+            self._posting_sets[gram] = set(self.postings[gram])
+        return self._posting_sets[gram]
+
+
+class AuthorIndex:
+    """
+    Answer the author lookups of ``process_authors`` in constant time per id or name.
+
+    ``find_authors_by_id`` and ``find_authors_by_name`` take the same arguments (minus the
+    DataFrame) and return the same row labels as the functions of the same name in app.api.importer.rows.
+    """
+
+    def __init__(self, authors_df):
+        self.authors_df = authors_df
+        labels = list(authors_df.index)
+        self.ids = {}
+        for column in ID_COLUMNS:
+            index = self.ids[column] = {}
+            for label, value in zip(labels, authors_df[column]):
+                if not pd.isna(value):
+                    index.setdefault(value, label)
+        self.names = {
+            column: NameIndex(labels, authors_df[column].tolist())
+            for column in NAME_COLUMNS if authors_df[column].dtype == object
+        }
+        self._matches = {}
+
+    def find_authors_by_id(self, ids, column_name):
+        if column_name not in self.ids:
+            return find_authors_by_id(self.authors_df, ids, column_name)
+        index = self.ids[column_name]
+        authors_indices = set()
+        for author_id in ids:
+            label = index.get(author_id)
+            if label is not None:
+                authors_indices.add(label)
+        return authors_indices
+
+    def find_authors_by_name(self, names, column_name):
+        index = self.names.get(column_name)
+        authors_indices = set()
+        for name in names:
+            if index is None or not isinstance(name, str) or REGEX_CHARACTERS & set(name):
+                # Not a plain substring search, let pandas handle (or reject) it
+                authors_indices.update(find_authors_by_name(self.authors_df, [name], column_name))
+                continue
+            key = (column_name, name)
+            if key not in self._matches:
+                self._matches[key] = index.first(name)
+            if self._matches[key] is not None:
+                authors_indices.add(self._matches[key])
+        return authors_indices
@@ -0,0 +1,387 @@
+# Set-based import engine behind ``flask api populate --bulk``.
+#
+# The row-by-row path resolves every genre, publisher, author, cover... with a SELECT and
+# flushes each new entity as soon as it meets it. CatalogImport applies the same rules to
+# in-memory indexes instead. Entities are deduplicated across the whole file and numbered in
+# the order the row-by-row path would insert them, so both paths produce the same rows with
+# the same ids. ``write`` then inserts every table, association tables included, with batched
+# executemany. Like ``populate``, it expects empty tables.
+#
+# Normalizing and validating the rows (``prepare_book``, ``prepare_author``) only depends on
+# the row itself, so with ``workers`` > 1 it runs in a process pool. The results come back in
+# file order and are resolved by this process alone, so the deduplication is the same.
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+import pandas as pd
+import sqlalchemy as sa
+from app.models import Book, Product, Author, AuthorPhoto, Cover, FeaturedBook, Genre, Publisher, Language, Series, Provider
+from app.models.books import book_authors, book_genres, book_publishers, book_languages, book_series, book_providers
+from app.schemas import (
+    BookSchema, AuthorSchema, GenreSchema, PublisherSchema, LanguageSchema, SeriesSchema,
+    CoverSchema, AuthorPhotoSchema,
+)
+from app.api.books.related import refresh_related
+from app.api.books.search import rebuild_search_index
+from app.api.importer.rows import book_data_from_row, author_data_from_row, content_hash
+from app.api.importer.providers import provider_data
+from app.api.importer.authors import AuthorIndex
+
+INSERT_BATCH_SIZE = 1000
+# Rows sent to a worker process at a time
+PREPARE_CHUNK_SIZE = 500
+
+# Named entities linked to the books, with the model, schema and association table of each
+TAXONOMIES = {
+    "genres": (Genre, GenreSchema, book_genres, "genre_id"),
+    "publishers": (Publisher, PublisherSchema, book_publishers, "publisher_id"),
+    "languages": (Language, LanguageSchema, book_languages, "language_id"),
+    "series": (Series, SeriesSchema, book_series, "series_id"),
+}
+
+# Author matching of ``process_authors``: (AuthorIndex method, book column, authors column), tried in order
+AUTHOR_MATCHERS = (
+    ("find_authors_by_id", "author_ids_cdl", "id_cdl"),
+    ("find_authors_by_id", "authors_ol", "key_ol"),
+    ("find_authors_by_name", "author_names_cdl", "name_cdl"),
+    ("find_authors_by_name", "autor", "name_alejandria"),
+)
+
+# Columns of the books file the resolution needs, besides the book fields
+LINK_COLUMNS = ("covers", *TAXONOMIES, "cod_pro", "author_ids_cdl", "authors_ol", "author_names_cdl", "autor")
+
+_schemas = {}
+
+
+def _schema(schema_class):
+    # One instance per process, building a schema is expensive
+    if schema_class not in _schemas:
+        _schemas[schema_class] = schema_class()
+    return _schemas[schema_class]
+
+
+def prepare_book(row):
+    """Normalize and validate a row of the books file, returning the book fields and the link columns."""
+    return _schema(BookSchema).load(book_data_from_row(row)), {column: row[column] for column in LINK_COLUMNS}
+
+
+def prepare_author(item):
+    """
+    Normalize and validate a (label, row) of the authors file.
+
+    Errors are returned instead of raised: like in the row-by-row path, an invalid author only
+    fails the import when a book refers to it.
+    """
+    label, row = item
+    try:
+        return label, (_schema(AuthorSchema).load(author_data_from_row(row)), row["photos"])
+    except Exception as e:
+        return label, e
+
+
+class Rows:
+    """The rows of one table, numbered in insertion order like an autoincrement primary key."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, row):
+        row = {"id": len(self.rows) + 1, **row}
+        self.rows[row["id"]] = row
+        return row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows.values())
+
+
+class CatalogImport:
+    """
+    Resolve the rows of the books file into the rows of every catalog table.
+
+    Args:
+        authors_df (DataFrame): The deserialized authors file.
+        providers_df (DataFrame): The providers file.
+    """
+
+    def __init__(self, authors_df, providers_df):
+        self.authors_df = authors_df
+        self.author_index = AuthorIndex(authors_df)
+        self.providers_df = providers_df
+        self.books = Rows()
+        self.authors = Rows()
+        self.photos = Rows()
+        self.covers = Rows()
+        self.featured = Rows()
+        self.providers = Rows()
+        self.taxonomies = {collection: Rows() for collection in TAXONOMIES}
+        # book id -> {linked id: None} (ordered sets) for each collection of the books
+        self.links = {collection: {} for collection in (*TAXONOMIES, "providers", "authors")}
+
+        self._schemas = {collection: schema() for collection, (_, schema, _, _) in TAXONOMIES.items()}
+        self._cover_schema = CoverSchema()
+        self._photo_schema = AuthorPhotoSchema()
+
+        # Lookup indexes replacing the SELECTs of the row-by-row path
+        self._books_by_code_title = {}
+        self._books_by_isbn_10 = {}
+        self._books_by_isbn_13 = {}
+        self._names = {collection: {} for collection in TAXONOMIES}
+        self._covers_by_url = {}
+        self._book_covers = {}
+        self._featured_books = set()
+        self._authors_by_ol = {}
+        self._authors_by_cdl = {}
+        self._authors_by_name = {}
+        self._photos_by_url = {}
+        self._author_photos = {}
+        self._providers_by_code = {}
+        # Memoized per source row or value, the same authors and providers come back for many books
+        self._author_rows = {}
+        # Every provider of the file, before the first book like ProviderLinks
+        for code, data in provider_data(providers_df).items():
+            if data is not None:
+                self._providers_by_code[code] = self.providers.add(data)
+
+    # ----------- BOOKS -----------
+
+    def add_books(self, books, limit=None, workers=1, progress=None):
+        """
+        Resolve the first ``limit`` rows of ``books`` (every row if ``limit`` is falsy).
+
+        Args:
+            books (DataFrame | Iterable[DataFrame]): The deserialized books file, or its chunks
+                (see app.api.importer.reader.read_books) to stream it.
+            workers (int): Processes normalizing and validating the books and authors.
+            progress (Progress): Told about every chunk of resolved rows.
+        """
+        chunks = [books] if isinstance(books, pd.DataFrame) else books
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            if pool is not None:
+                authors = zip(self.authors_df.index, self.authors_df.to_dict("records"))
+                self._author_rows.update(pool.map(prepare_author, authors, chunksize=PREPARE_CHUNK_SIZE))
+            remaining = limit or None
+            for chunk in chunks:
+                if remaining is not None:
+                    chunk = chunk.head(remaining)
+                    remaining -= len(chunk)
+                rows = chunk.to_dict("records")
+                if pool is None:
+                    for row in rows:
+                        self.add_book(row)
+                else:
+                    for data, row in pool.map(prepare_book, rows, chunksize=PREPARE_CHUNK_SIZE):
+                        self.add_prepared_book(data, row)
+                if progress is not None:
+                    progress.update(len(rows))
+                if remaining == 0:
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def add_book(self, row):
+        """Resolve one row of the books file, as ``populate`` does for each row."""
+        return self.add_prepared_book(*prepare_book(row))
+
+    def add_prepared_book(self, data, row):
+        """Resolve the output of ``prepare_book``."""
+        book = self._add_book_data(data)
+        self._add_covers(book, row["covers"])
+        if self._book_covers.get(book["id"]) and book.get("description") is not None and book["id"] not in self._featured_books:
+            self.featured.add({"book_id": book["id"]})
+            self._featured_books.add(book["id"])
+        for collection in TAXONOMIES:
+            self._add_names(book, collection, row[collection])
+        self._add_provider(book, row["cod_pro"])
+        self._add_authors(book, row)
+        return book
+
+    def _book_keys(self, book):
+        if book.get("code_alejandria") is not None and book.get("title") is not None:
+            yield self._books_by_code_title, (book["code_alejandria"], book["title"])
+        if book.get("isbn_10") is not None:
+            yield self._books_by_isbn_10, book["isbn_10"]
+        if book.get("isbn_13") is not None:
+            yield self._books_by_isbn_13, book["isbn_13"]
+
+    def _add_book_data(self, data):
+        # Same matching as check_if_book_exists, and the same merge as merge_books
+        matches = [index[key] for index, key in self._book_keys(data) if key in index]
+        if matches:
+            book = self.books.rows[min(matches)]
+            for field, value in data.items():
+                if book.get(field) is None and value is not None:
+                    book[field] = value
+        else:
+            book = self.books.add({"type": "book", **data})
+        for index, key in self._book_keys(book):
+            index.setdefault(key, book["id"])
+        return book
+
+    def _add_covers(self, book, urls):
+        covers = self._book_covers.setdefault(book["id"], [])
+        for url in urls:
+            data = self._cover_schema.load({"url": url, "size": "large", "is_primary": len(covers) < 1})
+            cover = self._covers_by_url.get(url)
+            if cover is None:
+                cover = self.covers.add({**data, "book_id": None})
+                self._covers_by_url[url] = cover
+            if cover["id"] not in covers:
+                # A cover already seen on another book moves to this one
+                if cover["book_id"] is not None:
+                    self._book_covers[cover["book_id"]].remove(cover["id"])
+                cover["book_id"] = book["id"]
+                covers.append(cover["id"])
+
+    def _add_names(self, book, collection, names):
+        ids = self._names[collection]
+        links = self.links[collection].setdefault(book["id"], {})
+        for name in names:
+            if collection == "genres":
+                name = name.title()
+            if name not in ids:
+                data = self._schemas[collection].load({"name": name})
+                ids[name] = self.taxonomies[collection].add(data)["id"]
+            links[ids[name]] = None
+
+    # ----------- PROVIDERS -----------
+
+    def _add_provider(self, book, provider_id):
+        if pd.isna(provider_id) or provider_id is None:
+            return
+        provider = self._providers_by_code.get(provider_id)
+        if provider is None:
+            print(f"Error finding provider with id: {provider_id}")
+            return
+        self.links["providers"].setdefault(book["id"], {})[provider["id"]] = None
+
+    # ----------- AUTHORS -----------
+
+    def _add_authors(self, book, row):
+        # Same precedence as process_authors
+        found = set()
+        for finder, column, authors_column in AUTHOR_MATCHERS:
+            if found:
+                break
+            found = getattr(self.author_index, finder)(row[column], authors_column)
+            for index in found:
+                self._link_author(book, self._author_from_index(index))
+        if found:
+            return
+        for column in ("author_names_cdl", "autor"):
+            if len(row[column]) > 0:
+                for name in row[column]:
+                    if name == '':
+                        continue
+                    author_id = self._authors_by_name.get(name)
+                    if author_id is None:
+                        author_id = self._add_author({"name": name})["id"]
+                    self._link_author(book, author_id)
+                return
+
+    def _link_author(self, book, author_id):
+        self.links["authors"].setdefault(book["id"], {})[author_id] = None
+
+    def _add_author(self, data):
+        author = self.authors.add(data)
+        for index, key in (
+            (self._authors_by_ol, data.get("open_library_id")),
+            (self._authors_by_cdl, data.get("casa_del_libro_id")),
+            (self._authors_by_name, data.get("name")),
+        ):
+            if key is not None:
+                index.setdefault(key, author["id"])
+        return author
+
+    def _author_from_index(self, index):
+        """The id of the author of a row of the authors file, creating the author like process_author."""
+        if index not in self._author_rows:
+            self._author_rows[index] = prepare_author((index, self.authors_df.loc[index, :]))[1]
+        if isinstance(self._author_rows[index], Exception):
+            raise self._author_rows[index]
+        data, photos = self._author_rows[index]
+        if data["open_library_id"]:
+            author_id = self._authors_by_ol.get(data["open_library_id"])
+        elif data["casa_del_libro_id"]:
+            author_id = self._authors_by_cdl.get(data["casa_del_libro_id"])
+        else:
+            author_id = self._authors_by_name.get(data["name"])
+        if author_id is None:
+            author_id = self._add_author(dict(data))["id"]
+            self._add_photos(author_id, photos)
+        return author_id
+
+    def _add_photos(self, author_id, urls):
+        photos = self._author_photos.setdefault(author_id, [])
+        for url in urls:
+            data = self._photo_schema.load({"url": url, "size": "large", "is_primary": len(photos) < 1})
+            photo = self._photos_by_url.get(url)
+            if photo is None:
+                photo = self.photos.add({**data, "author_id": None})
+                self._photos_by_url[url] = photo
+            if photo["id"] not in photos:
+                if photo["author_id"] is not None:
+                    self._author_photos[photo["author_id"]].remove(photo["id"])
+                photo["author_id"] = author_id
+                photos.append(photo["id"])
+
+    # ----------- WRITING -----------
+
+    def _tables(self):
+        """(table, rows) pairs in foreign key order."""
+        product_columns = set(Product.__table__.c.keys())
+        book_columns = set(Book.__table__.c.keys())
+        yield Product.__table__, [{k: v for k, v in book.items() if k in product_columns} for book in self.books]
+        yield Book.__table__, [
+            {**{k: v for k, v in book.items() if k in book_columns}, "source_hash": content_hash(book)} for book in self.books
+        ]
+        yield Author.__table__, list(self.authors)
+        yield AuthorPhoto.__table__, list(self.photos)
+        yield Cover.__table__, list(self.covers)
+        yield FeaturedBook.__table__, list(self.featured)
+        for collection, (model, _, _, _) in TAXONOMIES.items():
+            yield model.__table__, list(self.taxonomies[collection])
+        yield Provider.__table__, list(self.providers)
+        associations = {
+            **{collection: (table, column) for collection, (_, _, table, column) in TAXONOMIES.items()},
+            "providers": (book_providers, "provider_id"),
+            "authors": (book_authors, "author_id"),
+        }
+        for collection, (table, column) in associations.items():
+            yield table, [
+                {"book_id": book_id, column: linked_id}
+                for book_id, linked in self.links[collection].items()
+                for linked_id in linked
+            ]
+
+    def write(self, connection, batch_size=INSERT_BATCH_SIZE):
+        """Insert every resolved row, then build the related books and the search index."""
+        for table, rows in self._tables():
+            insert_rows(connection, table, rows, batch_size)
+        if connection.dialect.name == "postgresql":
+            # The ids were assigned here, move the sequences past them
+            for table in (Product.__table__, Author.__table__, AuthorPhoto.__table__, Cover.__table__,
+                          FeaturedBook.__table__, Provider.__table__, *(model.__table__ for model, *_ in TAXONOMIES.values())):
+                connection.execute(sa.text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE(MAX(id), 1)) FROM {table.name}"
+                ))
+        refresh_related(connection, [book["id"] for book in self.books])
+        rebuild_search_index(connection)
+
+    def summary(self):
+        return {
+            "books": len(self.books), "authors": len(self.authors), "author_photos": len(self.photos),
+            "covers": len(self.covers), "featured_books": len(self.featured), "providers": len(self.providers),
+            **{collection: len(rows) for collection, rows in self.taxonomies.items()},
+        }
+
+
+def insert_rows(connection, table, rows, batch_size=INSERT_BATCH_SIZE):
+    """Insert ``rows`` into ``table`` with one executemany per batch of rows having the same keys."""
+    for _, group in groupby(rows, key=lambda row: tuple(row)):
+        group = list(group)
+        for start in range(0, len(group), batch_size):
+            connection.execute(table.insert(), group[start:start + batch_size])
@@ -0,0 +1,83 @@
+# Resumable runs of the row-by-row ``flask api populate``.
+#
+# After each committed batch, Checkpoint records the digest of the source files and the
+# number of books file rows done. A run started with ``--resume`` on the same files skips
+# those rows instead of starting over. RejectLog collects the rows that failed validation,
+# with the reason, and appends them to the reject file at the same commits. A crash never
+# leaves rejects of rows that will be read again.
+import hashlib
+import json
+import os
+
+DIGEST_BLOCK_SIZE = 1 << 20
+
+
+def source_digest(*paths):
+    """SHA-256 of the contents of ``paths``, in order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as source:
+            for block in iter(lambda: source.read(DIGEST_BLOCK_SIZE), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """The last committed row of an import of the source files with digest ``source``."""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.row = 0
+
+    def load(self):
+        """Resume from the saved checkpoint if it is for the same source files, returning the row to start at."""
+        try:
+            with open(self.path) as checkpoint:
+                saved = json.load(checkpoint)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return self.row
+        if saved.get("source") == self.source:
+            self.row = saved["row"]
+        return self.row
+
+    def save(self, row):
+        self.row = row
+        # Written aside and renamed, a crash mid-write keeps the previous checkpoint
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump({"source": self.source, "row": row}, checkpoint)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RejectLog:
+    """Rows that failed validation, written to a JSON lines file when their batch is committed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._pending = []
+
+    def add(self, row_number, reason, row):
+        self._pending.append({"row": row_number, "reason": reason, "data": row})
+
+    def flush(self):
+        if not self._pending:
+            return
+        with open(self.path, "a") as rejects:
+            for reject in self._pending:
+                rejects.write(json.dumps(reject, default=str) + "\n")
+        self.count += len(self._pending)
+        self._pending = []
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def discard(self):
+        """Forget the rejects of a rolled back batch, they are read again on resume."""
+        self._pending = []
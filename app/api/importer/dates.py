@@ -0,0 +1,72 @@
+# Date normalization of the imported publish, birth and death dates.
+#
+# The source files spell the same few formats over and over ("2005", "March 2005",
+# "2005-03-01", "Mar 1, 2005"). ``normalize_date`` answers those with precompiled patterns and
+# a memo of the raw strings already seen, and only hands the rest to dateutil's fuzzy parser.
+# Every fast path returns what the fuzzy parse would (missing months and days are the 1st).
+import re
+from datetime import date, datetime
+from functools import lru_cache
+from dateutil.parser import parse, parserinfo
+
+DATE_CACHE_SIZE = 65536
+# Filled in by dateutil for the parts a string doesn't have
+DEFAULT_DATE = datetime(2024, 1, 1)
+
+# "jan", "january", "sept"... -> month number, the names dateutil knows
+MONTHS = {name.lower(): number for number, names in enumerate(parserinfo.MONTHS, start=1) for name in names}
+
+ISO_DATE = re.compile(r"([1-9]\d{3})-(\d{1,2})-(\d{1,2})")
+YEAR = re.compile(r"[1-9]\d{3}")
+MONTH_YEAR = re.compile(r"([A-Za-z]+)\.? ([1-9]\d{3})")
+MONTH_DAY_YEAR = re.compile(r"([A-Za-z]+)\.? (\d{1,2}),? ([1-9]\d{3})")
+DAY_MONTH_YEAR = re.compile(r"(\d{1,2}) ([A-Za-z]+)\.?,? ([1-9]\d{3})")
+
+
+def _fast_date(text):
+    """The date of ``text`` if it has one of the known formats, else None."""
+    if match := ISO_DATE.fullmatch(text):
+        year, month, day = match.groups()
+    elif YEAR.fullmatch(text):
+        year, month, day = text, 1, 1
+    elif match := MONTH_YEAR.fullmatch(text):
+        month, year = match.groups()
+        day = 1
+    elif match := MONTH_DAY_YEAR.fullmatch(text):
+        month, day, year = match.groups()
+    elif match := DAY_MONTH_YEAR.fullmatch(text):
+        day, month, year = match.groups()
+    else:
+        return None
+    if isinstance(month, str) and not month.isdigit():
+        month = MONTHS.get(month.lower())
+        if month is None:
+            return None
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        # Out of range, let dateutil decide what it makes of it
+        return None
+
+
+def _parse_date(date_str):
+    try:
+        return parse(date_str, fuzzy=True, default=DEFAULT_DATE).strftime("%Y-%m-%d")
+    except Exception as e:
+        print(f"Error parsing date: {str(e)}")
+        return None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _normalize_text(date_str):
+    parsed = _fast_date(date_str.strip())
+    if parsed is not None:
+        return parsed.strftime("%Y-%m-%d")
+    return _parse_date(date_str)
+
+
+def normalize_date(date_str):
+    """Return ``date_str`` as "YYYY-MM-DD", or None if it has no date."""
+    if not isinstance(date_str, str):
+        return _parse_date(date_str)
+    return _normalize_text(date_str)
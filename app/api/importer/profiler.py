@@ -0,0 +1,126 @@
+# Stage timings of the row-by-row ``flask api populate --profile``.
+#
+# ImportProfiler is kept in ``session.info`` while it is attached, and ``stage`` is a no-op
+# without it, so the populate functions can mark their stages without passing it around.
+# Stages nest (the covers inside process_book, the photos inside process_authors). Time,
+# SQL statements and flushes go to the innermost running stage only, so the stages add up
+# to the whole import.
+import time
+from contextlib import contextmanager, nullcontext
+import sqlalchemy.orm as so
+from sqlalchemy import event
+
+PROFILER_KEY = "import_profiler"
+
+
+def stage(session, name):
+    """Time ``name`` on the profiler attached to ``session``, if any."""
+    profiler = session.info.get(PROFILER_KEY)
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+
+class StageStats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.statements = 0
+        self.flushes = 0
+
+
+class ImportProfiler:
+    """Per stage totals, and per book timings for the p50 / p99 of each stage."""
+
+    def __init__(self):
+        self.stages = {}
+        self.books = []
+        self._book = None
+        self._running = []
+
+    def _stats(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        return self.stages[name]
+
+    def _charge(self, now):
+        # Time since the innermost stage last started or resumed
+        if self._running:
+            name, started = self._running[-1]
+            elapsed = now - started
+            self._stats(name).seconds += elapsed
+            if self._book is not None:
+                self._book[name] = self._book.get(name, 0.0) + elapsed
+            self._running[-1] = (name, now)
+
+    @contextmanager
+    def stage(self, name):
+        self._charge(time.perf_counter())
+        self._stats(name)
+        self._running.append((name, time.perf_counter()))
+        try:
+            yield
+        finally:
+            self._charge(time.perf_counter())
+            self._running.pop()
+            if self._running:
+                self._running[-1] = (self._running[-1][0], time.perf_counter())
+
+    @contextmanager
+    def book(self):
+        """Group the stages run for one book."""
+        self._book = {}
+        try:
+            yield
+        finally:
+            self.books.append(self._book)
+            self._book = None
+
+    def _count(self, attribute):
+        if self._running:
+            stats = self._stats(self._running[-1][0])
+            setattr(stats, attribute, getattr(stats, attribute) + 1)
+
+    def _before_cursor_execute(self, *args, **kwargs):
+        self._count("statements")
+
+    def _after_flush(self, session, flush_context):
+        if session.info.get(PROFILER_KEY) is self:
+            self._count("flushes")
+
+    @contextmanager
+    def attach(self, session):
+        """Profile the stages run with ``session`` (see ``stage``)."""
+        engine = session.get_bind()
+        session.info[PROFILER_KEY] = self
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(so.Session, "after_flush", self._after_flush)
+        try:
+            yield self
+        finally:
+            event.remove(so.Session, "after_flush", self._after_flush)
+            event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+            session.info.pop(PROFILER_KEY, None)
+
+    def report(self):
+        """The summary table, one line per stage plus the whole book."""
+        header = f"{'stage':<20} {'total s':>9} {'p50 ms':>8} {'p99 ms':>8} {'SQL':>8} {'flushes':>8}"
+        lines = [header, "-" * len(header)]
+        totals = [sum(book.values()) for book in self.books]
+        rows = [(name, stats, [book.get(name, 0.0) for book in self.books]) for name, stats in self.stages.items()]
+        total = StageStats()
+        for stats in self.stages.values():
+            total.seconds += stats.seconds
+            total.statements += stats.statements
+            total.flushes += stats.flushes
+        for name, stats, per_book in rows + [("total", total, totals)]:
+            if any(per_book):
+                p50, p99 = (f"{percentile(per_book, q) * 1000:8.2f}" for q in (0.5, 0.99))
+            else:
+                p50 = p99 = f"{'-':>8}"
+            lines.append(f"{name:<20} {stats.seconds:9.2f} {p50} {p99} {stats.statements:8d} {stats.flushes:8d}")
+        lines.append(f"{len(self.books)} books")
+        return "\n".join(lines)
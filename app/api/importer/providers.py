@@ -0,0 +1,89 @@
+# Providers of an import, resolved once.
+#
+# The providers file has a few hundred rows shared by every book. Both import paths
+# validate it up front (``provider_data``) and create or update its providers in file order,
+# before the first book. The row-by-row path then links books through ProviderLinks. It
+# maps provider codes to ids in memory and writes the book_providers rows with one
+# executemany per batch, instead of a lookup, a validation and a SELECT per book.
+import pandas as pd
+import sqlalchemy as sa
+from marshmallow import ValidationError
+from app.models import Provider
+from app.models.books import book_providers
+from app.schemas import ProviderSchema
+from app.api.importer.rows import provider_data_from_row
+
+
+def provider_data(providers_df):
+    """Validated Provider fields of each code of the providers file (None if invalid), first row of a code first."""
+    schema = ProviderSchema()
+    providers = {}
+    for row in providers_df.to_dict("records"):
+        code = row["cod_pro"]
+        if pd.isna(code) or code in providers:
+            continue
+        try:
+            providers[code] = schema.load(provider_data_from_row(row))
+        except ValidationError as e:
+            print(f"Error loading provider {code}: {e.messages}")
+            providers[code] = None
+    return providers
+
+
+class ProviderLinks:
+    """
+    Upsert the providers of ``providers_df`` with ``session``, then collect the links of the books to them.
+
+    Links are written by ``flush``, before each commit of the import.
+    """
+
+    def __init__(self, session, providers_df):
+        self.session = session
+        self.pending = []
+        providers = {code: data for code, data in provider_data(providers_df).items() if data is not None}
+        # Matched on the validated code, the column is not a string like the file's
+        existing = {
+            provider.alejandria_code: provider
+            for provider in session.execute(
+                sa.select(Provider).where(Provider.alejandria_code.in_([data["alejandria_code"] for data in providers.values()]))
+            ).scalars()
+        } if providers else {}
+        models = {}
+        for code, data in providers.items():
+            provider = existing.get(data["alejandria_code"])
+            if provider is None:
+                provider = Provider(**data)
+                session.add(provider)
+            else:
+                for field, value in data.items():
+                    if getattr(provider, field) != value:
+                        setattr(provider, field, value)
+            models[code] = provider
+        session.flush()
+        self.ids = {code: provider.id for code, provider in models.items()}
+
+    def link(self, book, provider_code):
+        """Link ``book`` to the provider with ``provider_code`` at the next ``flush``."""
+        if pd.isna(provider_code) or provider_code is None:
+            return
+        provider_id = self.ids.get(provider_code)
+        if provider_id is None:
+            print(f"Error finding provider with id: {provider_code}")
+            return
+        self.pending.append((book, provider_id))
+
+    def flush(self):
+        """Insert the pending links the books don't have yet."""
+        if not self.pending:
+            return
+        # The new books need their ids
+        self.session.flush()
+        links = list(dict.fromkeys((book.id, provider_id) for book, provider_id in self.pending))
+        self.pending = []
+        existing = set(self.session.execute(
+            sa.select(book_providers.c.book_id, book_providers.c.provider_id)
+            .where(book_providers.c.book_id.in_({book_id for book_id, _ in links}))
+        ).all())
+        rows = [{"book_id": book_id, "provider_id": provider_id} for book_id, provider_id in links if (book_id, provider_id) not in existing]
+        if rows:
+            self.session.execute(book_providers.insert(), rows)
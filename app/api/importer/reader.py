@@ -0,0 +1,112 @@
+# Streaming reader for the tab-separated source files of ``flask api populate``.
+#
+# ``read_chunks`` reads a file a chunk of rows at a time and decodes its JSON columns the
+# way ``deserialize_columns`` does. A column is decoded with a single ``json.loads`` of all
+# its values joined into one JSON array, falling back to one call per distinct value when
+# some of them aren't JSON. Memory is bounded by the chunk size instead of several copies of
+# the whole file.
+import json
+import logging
+import time
+import pandas as pd
+
+CHUNK_SIZE = 5000
+# Arrow staging files, see app.api.importer.staging
+STAGING_SUFFIX = ".arrow"
+
+BOOKS_DTYPES = {'isbn_13': str, 'isbn_10': str, 'ean': str, 'weight': str}
+AUTHORS_DTYPES = {'id_cdl': str}
+PROVIDERS_DTYPES = {'cod_pro': str}
+
+
+def _loads(value):
+    try:
+        return json.loads(value)
+    except (json.JSONDecodeError, TypeError):
+        return value
+
+
+def decode_json_column(values):
+    """Decode a list of cells like ``deserialize_columns`` (cells that aren't JSON are kept as they are)."""
+    if values and all(isinstance(value, str) for value in values):
+        try:
+            decoded = json.loads("[" + ",".join(values) + "]")
+        except json.JSONDecodeError:
+            pass
+        else:
+            # A cell like "1, 2" would decode as two values, only trust an exact fit
+            if len(decoded) == len(values):
+                return decoded
+    memo = {}
+    decoded = []
+    for value in values:
+        if not isinstance(value, str):
+            decoded.append(_loads(value))
+            continue
+        if value not in memo:
+            memo[value] = _loads(value)
+        decoded.append(memo[value])
+    return decoded
+
+
+def decode_chunk(df):
+    """Decode the JSON columns of a chunk, skipping the date columns like ``deserialize_columns``."""
+    for column_name in df.columns:
+        # Only object columns hold strings, json.loads leaves every other value as it is
+        if df[column_name].dtype != object or 'date' in column_name:
+            continue
+        df[column_name] = pd.Series(decode_json_column(df[column_name].tolist()), index=df.index)
+    return df
+
+
+def read_chunks(path, dtype=None, chunksize=CHUNK_SIZE, decode=True):
+    """
+    Yield the rows of a tab-separated file as DataFrames of ``chunksize`` rows, with a continuous index.
+
+    Arrow staging files (see app.api.importer.staging) are read as they were written.
+    """
+    if str(path).endswith(STAGING_SUFFIX):
+        from app.api.importer.staging import read_staging  # the staging module imports this one
+        yield from read_staging(path, chunksize=chunksize)
+        return
+    with pd.read_csv(path, sep='\t', dtype=dtype, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield decode_chunk(chunk) if decode else chunk
+
+
+def read_books(path, chunksize=CHUNK_SIZE):
+    for chunk in read_chunks(path, dtype=BOOKS_DTYPES, chunksize=chunksize):
+        chunk['weight'] = chunk['weight'].astype('str')
+        yield chunk
+
+
+def read_table(path, dtype=None, chunksize=CHUNK_SIZE, decode=True):
+    """Read a whole (smaller) file through ``read_chunks``."""
+    chunks = list(read_chunks(path, dtype=dtype, chunksize=chunksize, decode=decode))
+    return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+
+
+class Progress:
+    """Log the number of rows processed and the throughput every ``every`` seconds."""
+
+    def __init__(self, logger=None, label="rows", every=5.0):
+        self.logger = logger or logging.getLogger(__name__)
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.started = self.reported = time.monotonic()
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def update(self, rows):
+        self.count += rows
+        now = time.monotonic()
+        if now - self.reported >= self.every:
+            self.reported = now
+            self.logger.info("Processed %d %s (%.0f rows/s)", self.count, self.label, self.rate)
+
+    def done(self):
+        self.logger.info("Processed %d %s in %.1fs (%.0f rows/s)", self.count, self.label, time.monotonic() - self.started, self.rate)
@@ -0,0 +1,143 @@
+# Row builders shared by the import paths of ``flask api populate``.
+#
+# Each function turns a row of the source files (a pandas Series or a plain dict) into the
+# fields of a model, without touching the database.
+import hashlib
+import json
+import pandas as pd
+from app.api.importer.dates import normalize_date
+
+
+def deserialize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    def _loads(value):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return value
+        except TypeError:
+            return value
+    result_df = df.copy()
+    for column_name in df.columns:
+        if df[column_name].dtype == 'float64' or 'date' in column_name:
+            continue
+        result_df[column_name] = result_df[column_name].apply(_loads)
+    return result_df
+
+
+def process_date(date_str):
+    return normalize_date(date_str)
+
+
+def get_field_value(row, field_name, default=None):
+    return row[field_name] if not pd.isna(row[field_name]) else default
+
+
+def author_data_from_row(author_row):
+    """Build the Author fields of a row of the authors file (before validation)."""
+    summary = author_row['summary_cdl'] if not pd.isna(author_row['summary_cdl']) else get_field_value(author_row, 'bio_ol')
+    name = author_row['name_cdl'] if not pd.isna(author_row['name_cdl']) else get_field_value(author_row, 'name_ol', author_row['name_alejandria'])
+    try:
+        death_date = process_date(author_row['death_date_ol']) if not pd.isna(author_row['death_date_ol']) else None
+    except Exception as e:
+        print(f"Error parsing death date: {str(e)}")
+        death_date = None
+    try:
+        birth_date = process_date(author_row['birth_date_ol']) if not pd.isna(author_row['birth_date_ol']) else None
+    except Exception as e:
+        print(f"Error parsing birth date: {str(e)}")
+        birth_date = None
+
+    return {
+        'name': name if not pd.isna(name) else None,
+        'birth_date': birth_date,
+        'birth_date_str': get_field_value(author_row, 'birth_date_ol'),
+        'death_date': death_date,
+        'death_date_str': get_field_value(author_row, 'death_date_ol'),
+        'biography': summary,
+        'other_names': author_row['other_names_ol'],
+        'open_library_id': get_field_value(author_row, 'key_ol'),
+        'casa_del_libro_id': get_field_value(author_row, 'id_cdl')
+    }
+
+
+def find_authors_by_id(authors_df, ids, column_name):
+    """Helper function to find authors by ID in a specific column."""
+    authors_indices = set()
+    for author_id in ids:
+        try:
+            author_row = authors_df[authors_df[column_name] == author_id]
+            if not author_row.empty:
+                authors_indices.add(author_row.index.values[0])
+        except Exception as e:
+            raise (e)
+            print(f"Error finding author by id: {str(e)}")
+    return authors_indices
+
+
+def find_authors_by_name(authors_df, names, column_name):
+    """Helper function to find authors by name in a specific column."""
+    authors_indices = set()
+    for name in names:
+        try:
+            author_rows = authors_df[authors_df[column_name].str.contains(name, case=False, na=False)]
+            if not author_rows.empty:
+                authors_indices.add(author_rows.index.values[0])
+        except Exception as e:
+            print(f"Error finding author by name: {str(e)}")
+    return authors_indices
+
+
+def book_data_from_row(book_row):
+    """Build the Book fields of a row of the books file (before validation)."""
+    return {
+        'title': get_field_value(book_row, 'title'),
+        'isbn_10': get_field_value(book_row, 'isbn_10'),
+        'isbn_13': get_field_value(book_row, 'isbn_13'),
+        'publish_date': process_date(book_row['publish_date']) if not pd.isna(book_row['publish_date']) else None,
+        'description': get_field_value(book_row, 'description'),
+        'current_price': get_field_value(book_row, 'precio', 0),
+        'price_alejandria': get_field_value(book_row, 'precio'),
+        'iva': get_field_value(book_row, 'iva'),
+        'cost': get_field_value(book_row, 'ultimo_costo'),
+        'cost_supplier': get_field_value(book_row, 'costo_proveedor'),
+        'average_cost_alejandria': get_field_value(book_row, 'costo_promedio'),
+        'last_cost_alejandria': get_field_value(book_row, 'ultimo_costo'),
+        'stock': get_field_value(book_row, 'stock_propio'),
+        'stock_alejandria': get_field_value(book_row, 'stock_propio'),
+        'stock_consig': get_field_value(book_row, 'stock_consig'),
+        'stock_consig_alejandria': get_field_value(book_row, 'stock_consig'),
+        'physical_format': get_field_value(book_row, 'physical_format'),
+        'number_of_pages': get_field_value(book_row, 'number_of_pages'),
+        'bar_code_alejandria': get_field_value(book_row, 'barra_cod'),
+        'isbn_alejandria': get_field_value(book_row, 'isbn'),
+        'code_alejandria': get_field_value(book_row, 'cod_art'),
+        'physical_dimensions': get_field_value(book_row, 'physical_dimensions'),
+        'weight': get_field_value(book_row, 'weight'),
+        'publish_places': book_row['publish_places'],
+        'edition_name': get_field_value(book_row, 'edition_name'),
+        'subtitle': get_field_value(book_row, 'subtitle')
+    }
+
+
+def content_hash(book_data):
+    """Hash of the Book fields built from the source rows of a book, stored in ``Book.source_hash``."""
+    fields = {field: value for field, value in book_data.items() if value is not None and field not in ('id', 'type')}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def provider_data_from_row(provider_row):
+    """Build the Provider fields of a row of the providers file (before validation)."""
+    return {
+        'alejandria_code': provider_row['cod_pro'],
+        'cedula': provider_row['cedula_proveedor'],
+        'name': get_field_value(provider_row, 'nombre_proveedor'),
+        'address': get_field_value(provider_row, 'direccion_proveedor'),
+        'phone': get_field_value(provider_row, 'telefono_proveedor'),
+        'email': get_field_value(provider_row, 'correo_proveedor'),
+        'contact_name': get_field_value(provider_row, 'nombre_contacto_proveedor'),
+        'nombre_banco': get_field_value(provider_row, 'nombre_banco_proveedor'),
+        'titular_banco': get_field_value(provider_row, 'titular_banco_proveedor'),
+        'rif_banco': get_field_value(provider_row, 'rif_banco_proveedor'),
+        'cod_cuenta': get_field_value(provider_row, 'cuenta_banco_proveedor'),
+        'notes': get_field_value(provider_row, 'notas')
+    }
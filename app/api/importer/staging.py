@@ -0,0 +1,149 @@
+# Arrow staging files for ``flask api populate``.
+#
+# ``flask api stage`` converts the tab-separated source files once into Arrow IPC files (".arrow")
+# holding what read_chunks yields: the list columns as native list<string> columns and the
+# numbers with their dtypes. Readers memory-map the file and skip the CSV tokenizing and
+# the JSON decoding. A column whose decoded values have no single Arrow type (numbers mixed
+# with text...) is stored as JSON text and decoded on read, so a staged file always reads
+# back like its source.
+#
+# pyarrow (in requirements.txt) is only imported when a staging file is read or written,
+# so the other import paths and the app don't load it.
+import json
+import math
+import numpy as np
+import pandas as pd
+from app.api.importer.reader import CHUNK_SIZE, STAGING_SUFFIX, decode_json_column
+
+# Schema metadata listing the columns stored as JSON text
+JSON_COLUMNS_KEY = b"json_columns"
+
+
+def _pyarrow():
+    import pyarrow  # only needed for the staging files
+    import pyarrow.ipc  # noqa: F401
+    return pyarrow
+
+
+def is_staging_file(path):
+    return str(path).endswith(STAGING_SUFFIX)
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _value_kind(value):
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return "list"
+    return "json"
+
+
+def _chunk_kinds(chunk):
+    """Kind of each column of a chunk: a pandas dtype kind, or the kind of the values of an object column."""
+    kinds = {}
+    for column in chunk.columns:
+        series = chunk[column]
+        if series.dtype != object:
+            # Columns with only missing values are read as floats
+            kinds[column] = {"null"} if series.isna().all() else {series.dtype.kind}
+        else:
+            kinds[column] = {_value_kind(value) for value in series.tolist() if not _is_null(value)} or {"null"}
+    return kinds
+
+
+def _column_type(kinds):
+    missing = "null" in kinds
+    kinds = kinds - {"null"}
+    if kinds <= {"i", "u", "f"} and ("f" in kinds or (kinds and missing)):
+        # Like read_csv, integers with missing values are floats
+        return "f"
+    if kinds == {"b"} and missing:
+        return "json"
+    if len(kinds) > 1 or kinds & {"json", "O"}:
+        return "json"
+    return kinds.pop() if kinds else "string"
+
+
+def _arrow_types(pa):
+    return {
+        "string": pa.string(), "json": pa.string(), "list": pa.list_(pa.string()),
+        "f": pa.float64(), "i": pa.int64(), "u": pa.uint64(), "b": pa.bool_(),
+    }
+
+
+def _to_arrow(pa, series, kind, arrow_type):
+    if kind == "f":
+        return pa.array(series.to_numpy(dtype=float), type=arrow_type, from_pandas=True)
+    if kind in ("i", "u", "b"):
+        return pa.array(series.to_numpy(), type=arrow_type)
+    values = series.tolist()
+    if kind == "json":
+        values = [None if _is_null(value) else json.dumps(value) for value in values]
+    else:
+        values = [None if _is_null(value) else value for value in values]
+    return pa.array(values, type=arrow_type)
+
+
+def write_staging(read_chunks, path):
+    """
+    Write the chunks of a source file to an Arrow staging file.
+
+    Args:
+        read_chunks (callable): Returns a fresh iterable of the DataFrame chunks (see
+            app.api.importer.reader), called twice: to find the type of every column, then to write them.
+        path: The staging file to write.
+
+    Returns:
+        The number of rows written.
+    """
+    pa = _pyarrow()
+    kinds = {}
+    for chunk in read_chunks():
+        for column, chunk_kinds in _chunk_kinds(chunk).items():
+            kinds.setdefault(column, set()).update(chunk_kinds)
+    column_types = {column: _column_type(column_kinds) for column, column_kinds in kinds.items()}
+    arrow_types = _arrow_types(pa)
+    json_columns = [column for column, kind in column_types.items() if kind == "json"]
+    schema = pa.schema(
+        [(column, arrow_types[kind]) for column, kind in column_types.items()],
+        metadata={JSON_COLUMNS_KEY: json.dumps(json_columns)},
+    )
+    rows = 0
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in read_chunks():
+            arrays = [
+                _to_arrow(pa, chunk[column], column_types[column], arrow_types[column_types[column]])
+                for column in schema.names
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+def _from_arrow(values, is_json):
+    if is_json:
+        values = decode_json_column(values)
+    # Lists come back as numpy arrays, and missing values as None instead of read_csv's NaN
+    return [np.nan if value is None else value.tolist() if isinstance(value, np.ndarray) else value for value in values]
+
+
+def read_staging(path, chunksize=CHUNK_SIZE):
+    """Yield the rows of a staging file as DataFrames of ``chunksize`` rows, with a continuous index."""
+    pa = _pyarrow()
+    with pa.memory_map(str(path), "r") as source:
+        reader = pa.ipc.open_file(source)
+        json_columns = set(json.loads((reader.schema.metadata or {}).get(JSON_COLUMNS_KEY, b"[]")))
+        offset = 0
+        for batch_index in range(reader.num_record_batches):
+            batch = reader.get_batch(batch_index)
+            for start in range(0, batch.num_rows, chunksize):
+                chunk = batch.slice(start, chunksize).to_pandas()
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                for column in chunk.columns:
+                    if chunk[column].dtype == object:
+                        chunk[column] = pd.Series(_from_arrow(chunk[column].tolist(), column in json_columns), index=chunk.index)
+                yield chunk
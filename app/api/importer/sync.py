@@ -0,0 +1,172 @@
+# Incremental sync behind ``flask api sync``.
+#
+# ``populate`` rebuilds the database from scratch. CatalogSync refreshes it in place: every
+# row of the books file is matched against the existing books with the rules of
+# check_if_book_exists, and the fields of the rows matching a book are merged like
+# merge_books does. A book is only written when the hash of those fields differs from the
+# ``source_hash`` stored by the previous import, with one batched upsert per table
+# (INSERT ... ON CONFLICT DO UPDATE on Postgres and SQLite). Rows matching no book are imported
+# through the row-by-row path, links included.
+#
+# Only the book fields are refreshed for existing books, their covers, authors and taxonomies
+# are left as they are. Fields missing from the export never clear a stored value.
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from app.models import Book, Product
+from app.api.books.search import reindex_books
+from app.api.books.suggestions import suggestion_index
+from app.api.importer.bulk import INSERT_BATCH_SIZE, prepare_book
+from app.api.importer.rows import content_hash
+
+
+class CatalogSync:
+    """
+    Match the rows of the books file against the books of ``session`` and upsert the changed ones.
+
+    Args:
+        session (Session): The session the new books are added to and the changes written with.
+        import_new_book (callable): Called with a row matching no existing book, imports it
+            through the ORM and returns the Book (see app.api.populate.import_book).
+    """
+
+    def __init__(self, session, import_new_book):
+        self.session = session
+        self.import_new_book = import_new_book
+        # book id -> merged fields of the rows matching it
+        self.books = {}
+        self.created = set()
+        self._hashes = {}
+        self._books_by_code_title = {}
+        self._books_by_isbn_10 = {}
+        self._books_by_isbn_13 = {}
+        book_table = Book.__table__
+        rows = session.execute(
+            sa.select(book_table.c.id, book_table.c.code_alejandria, book_table.c.title,
+                      book_table.c.isbn_10, book_table.c.isbn_13, book_table.c.source_hash)
+            .order_by(book_table.c.id)
+        )
+        for book_id, code, title, isbn_10, isbn_13, source_hash in rows:
+            self._hashes[book_id] = source_hash
+            self._index(book_id, {"code_alejandria": code, "title": title, "isbn_10": isbn_10, "isbn_13": isbn_13})
+
+    def _book_keys(self, book):
+        # Same keys as CatalogImport._book_keys
+        if book.get("code_alejandria") is not None and book.get("title") is not None:
+            yield self._books_by_code_title, (book["code_alejandria"], book["title"])
+        if book.get("isbn_10") is not None:
+            yield self._books_by_isbn_10, book["isbn_10"]
+        if book.get("isbn_13") is not None:
+            yield self._books_by_isbn_13, book["isbn_13"]
+
+    def _index(self, book_id, book):
+        for index, key in self._book_keys(book):
+            index.setdefault(key, book_id)
+
+    def add_books(self, books, progress=None):
+        """Match every row of ``books``, an iterable of DataFrame chunks (see app.api.importer.reader.read_books)."""
+        for chunk in books:
+            for row in chunk.to_dict("records"):
+                self.add_book(row)
+            if progress is not None:
+                progress.update(len(chunk))
+
+    def add_book(self, row):
+        data, _ = prepare_book(row)
+        matches = [index[key] for index, key in self._book_keys(data) if key in index]
+        book_id = min(matches) if matches else None
+        if book_id is None or book_id in self.created:
+            # New books, and the rows merged into them, take the whole row-by-row path
+            book_id = self.import_new_book(row).id
+            if book_id not in self._hashes:
+                self.created.add(book_id)
+        merged = self.books.setdefault(book_id, {})
+        for field, value in data.items():
+            if merged.get(field) is None and value is not None:
+                merged[field] = value
+        self._index(book_id, merged)
+        return book_id
+
+    def changed(self):
+        """Ids of the existing books whose fields differ from the ones of their last import."""
+        return [
+            book_id for book_id, data in self.books.items()
+            if book_id not in self.created and content_hash(data) != self._hashes.get(book_id)
+        ]
+
+    def write(self, batch_size=INSERT_BATCH_SIZE):
+        """Upsert the changed books and store the hash of every matched book, returning the changed ids."""
+        changed = self.changed()
+        product_columns = set(Product.__table__.c.keys()) - {"id"}
+        book_columns = set(Book.__table__.c.keys()) - {"id"}
+        product_rows, book_rows = [], []
+        for book_id in changed:
+            data = {field: value for field, value in self.books[book_id].items() if value is not None}
+            product_rows.append({"id": book_id, "type": "book", **{k: v for k, v in data.items() if k in product_columns}})
+            book_rows.append({
+                "id": book_id, **{k: v for k, v in data.items() if k in book_columns},
+                "source_hash": content_hash(self.books[book_id]),
+            })
+        self.session.flush()
+        connection = self.session.connection()
+        product_table = Product.__table__
+        # Like the ORM updates, bump the version the ETags are built from
+        upsert_rows(connection, product_table, product_rows, {"version": product_table.c.version + 1}, batch_size)
+        upsert_rows(connection, Book.__table__, book_rows, batch_size=batch_size)
+        reindex_books(connection, changed)
+        # The ORM copies of the upserted books are stale
+        self.session.expire_all()
+        for book_id in self.created:
+            self.session.get(Book, book_id).source_hash = content_hash(self.books[book_id])
+        self.session.flush()
+        return changed
+
+    def summary(self):
+        return {"matched": len(self.books) - len(self.created), "changed": len(self.changed()), "created": len(self.created)}
+
+
+def publish_changes(book_ids):
+    """
+    Expire what depends on books changed outside the ORM, once committed.
+
+    The session hooks of app.caching and app.api.books.suggestions don't see Core statements.
+    """
+    if not book_ids:
+        return
+    if has_app_context() and "response_cache" in current_app.extensions:
+        current_app.extensions["response_cache"].invalidate(*(f"book:{book_id}" for book_id in book_ids))
+    suggestion_index.mark_stale(set(book_ids), set())
+
+
+def upsert_rows(connection, table, rows, update=None, batch_size=INSERT_BATCH_SIZE):
+    """
+    Update the rows of ``table`` having the ids of ``rows`` with their other values.
+
+    Rows are sent with one executemany per batch of rows having the same keys, as an
+    INSERT ... ON CONFLICT DO UPDATE where the dialect supports it. ``update`` holds extra
+    column expressions for the SET clause.
+    """
+    if connection.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif connection.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        insert = None
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row), []).append(row)
+    for keys, group in groups.items():
+        columns = [key for key in keys if key != "id"]
+        if insert is not None:
+            statement = insert(table)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={**{column: statement.excluded[column] for column in columns}, **(update or {})},
+            )
+            parameters = group
+        else:
+            statement = table.update().where(table.c.id == sa.bindparam("row_id")).values(
+                **{column: sa.bindparam(f"row_{column}") for column in columns}, **(update or {})
+            )
+            parameters = [{f"row_{key}": value for key, value in row.items()} for row in group]
+        for start in range(0, len(parameters), batch_size):
+            connection.execute(statement, parameters[start:start + batch_size])
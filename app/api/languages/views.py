@@ -1,5 +1,5 @@
 from flask import current_app, render_template, request, jsonify, Request
-from app import db
+from app import db, cache
 from app.models import Language
 from app.api.languages import languages
 
@@ -22,6 +22,7 @@ def create_language():
 
 
 @languages.route('', methods=['GET'])
+@cache.cached("language:*")
 def get_languages():
     """Retrieve a list of languages with filtering, pagination, and sorting"""
     languages = db.session.execute(db.select(Language)).scalars()
@@ -37,6 +38,7 @@ def get_languages():
 
 
 @languages.route('/<int:language_id>', methods=['GET'])
+@cache.cached("language:{language_id}")
 def get_language(language_id):
     """Retrieve a single language by its ID"""
     language = db.session.execute(
@@ -0,0 +1,38 @@
+import sqlalchemy.orm as so
+from app.models import Book, Author, Review
+
+
+# Loader options needed by each BookSchema field that touches a relationship.
+# Collections use selectinload so a page of any size costs one extra query per
+# relationship instead of one query per book.
+BOOK_FIELD_LOADERS = {
+    "authors": lambda: so.selectinload(Book.authors).selectinload(Author.photos),
+    "series": lambda: so.selectinload(Book.series),
+    "genres": lambda: so.selectinload(Book.genres),
+    "publishers": lambda: so.selectinload(Book.publishers),
+    "languages": lambda: so.selectinload(Book.languages),
+    "providers": lambda: so.selectinload(Book.providers),
+    "reviews": lambda: so.selectinload(Book.reviews).joinedload(Review.user),
+    "cover_url": lambda: so.selectinload(Book.covers),
+}
+
+
+def book_loader_options(only=None, exclude=(), relationship=None):
+    """
+    Build the loader options needed to dump books with ``BookSchema(only=only, exclude=exclude)``.
+
+    Args:
+        only (iterable): The fields that will be dumped. ``None`` means every field.
+        exclude (iterable): Fields that will not be dumped.
+        relationship: Optional loader option pointing at the books (e.g. ``so.selectinload(CartItem.book)``)
+            to chain the book options from, for queries whose root entity is not ``Book``.
+
+    Returns:
+        list: Loader options to pass to ``Select.options``.
+    """
+    fields = set(BOOK_FIELD_LOADERS) if only is None else set(only)
+    fields -= set(exclude)
+    options = [BOOK_FIELD_LOADERS[field]() for field in sorted(fields & set(BOOK_FIELD_LOADERS))]
+    if relationship is not None:
+        return [relationship.options(*options)]
+    return options
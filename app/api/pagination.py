@@ -0,0 +1,107 @@
+from datetime import date, datetime
+from decimal import Decimal
+import sqlalchemy as sa
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from app import db
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _serializer(salt):
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt=f"cursor:{salt}")
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"date": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"decimal": str(value)}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict):
+        if "datetime" in value:
+            return datetime.fromisoformat(value["datetime"])
+        if "date" in value:
+            return date.fromisoformat(value["date"])
+        if "decimal" in value:
+            return Decimal(value["decimal"])
+    return value
+
+
+def encode_cursor(values, salt):
+    """Sign the sort key of the last item of a page into an opaque cursor."""
+    return _serializer(salt).dumps([_dump_value(value) for value in values])
+
+
+def decode_cursor(token, salt):
+    """Return the sort key stored in ``token``, raising InvalidCursor if it was tampered with."""
+    try:
+        values = _serializer(salt).loads(token)
+    except BadSignature:
+        raise InvalidCursor(token)
+    if not isinstance(values, list):
+        raise InvalidCursor(token)
+    return [_load_value(value) for value in values]
+
+
+def _after(order_by, values):
+    """Build the predicate selecting the rows that sort after ``values``."""
+    clauses = []
+    for position, (expression, descending) in enumerate(order_by):
+        ties = [previous == value for (previous, _), value in zip(order_by[:position], values)]
+        comparison = expression < values[position] if descending else expression > values[position]
+        clauses.append(sa.and_(*ties, comparison))
+    return sa.or_(*clauses)
+
+
+def order_clauses(order_by):
+    """Turn (expression, descending) pairs into ORDER BY clauses."""
+    return [expression.desc() if descending else expression.asc() for expression, descending in order_by]
+
+
+def keyset_paginate(query, order_by, cursor=None, per_page=10, max_per_page=100, salt="keyset"):
+    """
+    Paginate ``query`` by seeking past the sort key of the previous page instead of using OFFSET.
+
+    No COUNT(*) is issued, so every page costs the same no matter how deep it is.
+
+    Args:
+        query: A select() of a single entity, or of columns.
+        order_by (list): (expression, descending) pairs. The last expression must be unique
+            (usually the primary key) and none of them may be NULL.
+        cursor (str): The ``next`` cursor of the previous page, or None for the first page.
+        per_page (int): Items per page.
+        max_per_page (int): Upper bound for ``per_page``.
+        salt (str): Namespace of the cursor signature, so cursors can't be reused across endpoints.
+
+    Returns:
+        tuple: The items of the page (rows when ``query`` selects columns) and the cursor of the
+            next page (None on the last page).
+    """
+    width = len(query.column_descriptions)
+    per_page = max(1, min(per_page, max_per_page))
+    if len(order_by) < 1:
+        raise ValueError("keyset pagination needs at least one sort expression")
+    if cursor:
+        values = decode_cursor(cursor, salt)
+        if len(values) != len(order_by):
+            raise InvalidCursor(cursor)
+        query = query.where(_after(order_by, values))
+    query = query.add_columns(*[expression for expression, _ in order_by]).order_by(
+        *order_clauses(order_by)
+    ).limit(per_page + 1)
+    rows = db.session.execute(query).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(list(rows[-1][width:]), salt)
+    if width > 1:
+        return [row[:width] for row in rows], next_cursor
+    return [row[0] for row in rows], next_cursor
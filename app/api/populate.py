@@ -1,6 +1,7 @@
 # Script for populating the database with the data from the csv
 import numpy as np
 import os
+from contextlib import nullcontext
 from pprint import pprint
 from datetime import datetime
 from time import sleep
@@ -10,6 +11,7 @@ from pprint import pprint
 from sqlalchemy import select, and_, or_
 from sqlalchemy.inspection import inspect
 import click
+from marshmallow import ValidationError
 import pandas as pd
 from flask.cli import with_appcontext
 from flask import current_app
@@ -17,38 +19,25 @@ from app import db
 from app.models import Book, Author, Genre, Series, Publisher, Language, Provider, Cover, AuthorPhoto, FeaturedBook
 from app.schemas import BookSchema, AuthorSchema, GenreSchema, SeriesSchema, PublisherSchema, LanguageSchema, ProviderSchema, CoverSchema, AuthorPhotoSchema
 from app.api import api
+from app.api.importer.rows import (
+    process_date, get_field_value, find_authors_by_id, find_authors_by_name,
+    book_data_from_row, author_data_from_row, content_hash,
+)
+from app.api.importer.authors import AuthorIndex
+from app.api.importer.bulk import CatalogImport
+from app.api.importer.sync import CatalogSync, publish_changes
+from app.api.importer.checkpoint import Checkpoint, RejectLog, source_digest
+from app.api.importer.profiler import PROFILER_KEY, ImportProfiler, stage
+from app.api.importer.providers import ProviderLinks
+from app.api.books.related import deferred_related
+from app.api.importer.reader import (
+    CHUNK_SIZE, AUTHORS_DTYPES, PROVIDERS_DTYPES, Progress, read_books, read_chunks, read_table,
+)
+from app.api.importer.staging import STAGING_SUFFIX, write_staging
 from typing import List
 import json
 
 
-def deserialize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    def _loads(value):
-        try:
-            return json.loads(value)
-        except json.JSONDecodeError:
-            return value
-        except TypeError:
-            return value
-    result_df = df.copy()
-    for column_name in df.columns:
-        if df[column_name].dtype == 'float64' or 'date' in column_name:
-            continue
-        result_df[column_name] = result_df[column_name].apply(_loads)
-    return result_df
-
-
-def process_date(date_str):
-    try:
-        return parse(date_str, fuzzy=True, default=datetime.strptime("2024-01-01", "%Y-%m-%d")).strftime("%Y-%m-%d")
-    except Exception as e:
-        print(f"Error parsing date: {str(e)}")
-        return None
-
-
-def get_field_value(row, field_name, default=None):
-    return row[field_name] if not pd.isna(row[field_name]) else default
-
-
 def process_author_pictures(session, author, author_row):
     for picture in author_row['photos']:
         picture_data = {
@@ -67,31 +56,7 @@ def process_author_pictures(session, author, author_row):
 
 
 def process_author(session, author_row):
-    summary = author_row['summary_cdl'] if not pd.isna(author_row['summary_cdl']) else get_field_value(author_row, 'bio_ol')
-    name = author_row['name_cdl'] if not pd.isna(author_row['name_cdl']) else get_field_value(author_row, 'name_ol', author_row['name_alejandria'])
-    try:
-        death_date = process_date(author_row['death_date_ol']) if not pd.isna(author_row['death_date_ol']) else None
-    except Exception as e:
-        print(f"Error parsing death date: {str(e)}")
-        death_date = None
-    try:
-        birth_date = process_date(author_row['birth_date_ol']) if not pd.isna(author_row['birth_date_ol']) else None
-    except Exception as e:
-        print(f"Error parsing birth date: {str(e)}")
-        birth_date = None
-
-    author_data = {
-        'name': name if not pd.isna(name) else None,
-        'birth_date': birth_date,
-        'birth_date_str': get_field_value(author_row, 'birth_date_ol'),
-        'death_date': death_date,
-        'death_date_str': get_field_value(author_row, 'death_date_ol'),
-        'biography': summary,
-        'other_names': author_row['other_names_ol'],
-        'open_library_id': get_field_value(author_row, 'key_ol'),
-        'casa_del_libro_id': get_field_value(author_row, 'id_cdl')
-    }
-
+    author_data = author_data_from_row(author_row)
     new_author_data = AuthorSchema().load(author_data)
 
     # Check if author already exists
@@ -107,7 +72,8 @@ def process_author(session, author_row):
         new_author = Author(**new_author_data)
         session.add(new_author)
         session.flush()
-        process_author_pictures(session, new_author, author_row)
+        with stage(session, "photos"):
+            process_author_pictures(session, new_author, author_row)
     return new_author
 
 
@@ -141,39 +107,16 @@ def add_authors_by_indices(session, authors_df, indices, book):
             print(f"Error adding author by index: {str(e)}")
 
 
-def find_authors_by_id(authors_df, ids, column_name):
-    """Helper function to find authors by ID in a specific column."""
-    authors_indices = set()
-    for author_id in ids:
-        try:
-            author_row = authors_df[authors_df[column_name] == author_id]
-            if not author_row.empty:
-                authors_indices.add(author_row.index.values[0])
-        except Exception as e:
-            raise (e)
-            print(f"Error finding author by id: {str(e)}")
-    return authors_indices
-
-
-def find_authors_by_name(authors_df, names, column_name):
-    """Helper function to find authors by name in a specific column."""
-    authors_indices = set()
-    for name in names:
-        try:
-            author_rows = authors_df[authors_df[column_name].str.contains(name, case=False, na=False)]
-            if not author_rows.empty:
-                authors_indices.add(author_rows.index.values[0])
-        except Exception as e:
-            print(f"Error finding author by name: {str(e)}")
-    return authors_indices
-
-
-def process_authors(session, book: Book, book_row, authors_df):
+def process_authors(session, book: Book, book_row, authors_df, author_index=None):
     authors = set()
 
     def process_and_update(find_func, key, column):
         if len(authors) < 1:
-            found_authors = find_func(authors_df, book_row[key], column)
+            if author_index is not None:
+                # Same lookups, answered from the prebuilt indexes (see app.api.importer.authors)
+                found_authors = getattr(author_index, find_func.__name__)(book_row[key], column)
+            else:
+                found_authors = find_func(authors_df, book_row[key], column)
             add_authors_by_indices(session, authors_df, found_authors, book)
             authors.update(found_authors)
 
@@ -221,36 +164,13 @@ def merge_books(book1, book2):
     return book1
 
 
+# session.info key of the merged source fields of the books imported by the session, by book id
+SOURCE_FIELDS_KEY = "book_source_fields"
+
+
 def process_book(book_row, session):
     logger = current_app.logger
-    book_data = {
-        'title': get_field_value(book_row, 'title'),
-        'isbn_10': get_field_value(book_row, 'isbn_10'),
-        'isbn_13': get_field_value(book_row, 'isbn_13'),
-        'publish_date': get_field_value(book_row, 'publish_date'),
-        'description': get_field_value(book_row, 'description'),
-        'current_price': get_field_value(book_row, 'precio', 0),
-        'price_alejandria': get_field_value(book_row, 'precio'),
-        'iva': get_field_value(book_row, 'iva'),
-        'cost': get_field_value(book_row, 'ultimo_costo'),
-        'cost_supplier': get_field_value(book_row, 'costo_proveedor'),
-        'average_cost_alejandria': get_field_value(book_row, 'costo_promedio'),
-        'last_cost_alejandria': get_field_value(book_row, 'ultimo_costo'),
-        'stock': get_field_value(book_row, 'stock_propio'),
-        'stock_alejandria': get_field_value(book_row, 'stock_propio'),
-        'stock_consig': get_field_value(book_row, 'stock_consig'),
-        'stock_consig_alejandria': get_field_value(book_row, 'stock_consig'),
-        'physical_format': get_field_value(book_row, 'physical_format'),
-        'number_of_pages': get_field_value(book_row, 'number_of_pages'),
-        'bar_code_alejandria': get_field_value(book_row, 'barra_cod'),
-        'isbn_alejandria': get_field_value(book_row, 'isbn'),
-        'code_alejandria': get_field_value(book_row, 'cod_art'),
-        'physical_dimensions': get_field_value(book_row, 'physical_dimensions'),
-        'weight': get_field_value(book_row, 'weight'),
-        'publish_places': book_row['publish_places'],
-        'edition_name': get_field_value(book_row, 'edition_name'),
-        'subtitle': get_field_value(book_row, 'subtitle')
-    }
+    book_data = book_data_from_row(book_row)
     print(book_data['publish_date'], type(book_data['publish_date']))
     new_book_data = BookSchema().load(book_data)
     new_book = Book(**new_book_data)
@@ -263,10 +183,19 @@ def process_book(book_row, session):
         logger.info("\tExisting book: %s", existing_book)
         new_book = merge_books(existing_book, new_book)
         logger.info("\tMerged book: %s", new_book)
+    # Hash the fields of the rows merged into the book like the bulk import does, for the next sync
+    source_fields = session.info.setdefault(SOURCE_FIELDS_KEY, {})
+    fields = source_fields.get(new_book.id, {}) if existing_book else {}
+    for field, value in new_book_data.items():
+        if fields.get(field) is None and value is not None:
+            fields[field] = value
+    new_book.source_hash = content_hash(fields)
     session.add(new_book)
     session.flush()
+    source_fields[new_book.id] = fields
     logger.info("Book %s added", new_book)
-    process_book_covers(session, new_book, book_row)
+    with stage(session, "covers"):
+        process_book_covers(session, new_book, book_row)
     if new_book.cover_url is not None and new_book.description is not None:
         if session.query(FeaturedBook).filter(FeaturedBook.book_id == new_book.id).count() < 1:
             featured_book = FeaturedBook(book_id=new_book.id)
@@ -276,45 +205,9 @@ def process_book(book_row, session):
     return new_book
 
 
-def process_provider(session, provider_row):
-    provider_data = {
-        'alejandria_code': provider_row['cod_pro'],
-        'cedula': provider_row['cedula_proveedor'],
-        'name': get_field_value(provider_row, 'nombre_proveedor'),
-        'address': get_field_value(provider_row, 'direccion_proveedor'),
-        'phone': get_field_value(provider_row, 'telefono_proveedor'),
-        'email': get_field_value(provider_row, 'correo_proveedor'),
-        'contact_name': get_field_value(provider_row, 'nombre_contacto_proveedor'),
-        'nombre_banco': get_field_value(provider_row, 'nombre_banco_proveedor'),
-        'titular_banco': get_field_value(provider_row, 'titular_banco_proveedor'),
-        'rif_banco': get_field_value(provider_row, 'rif_banco_proveedor'),
-        'cod_cuenta': get_field_value(provider_row, 'cuenta_banco_proveedor'),
-        'notes': get_field_value(provider_row, 'notas')
-    }
-    provider_data = ProviderSchema().load(provider_data)
-    provider = session.execute(select(Provider).where(Provider.alejandria_code == provider_data['alejandria_code'])).scalar()
-    if not provider:
-        provider = Provider(**provider_data)
-        session.add(provider)
-        session.flush()
-    return provider
-
-
-def process_providers(session, book, book_row, providers_df):
-    provider_id = book_row['cod_pro']
-    if pd.isna(provider_id) or provider_id is None:
-        return
-    try:
-        provider_rows = providers_df[providers_df['cod_pro'] == provider_id]
-        if provider_rows.empty:
-            raise Exception(provider_id)
-        provider_row = provider_rows.iloc[0]
-        provider = process_provider(session, provider_row)
-        if provider and provider not in book.providers:
-            book.providers.append(provider)
-        current_app.logger.info("\tProviders: %s", book.providers)
-    except Exception as e:
-        print(f"Error finding provider with id: {str(e)}")
+def process_providers(session, book, book_row, providers):
+    """Link the book to its provider, resolved by ``providers`` (a ProviderLinks) and written at its next flush."""
+    providers.link(book, book_row['cod_pro'])
 
 
 def process_genre(session, book, book_row):
@@ -416,17 +309,125 @@ def check_if_book_exists(session, new_book):
     return existing_book
 
 
+def read_lookups(authors_path, providers_path):
+    """Read the authors and providers files, which every book may refer to."""
+    authors_df = read_table(authors_path, dtype=AUTHORS_DTYPES)
+    provider_df = read_table(providers_path, dtype=PROVIDERS_DTYPES, decode=False)
+    return authors_df, provider_df
+
+
+def import_book(session, row, authors_df, providers, author_index=None):
+    """
+    Import one row of the books file through the ORM, merging it into the book it matches.
+
+    ``providers`` is the ProviderLinks of the import, which writes the provider links.
+    """
+    with stage(session, "process_book"):
+        new_book = process_book(row, session)
+    with stage(session, "process_genre"):
+        process_genre(session, new_book, row)
+    with stage(session, "process_publishers"):
+        process_publishers(session, new_book, row)
+    with stage(session, "process_languages"):
+        process_languages(session, new_book, row)
+    with stage(session, "process_series"):
+        process_series(session, new_book, row)
+    with stage(session, "process_providers"):
+        process_providers(session, new_book, row, providers)
+    with stage(session, "process_authors"):
+        process_authors(session, new_book, row, authors_df, author_index)
+    return new_book
+
+
+def import_books(session, books, authors_df, provider_df, batch_size=50, limit=100, progress=None, checkpoint=None, rejects=None,
+                 dry_run=False):
+    """
+    Import the books one row at a time through the ORM, committing every ``batch_size`` books.
+
+    ``books`` is the books DataFrame or an iterable of its chunks (see app.api.importer.reader.read_books).
+    With a ``checkpoint`` (see app.api.importer.checkpoint), the rows before ``checkpoint.row`` are
+    skipped and each commit saves the next row. With ``rejects``, a row failing validation is
+    rolled back to a savepoint and logged there instead of aborting the import. With ``dry_run``,
+    nothing is committed and the caller rolls the import back.
+    """
+    logger = current_app.logger
+    author_index = AuthorIndex(authors_df)
+    chunks = [books] if isinstance(books, pd.DataFrame) else books
+    start = done = checkpoint.row if checkpoint is not None else 0
+    committing = commit and not dry_run
+    profiler = session.info.get(PROFILER_KEY)
+
+    def commit_batch():
+        with stage(session, "commit"):
+            providers.flush()
+            session.flush()  # Push changes to the database without committing
+            session.commit()  # Commit the batch
+        if checkpoint is not None:
+            checkpoint.save(done)
+        if rejects is not None:
+            rejects.flush()
+
+    try:
+        # The related books of the imported books are refreshed once, after the last row
+        with deferred_related(session):
+            with stage(session, "providers"):
+                providers = ProviderLinks(session, provider_df)
+            for index, row in (item for chunk in chunks for item in chunk.iterrows()):
+                if index < start:
+                    continue
+                logger.info("Processing book %d", index)
+                with profiler.book() if profiler is not None else nullcontext():
+                    if rejects is None:
+                        import_book(session, row, authors_df, providers, author_index)
+                    else:
+                        links = len(providers.pending)
+                        try:
+                            with session.begin_nested():
+                                import_book(session, row, authors_df, providers, author_index)
+                        except ValidationError as e:
+                            logger.warning("Rejected book %d: %s", index, e.messages)
+                            rejects.add(index, e.messages, row.to_dict())
+                            del providers.pending[links:]
+                done = index + 1
+                if committing:
+                    if (index + 1) % batch_size == 0:
+                        commit_batch()
+                if progress is not None:
+                    progress.update(1)
+                if limit and index + 1 >= limit:
+                    break
+            providers.flush()
+        if committing:
+            commit_batch()  # Final commit for remaining books
+    except Exception as e:
+        print(f"Error processing books: {str(e)}")
+        if committing:
+            session.rollback()
+        if rejects is not None:
+            rejects.discard()
+        raise e
+    finally:
+        session.info.pop(SOURCE_FIELDS_KEY, None)
+
+
 @api.cli.command(name='populate')
 @click.option('--source_path', help='Path to the data files')
-@click.option('--books_file', help='CSV file to read book data from', default='books.csv')
-@click.option('--authors_file', help='CSV file to read author data from', default='authors.csv')
-@click.option('--providers_file', help='CSV file to read providers data from', default='providers.csv')
+@click.option('--books_file', help='CSV (or .arrow staging) file to read book data from', default='books.csv')
+@click.option('--authors_file', help='CSV (or .arrow staging) file to read author data from', default='authors.csv')
+@click.option('--providers_file', help='CSV (or .arrow staging) file to read providers data from', default='providers.csv')
 @click.option('--batch_size', help='Size of the batch to commit to the database', default=50)
 @click.option('--limit', help='limit of books to add to the database', default=100)
+@click.option('--bulk', is_flag=True, default=False, help='Resolve the whole file in memory and write it with bulk inserts')
+@click.option('--workers', default=1, help='Processes normalizing and validating the rows (implies --bulk)')
+@click.option('--chunk_size', default=CHUNK_SIZE, help='Rows of the books file read at a time')
+@click.option('--resume', is_flag=True, default=False, help='Continue the interrupted import of the same files instead of starting over')
+@click.option('--checkpoint_file', default=None, help='File recording the last committed row, to --resume from')
+@click.option('--rejects_file', default=None, help='File the rows failing validation are written to, instead of aborting')
+@click.option('--profile', is_flag=True, default=False, help='Time the stages of the row-by-row import and print a summary')
+@click.option('--dry_run', is_flag=True, default=False, help='Import into the existing tables in a transaction that is rolled back')
 @with_appcontext
-def populate(source_path, books_file, authors_file, providers_file, batch_size, limit):
-    db.drop_all()
-    db.create_all()
+def populate(source_path, books_file, authors_file, providers_file, batch_size, limit, bulk, workers, chunk_size,
+             resume, checkpoint_file, rejects_file, profile, dry_run):
     books_path = os.path.join(source_path, books_file)
     authors_path = os.path.join(source_path, authors_file)
     providers_path = os.path.join(source_path, providers_file)
@@ -437,40 +438,113 @@ def populate(source_path, books_file, authors_file, providers_file, batch_size,
     logger.info("Authors path: %s", authors_path)
     logger.info("Providers path: %s", providers_path)
 
-    books_df = pd.read_csv(books_path, dtype={'isbn_13': str, 'isbn_10': str, 'ean': str, 'weight': str}, sep='\t')
-    books_df = deserialize_columns(books_df)
-    books_df['weight'] = books_df['weight'].astype('str')
-    print(books_df['publish_date'])
+    bulk = bulk or workers > 1
+    if bulk and (profile or dry_run):
+        raise click.UsageError("--profile and --dry_run apply to the row-by-row import, not to --bulk")
+    if resume and checkpoint_file is None:
+        raise click.UsageError("--resume needs the --checkpoint_file of the interrupted import")
+    # Hashing the source files and a savepoint per row are only paid for when asked for
+    checkpoint = rejects = None
+    if checkpoint_file is not None and not bulk and not dry_run:
+        checkpoint = Checkpoint(checkpoint_file, source_digest(books_path, authors_path, providers_path))
+    if rejects_file is not None and not bulk:
+        rejects = RejectLog(rejects_file)
+    # The bulk import writes everything in one transaction, there is nothing to resume
+    if dry_run:
+        # Leave the tables, the checkpoint and the rejects of real runs alone
+        logger.info("Dry run, the import will be rolled back")
+    elif resume and checkpoint is not None and checkpoint.load():
+        logger.info("Resuming from row %d", checkpoint.row)
+    else:
+        db.drop_all()
+        db.create_all()
+        if checkpoint is not None:
+            checkpoint.clear()
+        if rejects is not None:
+            rejects.clear()
+
+    # The books file is streamed, only the authors and providers are kept whole for the lookups
+    authors_df, provider_df = read_lookups(authors_path, providers_path)
+    books = read_books(books_path, chunksize=chunk_size)
+    progress = Progress(logger, label="books")
+
+    if bulk:
+        catalog = CatalogImport(authors_df, provider_df)
+        catalog.add_books(books, limit=limit, workers=workers, progress=progress)
+        progress.done()
+        with db.engine.begin() as connection:
+            catalog.write(connection)
+        logger.info("Imported %s", catalog.summary())
+        return
 
-    authors_df = pd.read_csv(authors_path, dtype={'id_cdl': str}, sep='\t')
-    authors_df = deserialize_columns(authors_df)
+    session = db.session
+    profiler = ImportProfiler()
+    try:
+        with profiler.attach(session) if profile else nullcontext():
+            import_books(session, books, authors_df, provider_df, batch_size=batch_size, limit=limit, progress=progress,
+                         checkpoint=checkpoint, rejects=rejects, dry_run=dry_run)
+        progress.done()
+    finally:
+        if dry_run:
+            session.rollback()
+            if rejects is not None:
+                rejects.discard()
+        session.close()
+    if profile:
+        click.echo(profiler.report())
+    if rejects is not None and rejects.count:
+        logger.warning("%d books rejected, see %s", rejects.count, rejects_file)
 
-    provider_df = pd.read_csv(providers_path, sep='\t', dtype={'cod_pro': str})
 
+@api.cli.command(name='sync')
+@click.option('--source_path', help='Path to the data files')
+@click.option('--books_file', help='CSV file to read book data from', default='books.csv')
+@click.option('--authors_file', help='CSV file to read author data from', default='authors.csv')
+@click.option('--providers_file', help='CSV file to read providers data from', default='providers.csv')
+@click.option('--chunk_size', default=CHUNK_SIZE, help='Rows of the books file read at a time')
+@with_appcontext
+def sync(source_path, books_file, authors_file, providers_file, chunk_size):
+    """Refresh the catalog from the CSV files in place, only writing the books that changed."""
+    logger = current_app.logger
+    authors_df, provider_df = read_lookups(os.path.join(source_path, authors_file), os.path.join(source_path, providers_file))
+    author_index = AuthorIndex(authors_df)
+    progress = Progress(logger, label="books")
     session = db.session
-
     try:
-        for index, row in books_df.iterrows():
-            logger.info("Processing book %d", index)
-            new_book = process_book(row, session)
-            process_genre(session, new_book, row)
-            process_publishers(session, new_book, row)
-            process_languages(session, new_book, row)
-            process_series(session, new_book, row)
-            process_providers(session, new_book, row, provider_df)
-            process_authors(session, new_book, row, authors_df)
-            if commit:
-                if (index + 1) % batch_size == 0:
-                    session.flush()  # Push changes to the database without committing
-                    session.commit()  # Commit the batch
-            if limit and index + 1 >= limit:
-                break
-        if commit:
-            session.commit()  # Final commit for remaining books
-    except Exception as e:
-        print(f"Error processing books: {str(e)}")
-        if commit:
-            session.rollback()
-        raise e
+        providers = ProviderLinks(session, provider_df)
+        catalog = CatalogSync(session, lambda row: import_book(session, row, authors_df, providers, author_index))
+        catalog.add_books(read_books(os.path.join(source_path, books_file), chunksize=chunk_size), progress=progress)
+        providers.flush()
+        changed = catalog.write()
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
     finally:
         session.close()
+    publish_changes(changed)
+    progress.done()
+    logger.info("Synced %s", catalog.summary())
+
+
+@api.cli.command(name='stage')
+@click.option('--source_path', help='Path to the data files')
+@click.option('--dest_path', help='Directory to write the Arrow staging files to')
+@click.option('--books_file', help='CSV file to read book data from', default='books.csv')
+@click.option('--authors_file', help='CSV file to read author data from', default='authors.csv')
+@click.option('--providers_file', help='CSV file to read providers data from', default='providers.csv')
+@click.option('--chunk_size', default=CHUNK_SIZE, help='Rows read and written at a time')
+@with_appcontext
+def stage_sources(source_path, dest_path, books_file, authors_file, providers_file, chunk_size):
+    """Convert the CSV files to Arrow staging files, to pass to populate and sync instead."""
+    os.makedirs(dest_path, exist_ok=True)
+    sources = {
+        books_file: lambda path: read_books(path, chunksize=chunk_size),
+        authors_file: lambda path: read_chunks(path, dtype=AUTHORS_DTYPES, chunksize=chunk_size),
+        providers_file: lambda path: read_chunks(path, dtype=PROVIDERS_DTYPES, chunksize=chunk_size, decode=False),
+    }
+    for file_name, read in sources.items():
+        source = os.path.join(source_path, file_name)
+        staged = os.path.join(dest_path, os.path.splitext(file_name)[0] + STAGING_SUFFIX)
+        rows = write_staging(lambda: read(source), staged)
+        current_app.logger.info("Staged %d rows of %s in %s", rows, source, staged)
@@ -1,5 +1,5 @@
 from flask import request, jsonify
-from app import db
+from app import db, cache
 from app.models import Publisher
 from app.api.publishers import publishers
 
@@ -18,6 +18,7 @@ def create_publisher():
 
 
 @publishers.route('', methods=['GET'])
+@cache.cached("publisher:*")
 def get_publishers():
     """Retrieve a list of publishers with filtering, pagination, and sorting"""
     publishers = db.session.execute(db.select(Publisher)).scalars()
@@ -28,6 +29,7 @@ def get_publishers():
 
 
 @publishers.route('/<int:publisher_id>', methods=['GET'])
+@cache.cached("publisher:{publisher_id}")
 def get_publisher(publisher_id):
     """Retrieve a single publisher by its ID"""
     publisher = db.session.execute(db.select(Publisher).filter_by(id=publisher_id)).scalar()
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 reviews = Blueprint("reviews", __name__, url_prefix="/reviews")
 
-from app.api.reviews import views
+from app.api.reviews import views, ratings, cli
@@ -0,0 +1,19 @@
+# cli utilities for dealing with reviews
+from flask.cli import with_appcontext
+import click
+from app import db, cache
+from app.api import api
+from app.api.reviews.ratings import reconcile_ratings
+
+
+@api.cli.command(name='reconcile-ratings')
+@click.option('-b', '--book-id', 'book_ids', type=int, multiple=True, help='Only reconcile these books (repeatable)')
+@with_appcontext
+def reconcile_ratings_command(book_ids):
+    """Recompute the stored review aggregates of the books from their reviews."""
+    fixed = reconcile_ratings(db.session.connection(), book_ids or None)
+    db.session.commit()
+    if fixed:
+        # The aggregates were rewritten without the session, so its commit hook didn't see them
+        cache.invalidate(*[f"book:{book_id}" for book_id in book_ids] or ["book:*"])
+    click.echo(f'Fixed the ratings of {fixed} books')
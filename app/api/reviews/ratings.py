@@ -0,0 +1,170 @@
+# Denormalized review aggregates of the books.
+#
+# Every book stores the number of reviews, the sum of their ratings, the average and a 1-5 star
+# histogram, so rating summaries, sorting and filtering never have to scan the review table.
+# The columns are updated incrementally from the session whenever reviews are added, changed
+# or deleted, with relative UPDATEs so concurrent reviews of the same book don't overwrite
+# each other. ``flask api reconcile-ratings`` recomputes them from scratch.
+from itertools import chain
+from math import isclose
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from app.models import Book, Product, Review
+
+RATINGS = range(1, 6)
+RATING_COLUMNS = ["rating_avg", "rating_count", "rating_total"] + [f"rating_{stars}_count" for stars in RATINGS]
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+def parse_rating(value):
+    """Return ``value`` as a 1-5 star rating, or None if it isn't one (4.5 or "4.9" are not ratings)."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        stars = value
+    elif isinstance(value, str) and value.strip().isdigit():
+        stars = int(value)
+    else:
+        return None
+    return stars if stars in RATINGS else None
+
+
+def _previous(review, key):
+    """The value ``key`` had in the database before the pending changes of ``review``."""
+    history = so.attributes.get_history(review, key)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(review, key)
+
+
+def _review_deltas(session):
+    """Net change of each book's aggregates caused by the reviews being flushed."""
+    deltas = {}
+
+    def apply(book_id, rating, sign):
+        stars = parse_rating(rating)
+        if book_id is None or stars is None:
+            return
+        delta = deltas.setdefault(book_id, {"count": 0, "total": 0, **{f"stars_{s}": 0 for s in RATINGS}})
+        delta["count"] += sign
+        delta["total"] += sign * stars
+        delta[f"stars_{stars}"] += sign
+
+    for review in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(review, Review):
+            continue
+        if review in session.new:
+            apply(review.book_id, review.rating, 1)
+        elif review in session.deleted:
+            apply(_previous(review, "book_id"), _previous(review, "rating"), -1)
+        elif session.is_modified(review):
+            apply(_previous(review, "book_id"), _previous(review, "rating"), -1)
+            apply(review.book_id, review.rating, 1)
+    return {book_id: delta for book_id, delta in deltas.items() if any(delta.values())}
+
+
+def _apply_deltas(connection, deltas):
+    book = Book.__table__
+    count = book.c.rating_count + sa.bindparam("count")
+    total = book.c.rating_total + sa.bindparam("total")
+    connection.execute(
+        book.update()
+        .where(book.c.id == sa.bindparam("book_id"))
+        .values(
+            rating_count=count,
+            rating_total=total,
+            rating_avg=sa.case((count > 0, sa.cast(total, sa.Float) / count), else_=0.0),
+            **{f"rating_{stars}_count": book.c[f"rating_{stars}_count"] + sa.bindparam(f"stars_{stars}") for stars in RATINGS}
+        ),
+        [{"book_id": book_id, **delta} for book_id, delta in deltas.items()]
+    )
+
+
+@event.listens_for(so.Session, "after_flush")
+def _update_book_ratings(session, flush_context):
+    # The new/dirty/deleted lists and the attribute history still describe the flushed changes here
+    deltas = _review_deltas(session)
+    if deltas:
+        _apply_deltas(session.connection(), deltas)
+        session.info.setdefault("rated_book_ids", set()).update(deltas)
+
+
+@event.listens_for(so.Session, "after_flush_postexec")
+def _expire_book_ratings(session, flush_context):
+    # The loaded books still hold the old aggregates, reload them on next access
+    for book_id in session.info.pop("rated_book_ids", set()):
+        book = session.identity_map.get(session.identity_key(Book, book_id))
+        if book is not None:
+            session.expire(book, RATING_COLUMNS)
+
+
+@event.listens_for(so.Session, "after_rollback")
+def _discard_book_ratings(session):
+    session.info.pop("rated_book_ids", None)
+
+
+def reconcile_ratings(connection, book_ids=None):
+    """
+    Recompute the review aggregates of the books from the review table.
+
+    Args:
+        connection: The connection to run the updates on.
+        book_ids (iterable): The books to fix, every book if None.
+
+    Returns:
+        int: The number of books whose stored aggregates were wrong.
+    """
+    book = Book.__table__
+    review = Review.__table__
+    if book_ids is None:
+        book_ids = connection.execute(sa.select(book.c.id).order_by(book.c.id)).scalars().all()
+    book_ids = sorted(set(book_ids))
+    fixed = 0
+    for start in range(0, len(book_ids), RECONCILE_BATCH_SIZE):
+        batch = book_ids[start:start + RECONCILE_BATCH_SIZE]
+        expected = {
+            book_id: {"count": 0, "total": 0, **{f"stars_{s}": 0 for s in RATINGS}} for book_id in batch
+        }
+        for book_id, rating, count in connection.execute(
+            sa.select(review.c.book_id, review.c.rating, sa.func.count())
+            .where(review.c.book_id.in_(batch))
+            .group_by(review.c.book_id, review.c.rating)
+        ):
+            stars = parse_rating(rating)
+            if stars is None:
+                continue
+            expected[book_id]["count"] += count
+            expected[book_id]["total"] += count * stars
+            expected[book_id][f"stars_{stars}"] += count
+        stored = connection.execute(
+            sa.select(
+                book.c.id, book.c.rating_avg, book.c.rating_count, book.c.rating_total,
+                *[book.c[f"rating_{s}_count"] for s in RATINGS]
+            ).where(book.c.id.in_(batch))
+        ).all()
+        wrong = []
+        for book_id, rating_avg, *counts in stored:
+            aggregates = expected[book_id]
+            average = aggregates["total"] / aggregates["count"] if aggregates["count"] else 0.0
+            if counts != list(aggregates.values()) or not isclose(rating_avg or 0.0, average):
+                wrong.append({"book_id": book_id, **aggregates})
+        if wrong:
+            book_update = book.update().where(book.c.id == sa.bindparam("book_id")).values(
+                rating_count=sa.bindparam("count"),
+                rating_total=sa.bindparam("total"),
+                rating_avg=sa.case(
+                    (sa.bindparam("count") > 0, sa.cast(sa.bindparam("total"), sa.Float) / sa.bindparam("count")),
+                    else_=0.0
+                ),
+                **{f"rating_{stars}_count": sa.bindparam(f"stars_{stars}") for stars in RATINGS}
+            )
+            connection.execute(book_update, wrong)
+            # The aggregates are part of the book JSON, so its ETag has to change too
+            product = Product.__table__
+            connection.execute(
+                product.update()
+                .where(product.c.id.in_([row["book_id"] for row in wrong]))
+                .values(version=product.c.version + 1)
+            )
+            fixed += len(wrong)
+    return fixed
@@ -4,6 +4,7 @@ from app.models import Review, Book
 from app.schemas import ReviewSchema
 from app import db
 from app.api.reviews import reviews
+from app.api.reviews.ratings import parse_rating
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, set_access_cookies
 from flask_wtf.csrf import generate_csrf
 from sqlalchemy import func
@@ -25,12 +26,9 @@ def get_reviews_for_book(book_id):
     reviews = book.reviews
     # TODO: paginate reviews
     reviews_schema = ReviewSchema(exclude=['book'], many=True)
-    counts = []
-    for i in reversed(range(1, 6)):
-        counts.append({'rating': i, 'count': len([review for review in reviews if review.rating == i])})
     response_data = {
-        'total_count': len(reviews),
-        'counts': counts,
+        'total_count': book.rating_count,
+        'counts': book.rating_histogram,
         'average_rating': book.average_rating,
         'reviews': reviews_schema.dump(reviews)
     }
@@ -53,10 +51,12 @@ def add_review(book_id):
     rating = data.get('rating')
     if not comment or not rating:
         return jsonify({'message': 'Comment and rating are required'}), 400
+    if parse_rating(rating) is None:
+        return jsonify({'message': 'Rating must be between 1 and 5'}), 400
     review_schema = ReviewSchema()
     review_data = review_schema.load({
         'comment': comment,
-        'rating': rating,
+        'rating': parse_rating(rating),
         'book_id': book_id,
         'user_id': int(user_id)
     })
@@ -80,8 +80,10 @@ def update_review(book_id):
     data = request.json
     comment = data.get('comment', review.comment)
     rating = data.get('rating', review.rating)
+    if parse_rating(rating) is None:
+        return jsonify({'message': 'Rating must be between 1 and 5'}), 400
     review.comment = comment
-    review.rating = rating
+    review.rating = parse_rating(rating)
     db.session.commit()
     return jsonify({'message': 'Review updated successfully'}), 200
 
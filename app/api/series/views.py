@@ -1,5 +1,5 @@
 from flask import request, jsonify
-from app import db
+from app import db, cache
 from app.models import Series
 from app.api.series import series
 
@@ -19,6 +19,7 @@ def create_series():
 
 
 @series.route('', methods=['GET'])
+@cache.cached("series:*")
 def get_series():
     """Retrieve a list of series with filtering, pagination, and sorting"""
     series = db.session.execute(db.select(Series)).scalars()
@@ -26,6 +27,7 @@ def get_series():
 
 
 @series.route('/<int:series_id>', methods=['GET'])
+@cache.cached("series:{series_id}")
 def get_single_series(series_id):
     """Retrieve a single series by its ID"""
     series = db.session.execute(
@@ -10,6 +10,7 @@ from flask_wtf.csrf import generate_csrf
 from app.models import Book
 from app.models import User
 from app.schemas import UserSchema
+from app.cart.carts import merge_session_cart
 from datetime import datetime
 
 
@@ -216,6 +217,9 @@ def login():
     set_access_cookies(response, access_token)
     # response.headers['X-CSRF-Token'] = csrf_token
     user.last_login = db.func.now()
+    # Keep what the user put in their cart before logging in
+    merge_session_cart(db.session, session, user.id)
+    db.session.commit()
     return response, 200
 
 
@@ -0,0 +1,322 @@
+# Response cache for the read-only catalog endpoints.
+#
+# Responses are stored under their URL along with the versions of the tags they were built
+# from ("book:42", "genre:*", ...). Writing an entity bumps the version of its own tag and of
+# the wildcard tag of its kind, so every cached response that used it stops matching; tagging
+# a response with "book:*" makes it depend on every book. The tags of the entities written
+# through the ORM are invalidated when the session commits, writes that bypass the session
+# have to call ``cache.invalidate`` themselves.
+#
+# CACHE_TYPE picks the backend: "lru" (per process, the default), "redis" (shared by every
+# worker, needs CACHE_REDIS_URL) or "null" (disabled). An invalidation only reaches the
+# processes sharing the backend, so "lru" is refused when WEB_CONCURRENCY is above 1 and
+# production uses redis: a write in one worker, or in a CLI command such as ``flask api sync``,
+# then expires the responses cached by every worker.
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+import sqlalchemy.orm as so
+from sqlalchemy import event
+from flask import current_app, g, has_app_context, request
+
+# Tag kind of each cached model, and of the models whose changes show up in their parent's responses
+ENTITY_TAGS = {
+    "Book": ("book", "id"),
+    "Cover": ("book", "book_id"),
+    "Review": ("book", "book_id"),
+    "Author": ("author", "id"),
+    "AuthorPhoto": ("author", "author_id"),
+    "Genre": ("genre", "id"),
+    "Series": ("series", "id"),
+    "Publisher": ("publisher", "id"),
+    "Language": ("language", "id"),
+    "Provider": ("provider", "id"),
+    "FeaturedBook": ("featured_book", "id"),
+}
+
+
+# Everything a full BookSchema dump embeds, for the responses that contain one
+BOOK_DUMP_TAGS = ("book:*", "author:*", "genre:*", "series:*", "publisher:*", "language:*", "provider:*")
+
+
+def entity_tag(obj):
+    """Return the cache tag of a model instance ("book:42"), or None if it isn't cached."""
+    kind, attribute = ENTITY_TAGS.get(type(obj).__name__, (None, None))
+    if kind is None:
+        return None
+    identity = getattr(obj, attribute, None)
+    return f"{kind}:{identity}" if identity is not None else f"{kind}:*"
+
+
+def _version_keys(tag):
+    """The version counters a response tagged with ``tag`` depends on."""
+    kind, _, identity = tag.partition(":")
+    if identity == "*":
+        return [tag]
+    # "book:" is only bumped by invalidate("book:*") and expires every single book
+    return [tag, f"{kind}:"]
+
+
+def _bumped_keys(tag):
+    """The version counters to bump when ``tag`` is invalidated."""
+    kind, _, identity = tag.partition(":")
+    if identity == "*":
+        return [tag, f"{kind}:"]
+    return [tag, f"{kind}:*"]
+
+
+class NullBackend:
+    """Caches nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def get_versions(self, keys):
+        return [0 for _ in keys]
+
+    def bump_versions(self, keys):
+        pass
+
+    def incr_stat(self, name):
+        pass
+
+    def get_stats(self):
+        return {}
+
+    def clear(self):
+        pass
+
+
+class LRUBackend:
+    """In-process cache holding at most ``max_entries`` responses."""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._stats = {}
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        expires_at = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_versions(self, keys):
+        with self._lock:
+            return [self._versions.get(key, 0) for key in keys]
+
+    def bump_versions(self, keys):
+        with self._lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    def incr_stat(self, name):
+        with self._lock:
+            self._stats[name] = self._stats.get(name, 0) + 1
+
+    def get_stats(self):
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self._stats.clear()
+
+
+class RedisBackend:
+    """Cache shared by every worker, stored in redis."""
+
+    def __init__(self, url, prefix="response-cache:"):
+        import redis  # only needed with CACHE_TYPE = "redis"
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, timeout):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=timeout or None)
+
+    def get_versions(self, keys):
+        if not keys:
+            return []
+        return [int(value or 0) for value in self.client.mget([f"{self.prefix}version:{key}" for key in keys])]
+
+    def bump_versions(self, keys):
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.incr(f"{self.prefix}version:{key}")
+        pipeline.execute()
+
+    def incr_stat(self, name):
+        self.client.incr(f"{self.prefix}stats:{name}")
+
+    def get_stats(self):
+        names = ["hits", "misses", "invalidations"]
+        values = self.client.mget([f"{self.prefix}stats:{name}" for name in names])
+        return {name: int(value or 0) for name, value in zip(names, values)}
+
+    def clear(self):
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+
+def create_backend(config):
+    cache_type = config.get("CACHE_TYPE", "lru")
+    if cache_type == "null":
+        return NullBackend()
+    if cache_type == "redis":
+        return RedisBackend(config["CACHE_REDIS_URL"])
+    if cache_type == "lru":
+        if config.get("WEB_CONCURRENCY", 1) > 1:
+            raise ValueError("CACHE_TYPE lru is per process, use redis with several workers (WEB_CONCURRENCY)")
+        return LRUBackend(config.get("CACHE_MAX_ENTRIES", 2048))
+    raise ValueError(f"Unknown CACHE_TYPE: {cache_type}")
+
+
+class ResponseCache:
+    """Flask extension caching GET responses by URL, invalidated by entity tags."""
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.timeout = 300
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_backend(app.config)
+        self.timeout = app.config.get("CACHE_DEFAULT_TIMEOUT", 300)
+        app.extensions["response_cache"] = self
+
+    # ----------- CACHING -----------
+
+    @staticmethod
+    def _key():
+        args = urlencode(sorted(request.args.items(multi=True)))
+        return f"response:{request.path}?{args}"
+
+    def _versions(self, tags):
+        keys = sorted({key for tag in tags for key in _version_keys(tag)})
+        return dict(zip(keys, self.backend.get_versions(keys)))
+
+    def cached(self, *tags, timeout=None):
+        """
+        Cache the successful GET responses of a view.
+
+        Args:
+            *tags: Tags the response depends on, formatted with the view arguments
+                (e.g. "book:{book_id}" or "genre:*"). The view can add more with ``cache.tag``.
+            timeout (int): Seconds to keep the response, CACHE_DEFAULT_TIMEOUT by default.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if isinstance(self.backend, NullBackend) or request.method != "GET":
+                    return view(*args, **kwargs)
+                key = self._key()
+                entry = self.backend.get(key)
+                if entry is not None and entry["versions"] == self._versions(entry["tags"]):
+                    self.backend.incr_stat("hits")
+                    response = current_app.response_class(entry["body"], status=entry["status"], mimetype=entry["mimetype"])
+                    response.headers["X-Cache"] = "HIT"
+                    if entry.get("etag"):
+                        response.set_etag(entry["etag"])
+                        response.make_conditional(request)
+                    return response
+                self.backend.incr_stat("misses")
+                # Read the versions before building the response, so a write racing with it
+                # leaves a stale entry that never matches instead of a stale hit
+                g.cache_tags = {tag.format(**kwargs) for tag in tags}
+                versions = self._versions(g.cache_tags)
+                response = current_app.make_response(view(*args, **kwargs))
+                response.headers["X-Cache"] = "MISS"
+                view_tags = g.pop("cache_tags")
+                if response.status_code == 200 and not response.direct_passthrough:
+                    extra = view_tags - {tag.format(**kwargs) for tag in tags}
+                    versions.update(self._versions(extra))
+                    self.backend.set(key, {
+                        "tags": sorted(view_tags),
+                        "versions": versions,
+                        "status": response.status_code,
+                        "mimetype": response.mimetype,
+                        "body": response.get_data(),
+                        "etag": response.get_etag()[0],
+                    }, timeout or self.timeout)
+                return response
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def tag(*tags):
+        """Add tags to the response being cached (no-op outside a cached view)."""
+        if "cache_tags" in g:
+            g.cache_tags.update(tags)
+
+    # ----------- INVALIDATION -----------
+
+    def invalidate(self, *tags):
+        """Expire every cached response depending on any of ``tags``."""
+        keys = sorted({key for tag in tags for key in _bumped_keys(tag)})
+        if keys:
+            self.backend.bump_versions(keys)
+            self.backend.incr_stat("invalidations")
+
+    def clear(self):
+        self.backend.clear()
+
+    # ----------- METRICS -----------
+
+    def stats(self):
+        stats = {"hits": 0, "misses": 0, "invalidations": 0, **self.backend.get_stats()}
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
+
+
+# ----------- CHANGE TRACKING -----------
+
+@event.listens_for(so.Session, "after_flush")
+def _collect_cache_tags(session, flush_context):
+    tags = session.info.setdefault("cache_tags", set())
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in list(session.new) + dirty + list(session.deleted):
+        tag = entity_tag(obj)
+        if tag is not None:
+            tags.add(tag)
+
+
+@event.listens_for(so.Session, "after_commit")
+def _invalidate_cache_tags(session):
+    tags = session.info.pop("cache_tags", None)
+    if tags and has_app_context() and "response_cache" in current_app.extensions:
+        current_app.extensions["response_cache"].invalidate(*tags)
+
+
+@event.listens_for(so.Session, "after_rollback")
+def _discard_cache_tags(session):
+    session.info.pop("cache_tags", None)
@@ -1,4 +1,4 @@
 from flask import Blueprint
 
 cart = Blueprint('cart', __name__, url_prefix='/cart')
-from app.cart import views
+from app.cart import views, reaper
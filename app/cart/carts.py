@@ -0,0 +1,277 @@
+# Loading and batch changes of carts for the cart routes.
+#
+# A cart is dumped with its user, its items and, for each item, the book fields of
+# CartItemSchema. ``cart_query`` loads all of it eagerly, in one query per relationship,
+# so the dump never lazy-loads and its cost doesn't grow with the number of items.
+# ``apply_operations`` applies many line changes with one query for the books and one
+# for the items of the cart, for ``POST /cart/batch``.
+#
+# A book has a single line per cart (unique cart_id, book_id). Adding a book and merging
+# the guest cart of a session into the user's cart at login are upserts on that key, so
+# concurrent adds add up instead of racing on a SELECT.
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app.models import Book, Cart, CartItem
+from app.api.loaders import book_loader_options
+from app.checkout import reservations
+
+# The book fields dumped for each item (see CartItemSchema)
+CART_BOOK_FIELDS = (
+    'id', 'title', 'subtitle', 'isbn_10', 'isbn_13', 'authors', 'series', 'publishers', 'genres',
+    'previous_price', 'current_price', 'cover_url', 'rating',
+)
+
+
+def cart_query():
+    """Select carts with everything CartSchema dumps."""
+    return sa.select(Cart).options(
+        so.joinedload(Cart.user),
+        so.selectinload(Cart.items).options(
+            *book_loader_options(only=CART_BOOK_FIELDS, relationship=so.selectinload(CartItem.book))
+        ),
+    )
+
+
+def load_cart(db_session, cart_id=None, user_id=None):
+    """The cart with ``cart_id``, or the cart of the user with ``user_id``, ready to dump (None if there is none)."""
+    query = cart_query()
+    if user_id is not None:
+        query = query.where(Cart.user_id == user_id)
+    else:
+        query = query.where(Cart.id == cart_id)
+    return db_session.execute(query).unique().scalar_one_or_none()
+
+
+def touch_cart(db_session, cart_id):
+    """Record a change of the lines of a cart, the reaper deletes the anonymous carts left unchanged (see app.cart.reaper)."""
+    db_session.execute(Cart.__table__.update().where(Cart.__table__.c.id == cart_id).values(updated_at=sa.func.now()))
+    cart = db_session.identity_map.get(db_session.identity_key(Cart, cart_id))
+    if cart is not None:
+        db_session.expire(cart, ["updated_at"])
+
+
+def _upsert_insert(db_session):
+    """The INSERT construct with ON CONFLICT of the dialect, None if it has none."""
+    dialect = db_session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+
+def _insert_lines(db_session, rows, add=True):
+    """
+    Insert cart lines. A line of the same book written meanwhile by another request gets the
+    quantity added to it (``add``) or replaced, instead of failing on the unique (cart_id, book_id).
+    """
+    cart_item = CartItem.__table__
+    insert = _upsert_insert(db_session)
+    if insert is not None:
+        statement = insert(cart_item)
+        quantity = cart_item.c.quantity + statement.excluded.quantity if add else statement.excluded.quantity
+        db_session.execute(statement.on_conflict_do_update(
+            index_elements=[cart_item.c.cart_id, cart_item.c.book_id],
+            set_={"quantity": quantity},
+        ), rows)
+        return
+    update = cart_item.update().where(
+        cart_item.c.cart_id == sa.bindparam("line_cart_id"), cart_item.c.book_id == sa.bindparam("line_book_id")
+    ).values(quantity=(cart_item.c.quantity if add else 0) + sa.bindparam("line_quantity"))
+    for row in rows:
+        if not db_session.execute(update, {f"line_{key}": row[key] for key in ("cart_id", "book_id", "quantity")}).rowcount:
+            db_session.execute(cart_item.insert().values(**row))
+
+
+def add_item(db_session, cart_id, book, quantity):
+    """Add ``quantity`` copies of ``book`` to a cart, creating its line or adding to it, without committing."""
+    _insert_lines(db_session, [{"cart_id": cart_id, "book_id": book.id, "quantity": quantity, "in_stock": (book.stock or 0) > 0}])
+    touch_cart(db_session, cart_id)
+    _expire_items(db_session, cart_id)
+
+
+def _expire_items(db_session, cart_id):
+    # The lines were changed without the session
+    cart = db_session.identity_map.get(db_session.identity_key(Cart, cart_id))
+    if cart is not None:
+        for item in cart.__dict__.get("items", ()):
+            db_session.expire(item)
+        db_session.expire(cart, ["items"])
+
+
+def merge_guest_cart(db_session, user_id, guest_cart_id):
+    """
+    Move a guest cart into the cart of a user, without committing.
+
+    The guest cart becomes the user's cart if they have none. Otherwise its lines are added
+    to the user's cart with one INSERT ... SELECT ... ON CONFLICT (quantities of the books in
+    both carts add up), and it is deleted. Carts of another user, and guest carts already
+    merged by a concurrent request, are left alone.
+
+    Returns:
+        bool: Whether anything changed.
+    """
+    cart, cart_item = Cart.__table__, CartItem.__table__
+    user_cart_id = db_session.scalar(sa.select(cart.c.id).where(cart.c.user_id == user_id))
+    if user_cart_id is None:
+        adopted = db_session.execute(
+            cart.update().where(cart.c.id == guest_cart_id, cart.c.user_id.is_(None)).values(user_id=user_id)
+        ).rowcount
+        guest_cart = db_session.identity_map.get(db_session.identity_key(Cart, guest_cart_id))
+        if guest_cart is not None:
+            db_session.expire(guest_cart, ["user_id", "user"])
+        return bool(adopted)
+    # Claim the guest cart before copying its lines. A concurrent merge of the same cart (login
+    # and a cart request with the same session) waits on the row, then finds it gone and stops
+    # instead of adding the lines a second time.
+    claimed = db_session.execute(
+        cart.update().where(cart.c.id == guest_cart_id, cart.c.user_id.is_(None)).values(updated_at=sa.func.now())
+    ).rowcount
+    if not claimed:
+        return False
+    columns = ["cart_id", "book_id", "quantity", "in_stock"]
+    guest_lines = sa.select(
+        sa.literal(user_cart_id), cart_item.c.book_id, cart_item.c.quantity, cart_item.c.in_stock
+    ).where(cart_item.c.cart_id == guest_cart_id)
+    insert = _upsert_insert(db_session)
+    if insert is not None:
+        statement = insert(cart_item).from_select(columns, guest_lines)
+        db_session.execute(statement.on_conflict_do_update(
+            index_elements=[cart_item.c.cart_id, cart_item.c.book_id],
+            set_={"quantity": cart_item.c.quantity + statement.excluded.quantity},
+        ))
+    else:
+        # Add to the books in both carts, then copy the others
+        guest_item = cart_item.alias("guest_item")
+        guest_quantity = (
+            sa.select(guest_item.c.quantity)
+            .where(guest_item.c.cart_id == guest_cart_id, guest_item.c.book_id == cart_item.c.book_id)
+            .scalar_subquery()
+        )
+        db_session.execute(
+            cart_item.update().where(cart_item.c.cart_id == user_cart_id, guest_quantity.is_not(None))
+            .values(quantity=cart_item.c.quantity + guest_quantity)
+        )
+        user_item = cart_item.alias("user_item")
+        db_session.execute(cart_item.insert().from_select(columns, guest_lines.where(~sa.exists().where(
+            user_item.c.cart_id == user_cart_id, user_item.c.book_id == cart_item.c.book_id
+        ))))
+    reservations.release(db_session, guest_cart_id)
+    db_session.execute(cart_item.delete().where(cart_item.c.cart_id == guest_cart_id))
+    db_session.execute(cart.delete().where(cart.c.id == guest_cart_id))
+    guest_cart = db_session.identity_map.get(db_session.identity_key(Cart, guest_cart_id))
+    if guest_cart is not None:
+        db_session.expunge(guest_cart)
+    touch_cart(db_session, user_cart_id)
+    _expire_items(db_session, user_cart_id)
+    return True
+
+
+def merge_session_cart(db_session, flask_session, user_id):
+    """Merge the guest cart of the Flask session into the cart of the user logged in with it (see merge_guest_cart)."""
+    guest_cart_id = flask_session.pop('cart_id', None)
+    if guest_cart_id is None:
+        return False
+    return merge_guest_cart(db_session, user_id, guest_cart_id)
+
+
+CART_OPERATIONS = ('add', 'set', 'remove')
+
+
+class CartOperationError(Exception):
+    """An operation of a batch can't be applied, none of them are."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _operation(index, operation):
+    """Validate one operation of a batch and return its (op, book_id, quantity)."""
+    if not isinstance(operation, dict) or operation.get('op') not in CART_OPERATIONS:
+        raise CartOperationError(f"Operation {index}: op must be one of {', '.join(CART_OPERATIONS)}")
+    op, book_id = operation['op'], operation.get('book_id')
+    if not isinstance(book_id, int) or isinstance(book_id, bool):
+        raise CartOperationError(f"Operation {index}: Book ID is required")
+    quantity = operation.get('quantity', 1 if op == 'add' else 0)
+    if not isinstance(quantity, int) or isinstance(quantity, bool):
+        raise CartOperationError(f"Operation {index}: Quantity must be an integer")
+    if op == 'add' and quantity <= 0:
+        raise CartOperationError(f"Operation {index}: Quantity must be greater than zero")
+    if op == 'set' and quantity < 0:
+        raise CartOperationError(f"Operation {index}: Quantity can't be negative")
+    return op, book_id, quantity
+
+
+def apply_operations(db_session, cart, operations):
+    """
+    Apply a batch of cart operations, in order, without committing.
+
+    Each operation is ``{"op": "add" | "set" | "remove", "book_id": int, "quantity": int}``:
+    "add" adds ``quantity`` (1 by default) copies of the book, "set" replaces the quantity
+    (0 removes the book) and "remove" takes the book out of the cart.
+
+    Args:
+        db_session: The session, committed by the caller.
+        cart (Cart): The cart to change, flushed.
+        operations (list): The operations.
+
+    Raises:
+        CartOperationError: An operation is invalid or names a book that doesn't exist, the cart is unchanged.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise CartOperationError("Operations are required")
+    operations = [_operation(index, operation) for index, operation in enumerate(operations)]
+    book_ids = {book_id for _, book_id, _ in operations}
+    stock = dict(db_session.execute(sa.select(Book.id, Book.stock).where(Book.id.in_(book_ids))).all())
+    missing = sorted(book_ids - set(stock))
+    if missing:
+        raise CartOperationError(f"Books not found: {', '.join(map(str, missing))}", status=404)
+    cart_item = CartItem.__table__
+    rows = db_session.execute(
+        sa.select(cart_item.c.book_id, cart_item.c.id, cart_item.c.quantity).where(cart_item.c.cart_id == cart.id)
+    ).all()
+    items = {book_id: item_id for book_id, item_id, _ in rows}
+    before = {book_id: quantity for book_id, _, quantity in rows}
+    quantities = dict(before)
+    # Books whose quantity was set, not only added to
+    absolute = set()
+    for op, book_id, quantity in operations:
+        if op == 'add':
+            quantities[book_id] = quantities.get(book_id, 0) + quantity
+        else:
+            absolute.add(book_id)
+            if op == 'set' and quantity > 0:
+                quantities[book_id] = quantity
+            else:
+                quantities.pop(book_id, None)
+    # One statement per kind of change
+    new = [
+        {"cart_id": cart.id, "book_id": book_id, "quantity": quantity, "in_stock": (stock[book_id] or 0) > 0}
+        for book_id, quantity in quantities.items() if book_id not in items
+    ]
+    changed = [
+        {"item_id": items[book_id], "item_quantity": quantity}
+        for book_id, quantity in quantities.items() if book_id in items and before[book_id] != quantity
+    ]
+    removed = [items[book_id] for book_id in items if book_id not in quantities]
+    # Upserted, the line of a book may have been added since the snapshot
+    added = [row for row in new if row["book_id"] not in absolute]
+    if added:
+        _insert_lines(db_session, added)
+    if len(added) < len(new):
+        _insert_lines(db_session, [row for row in new if row["book_id"] in absolute], add=False)
+    if changed:
+        db_session.execute(
+            cart_item.update().where(cart_item.c.id == sa.bindparam("item_id")).values(quantity=sa.bindparam("item_quantity")),
+            changed,
+        )
+    if removed:
+        db_session.execute(cart_item.delete().where(cart_item.c.id.in_(removed)))
+    if new or changed or removed:
+        touch_cart(db_session, cart.id)
+    # The loaded items are out of date
+    db_session.expire(cart, ["items"])
@@ -0,0 +1,79 @@
+# Deletion of abandoned anonymous carts.
+#
+# Anonymous carts are only created with their first item, but most are never checked out
+# nor merged into a user's cart at login. ``flask cart reap`` (run daily) deletes the ones
+# unchanged for CART_TTL_DAYS, with their lines and stock holds. Carts are deleted in
+# batches of their ids, one short transaction each, so the cart tables are never locked
+# for long and the visitors' requests run between the batches.
+import time
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from app.cart import cart
+from app.checkout import reservations
+from app.models import Cart, CartItem, StockHold
+
+REAP_BATCH_SIZE = 500
+
+
+def abandoned_carts(cutoff):
+    """Select the ids of the anonymous carts unchanged since ``cutoff``."""
+    table = Cart.__table__
+    return sa.select(table.c.id).where(
+        table.c.user_id.is_(None),
+        sa.or_(
+            table.c.updated_at < cutoff,
+            # Carts created before their changes were recorded
+            sa.and_(table.c.updated_at.is_(None), table.c.created_at < cutoff),
+        ),
+    ).order_by(table.c.id)
+
+
+def reap_carts(db_session, ttl, batch_size=REAP_BATCH_SIZE, pause=0, now=None):
+    """
+    Delete the anonymous carts unchanged for ``ttl``, ``batch_size`` carts per transaction.
+
+    Args:
+        db_session: The session, committed after each batch.
+        ttl (timedelta): How long an anonymous cart is kept after its last change.
+        batch_size (int): Carts deleted per transaction.
+        pause (float): Seconds to wait between batches.
+        now (datetime): The current time.
+
+    Returns:
+        int: The number of carts deleted.
+    """
+    cutoff = (now or datetime.now()) - ttl
+    table, cart_item, hold = Cart.__table__, CartItem.__table__, StockHold.__table__
+    reaped = 0
+    while True:
+        cart_ids = db_session.execute(abandoned_carts(cutoff).limit(batch_size)).scalars().all()
+        if not cart_ids:
+            return reaped
+        # Checked again by the deletes, a cart changed since it was selected is kept
+        batch = abandoned_carts(cutoff).where(table.c.id.in_(cart_ids)).order_by(None)
+        held = db_session.execute(sa.select(hold.c.cart_id).where(hold.c.cart_id.in_(batch)).distinct()).scalars().all()
+        for cart_id in held:
+            reservations.release(db_session, cart_id)
+        db_session.execute(cart_item.delete().where(cart_item.c.cart_id.in_(batch)))
+        reaped += db_session.execute(table.delete().where(table.c.id.in_(batch))).rowcount
+        db_session.commit()
+        if len(cart_ids) < batch_size:
+            return reaped
+        if pause:
+            time.sleep(pause)
+
+
+@cart.cli.command(name='reap')
+@click.option('--days', type=int, default=None, help='Days without changes before a cart is deleted (CART_TTL_DAYS by default)')
+@click.option('--batch-size', type=int, default=REAP_BATCH_SIZE, help='Carts deleted per transaction')
+@click.option('--pause', type=float, default=0, help='Seconds to wait between batches')
+@with_appcontext
+def reap_command(days, batch_size, pause):
+    """Delete the anonymous carts nobody changed for a while (run daily)."""
+    days = current_app.config['CART_TTL_DAYS'] if days is None else days
+    reaped = reap_carts(db.session, timedelta(days=days), batch_size=batch_size, pause=pause)
+    click.echo(f'Deleted {reaped} abandoned carts')
@@ -7,6 +7,8 @@ from app import db
 from app.models import Cart, CartItem
 from app.schemas import CartSchema, CartItemSchema
 from app.cart import cart
+from app.cart.carts import load_cart, add_item, touch_cart, apply_operations, merge_session_cart, CartOperationError
+from app.checkout import reservations
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask import current_app
 
@@ -14,12 +16,15 @@ from flask import current_app
 cart_schema = CartSchema()
 
 
-def get_or_create_cart(db_session, flask_session, user_id, logger=None):
+def get_or_create_cart(db_session, flask_session, user_id, logger=None, create=True):
+    """The cart of the user or of the session, created if there is none and ``create`` (else None)."""
     cart = None
     if user_id is not None:
         user_id = int(user_id)
+        if merge_session_cart(db_session, flask_session, user_id):
+            db_session.commit()
         cart = db_session.query(Cart).filter_by(user_id=user_id).first()
-        if not cart:
+        if not cart and create:
             cart = Cart(user_id=user_id)
             db_session.add(cart)
             db_session.commit()
@@ -27,7 +32,7 @@ def get_or_create_cart(db_session, flask_session, user_id, logger=None):
         cart_id = flask_session.get('cart_id')
         if cart_id:
             cart = db_session.query(Cart).filter_by(id=cart_id).first()
-        if not cart:
+        if not cart and create:
             cart = Cart()
             db_session.add(cart)
             db_session.commit()
@@ -41,34 +46,26 @@ def get_or_create_cart(db_session, flask_session, user_id, logger=None):
 @jwt_required(optional=True)
 def get_cart():
     user_id = get_jwt_identity()
-    cart = None
     if user_id is not None:
         user_id = int(user_id)
-        user = db.session.query(User).filter_by(id=user_id).first()
-        cart = user.cart
-        if cart is None:
-            # check if there is a session cart_id
-            session_cart_id = session.get('cart_id')
-            cart_id = session_cart_id
-            if cart_id is not None:
-                cart = db.session.query(Cart).filter_by(id=cart_id).first()
-            else:
-                cart = Cart()
-                db.session.add(cart)
-            user.cart = cart
+        # First authenticated visit with a guest cart
+        if merge_session_cart(db.session, session, user_id):
+            db.session.commit()
+        cart = load_cart(db.session, user_id=user_id)
     else:
-        cart_id = session.get('cart_id')
-        if cart_id is not None:
-            cart = db.session.query(Cart).filter_by(id=cart_id).first()
-        if not cart:
-            cart = Cart()
-            db.session.add(cart)
-            session['cart_id'] = cart.id
-    db.session.commit()
-    if cart:
-        return jsonify(cart_schema.dump(cart)), 200
-    current_app.logger.info(f"Cart not found for user ID: {user_id}")
-    return jsonify({"message": "Cart not found"}), 404
+        session_cart_id = session.get('cart_id')
+        cart = load_cart(db.session, cart_id=session_cart_id) if session_cart_id is not None else None
+    if cart is None:
+        if user_id is None:
+            # Anonymous visitors get a cart with their first item
+            session.pop('cart_id', None)
+            return jsonify(cart_schema.dump(Cart())), 200
+        # Only the first visit writes
+        cart = Cart(user_id=user_id)
+        db.session.add(cart)
+        db.session.commit()
+        cart = load_cart(db.session, cart_id=cart.id)
+    return jsonify(cart_schema.dump(cart)), 200
 
 
 @cart.route('/add', methods=['POST'])
@@ -94,14 +91,8 @@ def add_to_cart():
         # Retrieve or create the cart
         cart = get_or_create_cart(db.session, session, user_id, current_app.logger)
 
-        # Check if item is already in the cart
-        cart_item = db.session.query(CartItem).filter_by(cart_id=cart.id, book_id=book_id).first()
-        if cart_item:
-            cart_item.quantity += quantity  # Update the quantity
-        else:
-            cart_item = CartItem(cart_id=cart.id, book=book, quantity=quantity)
-            db.session.add(cart_item)
-
+        # Add the book or to its quantity, in one statement
+        add_item(db.session, cart.id, book, quantity)
         db.session.commit()
 
         return jsonify({"message": "Item added to cart", "cart": cart_schema.dump(cart)}), 200
@@ -124,8 +115,10 @@ def update_cart():
         book = db.session.query(Book).filter_by(id=book_id).first()
         if not book:
             return jsonify({"message": "Book not found"}), 404
-        # Retrieve or create the cart
-        cart = get_or_create_cart(db.session, session, user_id)
+        # Retrieve the cart, or create it for a new book
+        cart = get_or_create_cart(db.session, session, user_id, create=quantity > 0)
+        if cart is None:
+            return jsonify({"message": "Item not found in cart"}), 404
 
         # Check if item is already in the cart
         cart_item = db.session.query(CartItem).filter_by(cart_id=cart.id, book_id=book_id).first()
@@ -137,6 +130,7 @@ def update_cart():
         else:
             cart_item = CartItem(cart_id=cart.id, book=book, quantity=quantity)
             db.session.add(cart_item)
+        touch_cart(db.session, cart.id)
 
         db.session.commit()
 
@@ -157,21 +151,45 @@ def remove_from_cart():
 
     if not book_id:
         return jsonify({"message": "Book ID is required"}), 400
-    cart = get_or_create_cart(db.session, session, user_id, current_app.logger)
-    cart_item = db.session.query(CartItem).filter_by(cart_id=cart.id, book_id=book_id).first()
+    cart = get_or_create_cart(db.session, session, user_id, current_app.logger, create=False)
+    cart_item = db.session.query(CartItem).filter_by(cart_id=cart.id, book_id=book_id).first() if cart else None
     if cart_item:
         db.session.delete(cart_item)
+        touch_cart(db.session, cart.id)
         db.session.commit()
         return jsonify({"message": "Item removed from cart", "cart": cart_schema.dump(cart)}), 200
     else:
         return jsonify({"message": "Item not found in cart"}), 404
 
 
+@cart.route('/batch', methods=['POST'])
+@jwt_required(optional=True)
+def batch_update_cart():
+    """Apply a list of add / set / remove operations to the cart in one transaction."""
+    user_id = get_jwt_identity()
+    data = request.get_json() or {}
+    try:
+        cart = get_or_create_cart(db.session, session, user_id, current_app.logger)
+        cart_id = cart.id
+        apply_operations(db.session, cart, data.get('operations'))
+        db.session.commit()
+    except CartOperationError as e:
+        db.session.rollback()
+        return jsonify({"message": e.message}), e.status
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        return jsonify({"message": "An error occurred", "error": str(e)}), 500
+    return jsonify({"message": "Cart updated", "cart": cart_schema.dump(load_cart(db.session, cart_id=cart_id))}), 200
+
+
 @cart.route('', methods=['DELETE'])
 @jwt_required(optional=True)
 def delete_cart():
     user_id = get_jwt_identity()
-    cart = get_or_create_cart(db.session, session, user_id)
+    cart = get_or_create_cart(db.session, session, user_id, create=False)
+    if cart is None:
+        return jsonify({"message": "Cart deleted"}), 200
+    reservations.release(db.session, cart.id)
     cart_items = db.session.query(CartItem).filter_by(cart_id=cart.id).all()
     for cart_item in cart_items:
         db.session.delete(cart_item)
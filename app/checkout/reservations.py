@@ -0,0 +1,165 @@
+# Stock reservations of the carts in checkout.
+#
+# Stock is only ever taken with a conditional UPDATE (``stock >= quantity`` in the WHERE
+# clause), one statement for all the products of a cart, so two checkouts of the last copy
+# can't both succeed: the database serializes them on the product row and the second one
+# matches no row. A cart that starts checking out holds its stock for CHECKOUT_HOLD_MINUTES
+# with StockHold rows; the checkout turns the holds into a sale, and expired holds give the
+# stock back the next time anything is reserved (or with ``flask checkout release-holds``).
+#
+# These statements bypass the session hooks, so they bump the product versions and queue
+# the cache tags of the books themselves.
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from app.checkout import checkout
+from app.models import Product, StockHold
+
+
+class OutOfStock(Exception):
+    """The stock of ``product_ids`` can't cover a cart."""
+
+    def __init__(self, product_ids):
+        super().__init__(f"Not enough stock for products {product_ids}")
+        self.product_ids = product_ids
+
+
+def cart_quantities(cart):
+    """Quantity of each product of ``cart``."""
+    quantities = {}
+    for item in cart.items:
+        quantities[item.book_id] = quantities.get(item.book_id, 0) + item.quantity
+    return quantities
+
+
+def hold_minutes():
+    return current_app.config.get('CHECKOUT_HOLD_MINUTES', 15)
+
+
+def _stock_changed(db_session, product_ids):
+    # What the session hooks would have done for an ORM change of the stock
+    db_session.info.setdefault("cache_tags", set()).update(f"book:{product_id}" for product_id in product_ids)
+    for product_id in product_ids:
+        product = db_session.identity_map.get(db_session.identity_key(Product, product_id))
+        if product is not None:
+            db_session.expire(product, ["stock", "version"])
+
+
+def _change_stock(db_session, quantities, sign):
+    """Add ``sign`` times the quantity of each product to its stock, taking it only where there is enough. Returns the rows changed."""
+    if not quantities:
+        return 0
+    product = Product.__table__
+    quantity = sa.case(quantities, value=product.c.id)
+    statement = product.update().where(product.c.id.in_(quantities))
+    if sign < 0:
+        statement = statement.where(product.c.stock >= quantity)
+    changed = db_session.execute(
+        statement.values(stock=product.c.stock + sign * quantity, version=product.c.version + 1)
+    ).rowcount
+    _stock_changed(db_session, quantities)
+    return changed
+
+
+def _delete_holds(db_session, condition):
+    """Delete the holds matching ``condition`` and return their quantity per product.
+
+    A hold deleted by a concurrent release is not counted, so its stock is only given back once.
+    """
+    hold = StockHold.__table__
+    if db_session.get_bind().dialect.delete_returning:
+        rows = db_session.execute(hold.delete().where(condition).returning(hold.c.product_id, hold.c.quantity)).all()
+    else:
+        rows = []
+        for hold_id, product_id, quantity in db_session.execute(
+            sa.select(hold.c.id, hold.c.product_id, hold.c.quantity).where(condition)
+        ).all():
+            if db_session.execute(hold.delete().where(hold.c.id == hold_id)).rowcount:
+                rows.append((product_id, quantity))
+    quantities = {}
+    for product_id, quantity in rows:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def release_expired(db_session, now=None):
+    """Give back the stock of the holds expired at ``now``. Returns the quantity released per product."""
+    quantities = _delete_holds(db_session, StockHold.__table__.c.expires_at <= (now or datetime.now()))
+    _change_stock(db_session, quantities, 1)
+    return quantities
+
+
+def release(db_session, cart_id):
+    """Give back the stock held by a cart, e.g. when it leaves checkout or is deleted."""
+    quantities = _delete_holds(db_session, StockHold.__table__.c.cart_id == cart_id)
+    _change_stock(db_session, quantities, 1)
+    return quantities
+
+
+def _short(db_session, quantities, cart_id):
+    """The products whose stock, with what the cart already holds, is below the quantities."""
+    hold = StockHold.__table__
+    held = dict(db_session.execute(
+        sa.select(hold.c.product_id, sa.func.sum(hold.c.quantity))
+        .where(hold.c.cart_id == cart_id).group_by(hold.c.product_id)
+    ).all())
+    stock = dict(db_session.execute(
+        sa.select(Product.__table__.c.id, Product.__table__.c.stock).where(Product.__table__.c.id.in_(quantities))
+    ).all())
+    return [
+        product_id for product_id, quantity in quantities.items()
+        if (stock.get(product_id) or 0) + held.get(product_id, 0) < quantity
+    ]
+
+
+def reserve(db_session, cart, minutes=None, now=None):
+    """
+    Hold the stock of the items of ``cart`` until its checkout, replacing the holds it already has.
+
+    Args:
+        db_session: The session, committed by the caller.
+        cart (Cart): The cart to reserve the items of.
+        minutes (int): Lifetime of the holds, CHECKOUT_HOLD_MINUTES by default.
+        now (datetime): The current time.
+
+    Returns:
+        datetime: When the holds expire.
+
+    Raises:
+        OutOfStock: Some products don't have enough stock, nothing was reserved.
+    """
+    now = now or datetime.now()
+    expires_at = now + timedelta(minutes=hold_minutes() if minutes is None else minutes)
+    release_expired(db_session, now)
+    quantities = cart_quantities(cart)
+    # The conditional UPDATE reads the stock from the database
+    db_session.flush()
+    savepoint = db_session.begin_nested()
+    release(db_session, cart.id)
+    if _change_stock(db_session, quantities, -1) < len(quantities):
+        savepoint.rollback()
+        raise OutOfStock(_short(db_session, quantities, cart.id))
+    if quantities:
+        db_session.execute(StockHold.__table__.insert(), [
+            {"cart_id": cart.id, "product_id": product_id, "quantity": quantity, "expires_at": expires_at}
+            for product_id, quantity in quantities.items()
+        ])
+    savepoint.commit()
+    return expires_at
+
+
+def confirm(db_session, cart_id):
+    """Turn the holds of a cart into a sale: the stock stays taken."""
+    db_session.execute(StockHold.__table__.delete().where(StockHold.__table__.c.cart_id == cart_id))
+
+
+@checkout.cli.command(name='release-holds')
+@with_appcontext
+def release_holds_command():
+    """Give back the stock of the expired holds."""
+    released = release_expired(db.session)
+    db.session.commit()
+    click.echo(f'Released the holds of {len(released)} products')
@@ -1,7 +1,7 @@
 from sqlalchemy import select
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask import request, jsonify
-from app.checkout import checkout
+from app.checkout import checkout, reservations
 from app.models import Order, OrderItem, Cart, User, Payment
 from app.schemas import OrderSchema, OrderItemSchema
 from app import db
@@ -12,6 +12,44 @@ def get_checkout_methods():
     return jsonify(Payment.get_payment_methods()), 200
 
 
+def checkout_cart(cart_id, user_id):
+    """The cart to check out, or the error response if it can't be."""
+    if not cart_id:
+        return None, (jsonify({'error': 'Cart ID is required'}), 400)
+    cart = db.session.query(Cart).filter_by(id=cart_id).first()
+    if not cart:
+        return None, (jsonify({'error': 'Cart not found'}), 404)
+    if cart.user_id and cart.user_id != user_id:
+        return None, (jsonify({'error': 'Unauthorized access to cart'}), 403)
+    if len(cart.items) == 0:
+        return None, (jsonify({'error': 'Cart is empty'}), 400)
+    return cart, None
+
+
+def out_of_stock(cart, error):
+    book = next(item.book for item in cart.items if item.book_id in error.product_ids)
+    return jsonify({'error': f"Book '{book.title}' is out of stock"}), 400
+
+
+@checkout.route('/hold', methods=['POST'])
+@jwt_required(optional=True)
+def hold_cart():
+    """Reserve the stock of a cart while its checkout is completed."""
+    user_id = get_jwt_identity()
+    if user_id is not None:
+        user_id = int(user_id)
+    cart, error = checkout_cart((request.json or {}).get('cart_id'), user_id)
+    if error:
+        return error
+    try:
+        expires_at = reservations.reserve(db.session, cart)
+    except reservations.OutOfStock as e:
+        db.session.commit()
+        return out_of_stock(cart, e)
+    db.session.commit()
+    return jsonify({'cart_id': cart.id, 'expires_at': expires_at.isoformat()}), 200
+
+
 # TODO: use celery to process the payment in the background
 @checkout.route('', methods=['POST'])
 @jwt_required(optional=True)
@@ -33,22 +71,17 @@ def process_checkout():
         #     return jsonify({'error': 'Invalid payment method'}), 400
 
         # Validate cart
-        if not cart_id:
-            return jsonify({'error': 'Cart ID is required'}), 400
-        cart = db.session.query(Cart).filter_by(id=cart_id).first()
-        if not cart:
-            return jsonify({'error': 'Cart not found'}), 404
-        if cart.user_id and cart.user_id != user_id:
-            return jsonify({'error': 'Unauthorized access to cart'}), 403
-        if len(cart.items) == 0:
-            return jsonify({'error': 'Cart is empty'}), 400
-
-        # Validate cart items
-        total = 0
-        for item in cart.items:
-            if item.book.stock < item.quantity:
-                return jsonify({'error': f"Book '{item.book.title}' is out of stock"}), 400
-            total += item.book.price * item.quantity
+        cart, error = checkout_cart(cart_id, user_id)
+        if error:
+            return error
+
+        # Take the stock of the items, with the holds of the cart if it has any
+        try:
+            reservations.reserve(db.session, cart)
+        except reservations.OutOfStock as e:
+            db.session.commit()
+            return out_of_stock(cart, e)
+        total = sum(item.book.price * item.quantity for item in cart.items)
 
         # Handle payment
         if payment_method == 'zelle':
@@ -60,6 +93,7 @@ def process_checkout():
             payment_success = True  # Replace with actual Stripe integration
             payment_status = 'completed' if payment_success else 'failed'
             if payment_status == 'failed':
+                db.session.rollback()
                 return jsonify({'error': 'Stripe payment failed'}), 400
 
         # Create order
@@ -67,12 +101,11 @@ def process_checkout():
         db.session.add(new_order)
         db.session.flush()  # Get the order ID before committing
 
-        # for item in cart:
-        #     order_item = OrderItem(order_id=new_order.id, quantity=item.quantity)
-        #     item.book.stock -= item['quantity']  # Deduct stock
-        #     db.session.add(order_item)
-        #     new_order.items.append(order_item)
+        # The stock was taken by the reservation, the items record the sale (and feed the best-seller counters)
+        for item in cart.items:
+            new_order.items.append(OrderItem(book_id=item.book_id, quantity=item.quantity, price=item.book.price))
 
+        reservations.confirm(db.session, cart.id)
         db.session.commit()
 
         response = {
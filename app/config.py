@@ -21,6 +21,23 @@ class BaseConfig:
     JWT_COOKIE_CSRF_PROTECT = True
     JWT_ACCESS_TOKEN_EXPIRES = 30000
 
+    # Seconds before a worker rebuilds its in-memory suggestion index from the database
+    SUGGESTION_INDEX_TTL = int(os.environ.get('SUGGESTION_INDEX_TTL', 300))
+
+    # Response cache of the catalog endpoints: "lru" (per worker), "redis" (shared) or "null"
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'lru')
+    # Worker processes serving the app (gunicorn reads the same variable), "lru" needs a single one
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 300))
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+
+    # Minutes the stock of a cart in checkout stays reserved before it is given back
+    CHECKOUT_HOLD_MINUTES = int(os.environ.get('CHECKOUT_HOLD_MINUTES', 15))
+
+    # Days without changes before ``flask cart reap`` deletes an anonymous cart
+    CART_TTL_DAYS = int(os.environ.get('CART_TTL_DAYS', 30))
+
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration"""
@@ -34,6 +51,9 @@ class ProductionConfig(BaseConfig):
     DEBUG = False
     JWT_COOKIE_SECURE = True
     JWT_COOKIE_CSRF_PROTECT = True
+    # Several gunicorn workers and the CLI commands share the response cache
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'redis')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://redis:6379/0')
 
 
 class TestingConfig(BaseConfig):
@@ -43,6 +63,8 @@ class TestingConfig(BaseConfig):
     APPLICATION_ROOT = '/'
     PREFERRED_URL_SCHEME = 'http'
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI', f'sqlite:///{BASE_DIR}/test_db.sqlite3')
+    # Tests write through factories, so the cache is only enabled by the tests covering it
+    CACHE_TYPE = 'null'
 
 
 config = {
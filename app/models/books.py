@@ -14,6 +14,7 @@ book_genres = sa.Table(
     db.metadata,
     sa.Column("book_id", sa.Integer, sa.ForeignKey("book.id", ondelete="CASCADE"), primary_key=True),
     sa.Column("genre_id", sa.Integer, sa.ForeignKey("genre.id", ondelete="CASCADE"), primary_key=True),
+    sa.Index("ix_book_genres_genre_id", "genre_id"),
 )
 
 book_languages = sa.Table(
@@ -49,6 +50,17 @@ book_authors = sa.Table(
     db.metadata,
     sa.Column("book_id", sa.Integer, sa.ForeignKey("book.id", ondelete="CASCADE"), primary_key=True),
     sa.Column("author_id", sa.Integer, sa.ForeignKey("author.id", ondelete="CASCADE"), primary_key=True),
+    sa.Index("ix_book_authors_author_id", "author_id"),
+)
+
+# Top related books of each book, precomputed by app.api.books.related
+related_books = sa.Table(
+    "related_books",
+    db.metadata,
+    sa.Column("book_id", sa.Integer, sa.ForeignKey("book.id", ondelete="CASCADE"), primary_key=True),
+    sa.Column("related_book_id", sa.Integer, sa.ForeignKey("book.id", ondelete="CASCADE"), primary_key=True),
+    sa.Column("score", sa.Integer, nullable=False),
+    sa.Index("ix_related_books_book_id_score", "book_id", "score"),
 )
 
 
@@ -64,6 +76,8 @@ class Author(db.Model):
     open_library_id: so.Mapped[Optional[str]] = so.mapped_column(sa.String)
     casa_del_libro_id: so.Mapped[Optional[str]] = so.mapped_column(sa.String)
     photos: so.Mapped[list["AuthorPhoto"]] = so.relationship("AuthorPhoto", back_populates="author", cascade="all, delete-orphan")
+    # Bumped whenever the author's JSON changes, used for ETags (see app.api.etags)
+    version: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=1, server_default="1")
 
     # Define the relationship with books
     books: so.Mapped[list["Book"]] = so.relationship(
@@ -123,6 +137,20 @@ class Book(Product):
     weight: so.Mapped[Optional[str]] = so.mapped_column(sa.String)
     publish_places: so.Mapped[Optional[list[str]]] = so.mapped_column(MutableList.as_mutable(sa.JSON))
     edition_name: so.Mapped[Optional[str]] = so.mapped_column(sa.String)
+    # Hash of the fields last imported from the Alejandría export (see app.api.importer.sync)
+    source_hash: so.Mapped[Optional[str]] = so.mapped_column(sa.String(64))
+    # When the related_books list was last computed, None until then (see app.api.books.related)
+    related_computed_at: so.Mapped[Optional[sa.DateTime]] = so.mapped_column(sa.DateTime)
+
+    # Review aggregates, kept up to date by app.api.reviews.ratings
+    rating_avg: so.Mapped[float] = so.mapped_column(sa.Float, default=0, server_default="0", index=True)
+    rating_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_total: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_1_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_2_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_3_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_4_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
+    rating_5_count: so.Mapped[int] = so.mapped_column(sa.Integer, default=0, server_default="0")
 
     # Define the relationships
     providers: so.Mapped[list["Provider"]] = so.relationship(
@@ -191,20 +219,20 @@ class Book(Product):
 
     @hybrid_property
     def average_rating(self):
-        """Calculate the average rating for the book at the Python level."""
-        if not self.reviews:
-            return 0.0
-        return sum(review.rating for review in self.reviews) / len(self.reviews)
+        """The average rating of the book's reviews (0.0 when it has none)."""
+        return self.rating_avg or 0.0
 
     @average_rating.expression
     def average_rating(cls):
-        """Calculate the average rating for the book at the SQL level."""
-        return (
-            db.session.query(func.avg(Review.rating))
-            .filter(Review.book_id == cls.id)
-            .correlate(cls)
-            .as_scalar()
-        )
+        return cls.rating_avg
+
+    @property
+    def rating_histogram(self) -> list[dict]:
+        """Number of reviews per star, from 5 stars down to 1."""
+        return [
+            {'rating': stars, 'count': getattr(self, f"rating_{stars}_count") or 0}
+            for stars in reversed(range(1, 6))
+        ]
 
 
 class Cover(db.Model):
@@ -240,7 +268,7 @@ class Publisher(db.Model):
     name: so.Mapped[str] = so.mapped_column(sa.String, nullable=False)
 
     # Define the relationship with books
-    books: so.Mapped['Book'] = so.relationship("Book", secondary=book_publishers, back_populates="publishers")
+    books: so.Mapped[list["Book"]] = so.relationship("Book", secondary=book_publishers, back_populates="publishers")
 
     def __repr__(self) -> str:
         return f"<Publisher(id={self.id}, name='{self.name}')>"
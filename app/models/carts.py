@@ -2,6 +2,7 @@ import sqlalchemy as sa
 import sqlalchemy.orm as so
 from app import db
 from typing import Optional
+from decimal import Decimal
 
 
 class Cart(db.Model):
@@ -12,14 +13,28 @@ class Cart(db.Model):
     user: so.Mapped[Optional['User']] = so.relationship('User', back_populates='cart')
     items: so.Mapped[list['CartItem']] = so.relationship('CartItem', back_populates='cart', cascade='all, delete-orphan')
 
-    updated_at: so.Mapped[Optional[sa.DateTime]] = so.mapped_column(sa.DateTime, onupdate=sa.func.now())
+    # Last change of the cart or its lines (see app.cart.carts.touch_cart), abandoned carts are reaped from it
+    updated_at: so.Mapped[Optional[sa.DateTime]] = so.mapped_column(sa.DateTime, default=sa.func.now(), onupdate=sa.func.now(), index=True)
     created_at: so.Mapped[Optional[sa.DateTime]] = so.mapped_column(sa.DateTime, default=sa.func.now())
 
+    @property
+    def subtotal(self) -> Decimal:
+        """Sum of the current price of each item's book times its quantity."""
+        return sum((item.subtotal for item in self.items), Decimal('0.00'))
+
+    @property
+    def item_count(self) -> int:
+        """Number of books in the cart, counting the quantity of each item."""
+        return sum(item.quantity for item in self.items)
+
     def __repr__(self) -> str:
         return f"<Cart(id={self.id}, user_id={self.user_id})>"
 
 
 class CartItem(db.Model):
+    # A book has one line per cart, adds upsert it (see app.cart.carts)
+    __table_args__ = (sa.UniqueConstraint('cart_id', 'book_id'),)
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     cart_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('cart.id'))
     book_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('book.id'))
@@ -35,5 +50,10 @@ class CartItem(db.Model):
         if 'book' in kwargs:
             self.in_stock = kwargs['book'].stock > 0
 
+    @property
+    def subtotal(self) -> Decimal:
+        """The current price of the book times the quantity (books without a price count as free)."""
+        return (self.book.current_price or Decimal('0.00')) * self.quantity
+
     def __repr__(self) -> str:
         return f"<CartItem(id={self.id}, book_id={self.book_id}, quantity={self.quantity})>"
@@ -1,5 +1,5 @@
 import enum
-from datetime import datetime
+from datetime import date, datetime
 from app import db
 from decimal import Decimal
 import sqlalchemy as sa
@@ -51,12 +51,40 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
-    order_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('order.id'), nullable=False)
+    # active_history: the best-seller counters take back the committed sale of a changed item (see app.api.books.popularity)
+    order_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('order.id'), nullable=False, active_history=True)
     order: so.Mapped["Order"] = so.relationship("Order", back_populates="items")
     book: so.Mapped["Book"] = so.relationship("Book")  # Add this relationship
-    book_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('book.id'), nullable=False)
-    quantity: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False)
-    price: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(10, 2), nullable=False)
+    book_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('book.id'), nullable=False, active_history=True)
+    quantity: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, active_history=True)
+    price: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(10, 2), nullable=False, active_history=True)
 
     def __repr__(self):
         return f"<OrderItem {self.id}, book={self.book}>"
+
+
+class BookSales(db.Model):
+    """Units sold and revenue of a book on one day, kept for the rolling windows of BookPopularity."""
+    book_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('book.id', ondelete="CASCADE"), primary_key=True)
+    day: so.Mapped[date] = so.mapped_column(sa.Date, primary_key=True, index=True)
+    quantity: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=0)
+    revenue: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(12, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<BookSales book={self.book_id}, day={self.day}, quantity={self.quantity}>"
+
+
+class BookPopularity(db.Model):
+    """Best-seller counters of a book over the last 7 and 30 days and all time."""
+    book_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey('book.id', ondelete="CASCADE"), primary_key=True)
+    quantity_7d: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=0, index=True)
+    quantity_30d: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=0, index=True)
+    quantity_all: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=0, index=True)
+    revenue_7d: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(12, 2), nullable=False, default=0, index=True)
+    revenue_30d: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(12, 2), nullable=False, default=0, index=True)
+    revenue_all: so.Mapped[Decimal] = so.mapped_column(sa.Numeric(12, 2), nullable=False, default=0, index=True)
+
+    book: so.Mapped["Book"] = so.relationship("Book")
+
+    def __repr__(self):
+        return f"<BookPopularity book={self.book_id}, quantity_all={self.quantity_all}>"
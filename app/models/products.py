@@ -26,6 +26,8 @@ class Product(db.Model):
     cost_supplier: so.Mapped[Optional[float]] = so.mapped_column(sa.Numeric(10, 2))
     stock: so.Mapped[Optional[int]] = so.mapped_column(sa.Integer)
     rating: so.Mapped[Optional[float]] = so.mapped_column(sa.Numeric(4, 2), default=0)
+    # Bumped whenever the product's JSON changes, used for ETags (see app.api.etags)
+    version: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False, default=1, server_default="1")
     discounts: so.Mapped[List["Discount"]] = so.relationship(
         "Discount",
         secondary=product_discounts,
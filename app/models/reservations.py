@@ -0,0 +1,17 @@
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from datetime import datetime
+from app import db
+
+
+class StockHold(db.Model):
+    """Stock taken from a product for a cart in checkout, given back if the hold expires (see app.checkout.reservations)."""
+    __tablename__ = "stock_hold"
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    cart_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('cart.id', ondelete='CASCADE'), index=True)
+    product_id: so.Mapped[int] = so.mapped_column(sa.Integer, sa.ForeignKey('product.id'))
+    quantity: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False)
+    expires_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime, nullable=False, index=True)
+
+    def __repr__(self) -> str:
+        return f"<StockHold(id={self.id}, cart_id={self.cart_id}, product_id={self.product_id}, quantity={self.quantity})>"
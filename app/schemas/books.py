@@ -1,7 +1,7 @@
 from app import ma
 from app.models import Book, Author, Genre, Series, Publisher, Language, Provider, FeaturedBook, Cover, AuthorPhoto
 from datetime import datetime
-from marshmallow import fields, ValidationError
+from marshmallow import fields, pre_load, ValidationError
 
 
 # Custom DateTime field
@@ -15,9 +15,27 @@ class DateTimeField(fields.Field):
             raise ValidationError("Invalid date format. Expected 'YYYY-MM-DD HH:MM:SS'.")
 
 
+# Book columns maintained by the app, dumped but never loaded
+MAINTAINED_FIELDS = (
+    'version', 'rating_avg', 'rating_count', 'rating_total',
+    'rating_1_count', 'rating_2_count', 'rating_3_count', 'rating_4_count', 'rating_5_count'
+)
+
+
 class BookSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Book
+        # Maintained by the app (review aggregates and the ETag version), never written directly
+        dump_only = MAINTAINED_FIELDS
+        # Bookkeeping of the import and of the related books, not part of the API
+        exclude = ('source_hash', 'related_computed_at')
+
+    @pre_load
+    def drop_maintained_fields(self, data, **kwargs):
+        # A dumped book loads back, its maintained fields are ignored instead of rejected as unknown
+        if isinstance(data, dict):
+            data = {key: value for key, value in data.items() if key not in MAINTAINED_FIELDS}
+        return data
 
     def get_cover_url(self, obj):
         return obj.cover_url
@@ -63,6 +81,7 @@ class CoverSchema(ma.SQLAlchemyAutoSchema):
 class AuthorSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Author
+        dump_only = ('version',)
 
     def get_photo_url(self, obj):
         return obj.photo_url
@@ -10,6 +10,8 @@ class CartSchema(ma.SQLAlchemyAutoSchema):
     id = ma.auto_field(dump_only=True)
     user = fields.Nested('UserSchema', only=['id', 'username', 'email', 'shipping_address', 'shipping_city', 'shipping_country', 'shipping_postal_code', 'shipping_state'], dump_only=True)
     items = fields.Nested('CartItemSchema', many=True, dump_only=True, exclude=('cart',))
+    subtotal = fields.Decimal(places=2, as_string=True, dump_only=True)
+    item_count = fields.Integer(dump_only=True)
 
 
 class CartItemSchema(ma.SQLAlchemyAutoSchema):
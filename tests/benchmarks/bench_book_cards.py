@@ -0,0 +1,64 @@
+"""
+Compare the book cards of the listing routes with the BookSchema dump they replaced.
+
+Run from the repository root (not collected by pytest):
+
+    python -m tests.benchmarks.bench_book_cards --books 1000 --per-page 100
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+# Use a throwaway database, the config reads it at import time
+DATABASE = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE}"
+
+from app import create_app, db  # noqa: E402
+from app.models import Book  # noqa: E402
+from app.schemas import BookSchema  # noqa: E402
+from app.api.loaders import book_loader_options  # noqa: E402
+from app.api.books.cards import card_query, dump_cards  # noqa: E402
+from tests.factories import BookFactory  # noqa: E402
+
+# The fields the listing routes dumped with BookSchema before the cards
+SCHEMA_FIELDS = ["id", "title", "subtitle", "isbn_10", "isbn_13", "authors", "series", "genres", "publishers", "current_price", "cover_url", "previous_price", "rating", "rating_avg", "rating_count"]
+
+
+def schema_page(per_page):
+    db.session.expunge_all()
+    books = db.session.execute(
+        db.select(Book).options(*book_loader_options(SCHEMA_FIELDS)).order_by(Book.id).limit(per_page)
+    ).scalars().all()
+    schema = BookSchema(only=SCHEMA_FIELDS)
+    return [schema.dump(book) for book in books]
+
+
+def cards_page(per_page):
+    db.session.expunge_all()
+    return dump_cards(db.session.execute(card_query().order_by(Book.id).limit(per_page)).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books", type=int, default=500, help="Books to create")
+    parser.add_argument("--per-page", type=int, default=100, help="Books per listing page")
+    parser.add_argument("--repeat", type=int, default=20, help="Pages to time for each serializer")
+    args = parser.parse_args()
+
+    app = create_app("testing")
+    with app.app_context():
+        db.create_all()
+        BookFactory._meta.sqlalchemy_session_persistence = "flush"
+        BookFactory.create_batch(args.books)
+        db.session.commit()
+        for name, page in (("BookSchema", schema_page), ("book cards", cards_page)):
+            page(args.per_page)  # warm up
+            seconds = timeit.timeit(lambda: page(args.per_page), number=args.repeat) / args.repeat
+            print(f"{name:>10}: {seconds * 1000:8.2f} ms per page of {args.per_page} books")
+        db.session.remove()
+    os.remove(DATABASE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the date normalizer of the importer with the dateutil fuzzy parse it replaced.
+
+Run from the repository root (not collected by pytest), on a books file for real strings:
+
+    python -m tests.benchmarks.bench_dates --books-file data/books.csv --rows 100000
+"""
+import argparse
+import random
+import timeit
+import pandas as pd
+
+from app.api.importer.dates import normalize_date, _normalize_text, _parse_date
+
+# Spellings found in the publish_date, birth_date_ol and death_date_ol columns
+SAMPLE_DATES = [
+    "2005", "1998", "2012", "March 2005", "Mar 2005", "Sept 1999", "2005-03-01", "2016-11-23",
+    "Mar 1, 2005", "September 14, 2010", "1 March 2005", "12 Jun 1923", "c. 1890", "Spring 2001",
+]
+
+
+def sample(books_file, rows):
+    if books_file:
+        dates = pd.read_csv(books_file, sep="\t", usecols=["publish_date"], nrows=rows)["publish_date"].dropna().tolist()
+        if dates:
+            return [dates[i % len(dates)] for i in range(rows)]
+    rng = random.Random(0)
+    return [rng.choice(SAMPLE_DATES) for _ in range(rows)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--books-file", help="Books file to sample the publish dates of")
+    parser.add_argument("--rows", type=int, default=20000, help="Dates to normalize")
+    args = parser.parse_args()
+
+    dates = sample(args.books_file, args.rows)
+    print(f"{len(dates)} dates, {len(set(dates))} distinct")
+
+    def uncached():
+        for value in dates:
+            if isinstance(value, str):
+                _normalize_text.__wrapped__(value)
+            else:
+                _parse_date(value)
+
+    def cached():
+        _normalize_text.cache_clear()
+        for value in dates:
+            normalize_date(value)
+
+    def dateutil():
+        for value in dates:
+            _parse_date(value)
+
+    for name, run in (("dateutil", dateutil), ("fast paths", uncached), ("memoized", cached)):
+        seconds = timeit.timeit(run, number=1)
+        print(f"{name:>10}: {seconds * 1000:8.1f} ms ({len(dates) / seconds:,.0f} dates/s)")
+
+
+if __name__ == "__main__":
+    main()
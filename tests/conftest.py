@@ -1,4 +1,6 @@
 import pytest
+from contextlib import contextmanager
+from sqlalchemy import event
 from app.models.users import Role
 from sqlalchemy.orm import scoped_session, sessionmaker
 from flask_jwt_extended import create_access_token, get_csrf_token
@@ -48,7 +50,8 @@ def app():
 
     # Establish an application context before running the tests
     with app.app_context():
-        # Create the database and tables for testing
+        # Create the database and tables for testing, dropping what an interrupted run left behind
+        db.drop_all()
         db.create_all()
         yield app
         # Drop the database after tests are done
@@ -76,11 +79,19 @@ def client(app, db_session):
 
 @pytest.fixture(scope="function")
 def db_session(app):
-    # Start a transaction for the test
-    connection = db.engine.connect()
+    # Start a transaction for the test. Flask-SQLAlchemy picks the bind from db.engines, so the
+    # test's connection replaces the engine there: the session, and the code using db.engine, run
+    # in this transaction. A commit of the session only releases a savepoint of it.
+    engines = db.engines
+    engine = engines[None]
+    connection = engine.connect()
     transaction = connection.begin()
-    db.session.bind = connection
-    db.session.begin_nested()
+    if connection.dialect.name == "sqlite":
+        # pysqlite only begins before a write, so the first savepoint would start (and its release commit) the transaction
+        connection.exec_driver_sql("BEGIN")
+    engines[None] = connection
+    db.session.remove()
+    db.session.configure(join_transaction_mode="create_savepoint")
 
     yield db.session  # Provide the session to the test
 
@@ -88,6 +99,7 @@ def db_session(app):
     db.session.remove()
     transaction.rollback()
     connection.close()
+    engines[None] = engine
 
 
 @pytest.fixture()
@@ -96,6 +108,26 @@ def runner(app):
     return app.test_cli_runner()
 
 
+@pytest.fixture
+def count_queries(app):
+    """Record the SQL statements executed inside a ``with count_queries() as queries:`` block"""
+    @contextmanager
+    def counter():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            # The savepoints are the test transaction's, not the code's
+            if not statement.startswith(("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")):
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+    return counter
+
+
 @pytest.fixture
 def admin_user(user_factory):
     user = user_factory.create(role=Role.ADMIN)
@@ -152,3 +152,23 @@ def test_get_author_books(client, author_factory, book_factory, num_authors, aut
     assert isinstance(data, list)  # Should return a list of books
     # The list should have the correct number of books
     assert len(data) == len(books_to_assign)
+
+
+def test_get_author_conditional(client, author_factory, book_factory):
+    author = author_factory.create()
+    book = book_factory.create(authors=[author])
+    db.session.commit()
+    for endpoint in ("api.authors.get_author", "api.authors.get_books_by_author"):
+        etag = client.get(url_for(endpoint, author_id=author.id)).headers["ETag"]
+        response = client.get(url_for(endpoint, author_id=author.id), headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    # The author's JSON embeds their books
+    book.title = "A brand new title"
+    db.session.commit()
+    response = client.get(url_for("api.authors.get_author", author_id=author.id), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    author.name = "A brand new name"
+    db.session.commit()
+    response = client.get(url_for("api.authors.get_author", author_id=author.id), headers={"If-None-Match": etag})
+    assert response.status_code == 200
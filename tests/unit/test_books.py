@@ -1,11 +1,16 @@
 from pprint import pprint
+from uuid import uuid4
 import pdb
 import json
 from faker import Faker
 from random import choice
 import pytest
 from app import db
-from app.models import Book
+from app.models import Book, BookPopularity, Cover
+from app.api.books.cards import card_query, dump_cards
+from app.api.books.popularity import refresh_popularity, rebuild_popularity
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from app.schemas import BookSchema
 from sqlalchemy import select, func
 from urllib.parse import quote
@@ -46,6 +51,149 @@ def test_get_books_pagination(client, book_factory, num_books, limit, page):
     assert isinstance(data["books"], list)
     assert len(data["books"]) == min(limit, num_books_in_db - (page - 1) * limit)  # Ensure pagination works as expected
 
+
+@pytest.mark.parametrize("limit", [10, 100])
+def test_get_books_query_count(client, book_factory, count_queries, limit):
+    """ Listing a page of books costs a fixed number of queries regardless of the page size """
+    book_factory.create_batch(limit)
+    db.session.expire_all()
+    with count_queries() as queries:
+        response = client.get(url_for('api.books.get_books', limit=limit))
+    assert response.status_code == 200
+    assert len(response.get_json()["books"]) == limit
+    # count + page of card rows + collection names + covers
+    assert len(queries) <= 4
+
+
+def test_book_cards_match_book_schema(client, book_factory, series_factory):
+    """ Cards hold the same values as the BookSchema dump they replace in the listing routes """
+    book = book_factory.create(series=[series_factory.create()])
+    db.session.add_all([
+        Cover(book_id=book.id, url="https://example.com/back.jpg"),
+        Cover(book_id=book.id, url="https://example.com/front.jpg", is_primary=True),
+    ])
+    db.session.commit()
+    card, = dump_cards(db.session.execute(card_query().where(Book.id == book.id)).all())
+    fields = ["id", "title", "subtitle", "isbn_10", "isbn_13", "current_price", "previous_price", "cover_url", "rating", "rating_avg", "rating_count"]
+    expected = BookSchema(only=fields).dump(book)
+    for collection in ("authors", "series", "genres", "publishers"):
+        expected[collection] = sorted(({"id": item.id, "name": item.name} for item in getattr(book, collection)), key=lambda item: item["id"])
+    assert card == expected
+    assert card["cover_url"] == "https://example.com/front.jpg"
+
+
+def walk_cursor_pages(client, endpoint, limit, **params):
+    """ Follow the cursors of a listing route and return every page """
+    pages = []
+    cursor = ""
+    while cursor is not None:
+        response = client.get(url_for(endpoint, limit=limit, cursor=cursor, **params))
+        assert response.status_code == 200
+        data = response.get_json()
+        assert 'pagination' not in data
+        pages.append(data["books"])
+        cursor = data["cursor"]["next"]
+        assert data["cursor"]["has_next"] == (cursor is not None)
+    return pages
+
+
+def test_get_books_cursor_pagination(client, book_factory, count_queries):
+    """ Cursor mode walks every book once, in id order, without counting the table """
+    book_factory.create_batch(25)
+    pages = walk_cursor_pages(client, 'api.books.get_books', limit=10)
+    assert all(len(page) == 10 for page in pages[:-1])
+    ids = [book["id"] for page in pages for book in page]
+    assert ids == sorted(db.session.execute(select(Book.id)).scalars())
+    with count_queries() as queries:
+        client.get(url_for('api.books.get_books', limit=10, cursor=""))
+    assert not any("count(" in query.lower() for query in queries)
+
+
+def test_get_latest_books_cursor_pagination(client, book_factory):
+    books = book_factory.create_batch(12)
+    books[0].publish_date = books[1].publish_date  # ties are broken by id
+    db.session.commit()
+    pages = walk_cursor_pages(client, 'api.books.get_latest_books', limit=50)
+    ids = [book["id"] for page in pages for book in page]
+    expected = db.session.execute(
+        select(Book.id).where(Book.publish_date.isnot(None)).order_by(Book.publish_date.desc(), Book.id.desc())
+    ).scalars().all()
+    assert ids == expected
+
+
+def test_search_books_cursor_pagination(client, book_factory):
+    book_factory.create_batch(3)
+    matching = book_factory.create_batch(7, description="A story about a zeppelin")
+    pages = walk_cursor_pages(client, 'api.books.search_books', limit=3, q="zeppelin")
+    ids = {book["id"] for page in pages for book in page}
+    assert ids == {book.id for book in matching}
+
+
+def test_get_books_invalid_cursor(client, book_factory):
+    book_factory.create_batch(3)
+    response = client.get(url_for('api.books.get_books', limit=1, cursor=""))
+    cursor = response.get_json()["cursor"]["next"]
+    # A cursor from another endpoint or a tampered one is rejected
+    response = client.get(url_for('api.books.get_latest_books', cursor=cursor))
+    assert response.status_code == 400
+    response = client.get(url_for('api.books.get_books', cursor=cursor[:-2] + "xx"))
+    assert response.status_code == 400
+
+def test_get_book_conditional(client, book_factory, count_queries):
+    """ A client that already has the book gets a 304 without the book being loaded """
+    book = book_factory.create()
+    db.session.commit()
+    response = client.get(url_for('api.books.get_book', book_id=book.id))
+    etag = response.headers["ETag"]
+    with count_queries() as queries:
+        response = client.get(url_for('api.books.get_book', book_id=book.id), headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.get_data() == b""
+    assert len(queries) == 1
+    client.put(
+        url_for("api.books.update_book", book_id=book.id),
+        data=json.dumps({"title": "A brand new title"}),
+        content_type="application/json",
+    )
+    response = client.get(url_for('api.books.get_book', book_id=book.id), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_book_etag_follows_embedded_genres(client, book_factory, genre_factory):
+    genre = genre_factory.create()
+    book = book_factory.create(genres=[genre])
+    db.session.commit()
+    etag = client.get(url_for('api.books.get_book', book_id=book.id)).headers["ETag"]
+    response = client.put(
+        url_for('api.genres.update_genre', genre_id=genre.id),
+        data=json.dumps({"name": f"Renamed {uuid4().hex}"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.get_book', book_id=book.id), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
+def test_get_books_conditional(client, book_factory, count_queries):
+    """ The listing ETag is stable until one of the listed books changes """
+    books = book_factory.create_batch(3)
+    db.session.commit()
+    response = client.get(url_for('api.books.get_books', limit=5))
+    etag = response.headers["ETag"]
+    assert client.get(url_for('api.books.get_books', limit=5)).headers["ETag"] == etag
+    assert client.get(url_for('api.books.get_books', limit=5, page=2)).headers["ETag"] != etag
+    with count_queries() as queries:
+        response = client.get(url_for('api.books.get_books', limit=5), headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(queries) == 1
+    books[0].title = "A brand new title"
+    db.session.commit()
+    response = client.get(url_for('api.books.get_books', limit=5), headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+
 # TODO: create tests for pagination with invalid page and limit values
 
 
@@ -176,6 +324,42 @@ def test_search_books_query(client, book_factory, author_factory):
     # assert book_with_author.id in book_ids
 
 
+def test_search_books_accent_insensitive(client, book_factory, author_factory):
+    book_factory.create_batch(3)
+    author = author_factory.create(name="Gabriel García Márquez")
+    book = book_factory.create(title="Cien años de soledad", authors=[author])
+    for params in [{"author": "garcia marquez"}, {"q": "GARCÍA"}, {"title": "cien anos"}]:
+        search_response = client.get(url_for("api.books.search_books", **params))
+        assert search_response.status_code == 200
+        book_ids = {book["id"] for book in search_response.get_json()["books"]}
+        assert book.id in book_ids
+
+
+def test_search_books_ranked_by_relevance(client, book_factory):
+    in_description = book_factory.create(title="Something else", description="A book about the lighthouse keeper")
+    in_title = book_factory.create(title="The Lighthouse", description="Nothing to see here")
+    search_response = client.get(url_for("api.books.search_books", q="lighthouse"))
+    assert search_response.status_code == 200
+    book_ids = [book["id"] for book in search_response.get_json()["books"]]
+    assert book_ids == [in_title.id, in_description.id]
+
+
+def test_search_index_follows_author_updates(client, book_factory, author_factory):
+    author = author_factory.create(name="Original Name")
+    book = book_factory.create(authors=[author])
+    response = client.put(
+        url_for("api.authors.update_author", author_id=author.id),
+        data=json.dumps({"name": "Renamed Writer"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    search_response = client.get(url_for("api.books.search_books", author="renamed writer"))
+    assert search_response.status_code == 200
+    assert book.id in {book["id"] for book in search_response.get_json()["books"]}
+    search_response = client.get(url_for("api.books.search_books", author="original name"))
+    assert search_response.status_code == 404
+
+
 @ pytest.mark.parametrize("num_books", [1, 5])
 def test_search_books_no_results(client, book_factory, num_books):
     book_factory.create_batch(num_books)
@@ -259,3 +443,62 @@ def test_remove_series_from_book(client, book_factory, series_factory, num_serie
 # def test_get_popular_books(client, book_factory, ):
 #     book = book_factory.create()
 #     assert False
+
+
+def test_get_popular_books_by_window(client, book_factory, order_factory, order_item_factory):
+    today = datetime.now()
+    recent, older, oldest = book_factory.create_batch(3)
+    for book, days_ago, quantity in [(recent, 0, 2), (older, 10, 3), (oldest, 100, 5)]:
+        order = order_factory.create(date=today - timedelta(days=days_ago))
+        order_item_factory.create(order=order, book=book, quantity=quantity, price=Decimal("10.00"))
+    counters = {
+        row.book_id: (row.quantity_7d, row.quantity_30d, row.quantity_all, row.revenue_all)
+        for row in db.session.execute(select(BookPopularity).where(BookPopularity.book_id.in_([recent.id, older.id, oldest.id]))).scalars()
+    }
+    assert counters == {recent.id: (2, 2, 2, 20), older.id: (0, 3, 3, 30), oldest.id: (0, 0, 5, 50)}
+
+    def ranked_ids(**params):
+        response = client.get(url_for('api.books.get_popular_books', limit=100, **params))
+        assert response.status_code == 200
+        return [book["id"] for book in response.get_json() if book["id"] in counters]
+
+    assert ranked_ids(window="7d") == [recent.id]
+    assert ranked_ids(window="30d") == [older.id, recent.id]
+    assert ranked_ids(window="all", metric="revenue") == [oldest.id, older.id, recent.id]
+    response = client.get(url_for('api.books.get_popular_books', window="1y"))
+    assert response.status_code == 400
+
+
+def test_refresh_popularity_moves_windows(db_session, book_factory, order_factory, order_item_factory):
+    book = book_factory.create()
+    order = order_factory.create(date=datetime.now())
+    order_item_factory.create(order=order, book=book, quantity=4, price=Decimal("5.00"))
+    refresh_popularity(db.session.connection(), today=date.today() + timedelta(days=8))
+    popularity = db.session.get(BookPopularity, book.id, populate_existing=True)
+    assert (popularity.quantity_7d, popularity.quantity_30d, popularity.quantity_all) == (0, 4, 4)
+    rebuild_popularity(db.session.connection())
+    popularity = db.session.get(BookPopularity, book.id, populate_existing=True)
+    assert (popularity.quantity_7d, popularity.quantity_30d, popularity.quantity_all) == (4, 4, 4)
+
+
+def test_popularity_follows_changed_order_items(db_session, book_factory, order_factory, order_item_factory):
+    book, other = book_factory.create_batch(2)
+    order = order_factory.create(date=datetime.now())
+    changed = order_item_factory.create(order=order, book=book, quantity=4, price=Decimal("5.00"))
+    deleted = order_item_factory.create(order=order, book=book, quantity=1, price=Decimal("5.00"))
+    changed.quantity = 2
+    changed.price = Decimal("6.00")
+    # Edited then deleted before the flush: the committed sale is taken back
+    deleted.quantity = 7
+    db.session.delete(deleted)
+    db.session.commit()
+    moved = order_item_factory.create(order=order, book=book, quantity=3, price=Decimal("1.00"))
+    moved.book = other
+    db.session.commit()
+
+    def counters(book):
+        popularity = db.session.get(BookPopularity, book.id, populate_existing=True)
+        return (popularity.quantity_7d, popularity.quantity_all, popularity.revenue_all)
+
+    assert counters(book) == (2, 2, 12)
+    assert counters(other) == (3, 3, 3)
@@ -0,0 +1,119 @@
+import json
+import pytest
+from flask import url_for
+from app import db, cache
+from app.caching import LRUBackend, create_backend
+
+
+@pytest.fixture
+def lru_cache(monkeypatch):
+    # The testing config disables the cache, turn it on for these tests only
+    monkeypatch.setattr(cache, "backend", LRUBackend(max_entries=100))
+    return cache
+
+
+def test_get_book_is_cached(client, book_factory, lru_cache, count_queries):
+    book = book_factory.create()
+    response = client.get(url_for('api.books.get_book', book_id=book.id))
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
+    with count_queries() as queries:
+        cached_response = client.get(url_for('api.books.get_book', book_id=book.id))
+    assert cached_response.headers["X-Cache"] == "HIT"
+    assert cached_response.get_json() == response.get_json()
+    assert queries == []
+    stats = lru_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+
+def test_cache_hit_answers_conditional_get(client, book_factory, lru_cache, count_queries):
+    book = book_factory.create()
+    etag = client.get(url_for('api.books.get_book', book_id=book.id)).headers["ETag"]
+    with count_queries() as queries:
+        response = client.get(url_for('api.books.get_book', book_id=book.id), headers={"If-None-Match": etag})
+    assert (response.status_code, response.headers["X-Cache"]) == (304, "HIT")
+    assert queries == []
+
+
+def test_update_book_invalidates_only_that_book(client, book_factory, lru_cache):
+    book, other_book = book_factory.create_batch(2)
+    db.session.commit()  # flush what the factories' post-generation hooks left pending
+    for cached_book in (book, other_book):
+        client.get(url_for('api.books.get_book', book_id=cached_book.id))
+    client.get(url_for('api.books.get_books'))
+    response = client.put(
+        url_for("api.books.update_book", book_id=book.id),
+        data=json.dumps({"title": "A brand new title"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.get_book', book_id=book.id))
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_json()["title"] == "A brand new title"
+    assert client.get(url_for('api.books.get_book', book_id=other_book.id)).headers["X-Cache"] == "HIT"
+    assert client.get(url_for('api.books.get_books')).headers["X-Cache"] == "MISS"
+
+
+def test_genre_rename_invalidates_books_showing_it(client, book_factory, genre_factory, lru_cache):
+    genre = genre_factory.create()
+    book = book_factory.create(genres=[genre])
+    other_book = book_factory.create()
+    db.session.commit()
+    for url in [
+        url_for('api.books.get_book', book_id=book.id),
+        url_for('api.books.get_book', book_id=other_book.id),
+        url_for('api.genres.get_genres'),
+    ]:
+        assert client.get(url).headers["X-Cache"] == "MISS"
+    response = client.put(
+        url_for('api.genres.update_genre', genre_id=genre.id),
+        data=json.dumps({"name": "Renamed genre"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.get_book', book_id=book.id))
+    assert response.headers["X-Cache"] == "MISS"
+    assert "Renamed genre" in [g["name"] for g in response.get_json()["genres"]]
+    assert client.get(url_for('api.books.get_book', book_id=other_book.id)).headers["X-Cache"] == "HIT"
+    assert client.get(url_for('api.genres.get_genres')).headers["X-Cache"] == "MISS"
+
+
+def test_genre_rename_invalidates_authors_embedding_books(client, book_factory, author_factory, genre_factory, lru_cache):
+    genre, author = genre_factory.create(), author_factory.create()
+    book_factory.create(authors=[author], genres=[genre])
+    db.session.commit()
+    url = url_for('api.authors.get_author', author_id=author.id)
+    assert client.get(url).headers["X-Cache"] == "MISS"
+    assert client.get(url).headers["X-Cache"] == "HIT"
+    response = client.put(
+        url_for('api.genres.update_genre', genre_id=genre.id),
+        data=json.dumps({"name": "Renamed genre"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    response = client.get(url)
+    assert response.headers["X-Cache"] == "MISS"
+    assert [g["name"] for g in response.get_json()["books"][0]["genres"]] == ["Renamed genre"]
+
+
+def test_wildcard_invalidation(client, book_factory, lru_cache):
+    book = book_factory.create()
+    client.get(url_for('api.books.get_book', book_id=book.id))
+    lru_cache.invalidate("book:*")
+    assert client.get(url_for('api.books.get_book', book_id=book.id)).headers["X-Cache"] == "MISS"
+
+
+def test_lru_backend_evicts_least_recently_used():
+    backend = LRUBackend(max_entries=2)
+    backend.set("a", 1, None)
+    backend.set("b", 2, None)
+    backend.get("a")
+    backend.set("c", 3, None)
+    assert (backend.get("a"), backend.get("b"), backend.get("c")) == (1, None, 3)
+
+
+def test_lru_backend_refused_with_several_workers():
+    assert isinstance(create_backend({"CACHE_TYPE": "lru", "WEB_CONCURRENCY": 1}), LRUBackend)
+    # Each worker would only invalidate its own copy
+    with pytest.raises(ValueError):
+        create_backend({"CACHE_TYPE": "lru", "WEB_CONCURRENCY": 4})
@@ -1,9 +1,18 @@
 from faker import Faker
 from flask import url_for
 from app.schemas import UserSchema, CartSchema, CartItemSchema
-from app.models import Cart
+from app.models import Cart, CartItem
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, func
+from datetime import datetime, timedelta
+from app.cart.reaper import reap_carts
+from app.cart.carts import apply_operations, merge_guest_cart
+from sqlalchemy import event
+from app.checkout import reservations
 import json
 import pytest
+from decimal import Decimal
+from app import db
 
 
 def test_get_cart_with_user(client, cart_factory, regular_user, user_token):
@@ -198,3 +207,208 @@ def test_remove_from_cart_with_existing_cart_and_user(total_quantity, quantity_t
 # TODO: write test for remove_from_cart with no user
 
 # TODO: write test for delete_cart with user and without user
+
+
+def test_get_cart_query_count(client, regular_user, user_token, cart_factory, cart_item_factory, book_factory, count_queries):
+    """Reading a 50 item cart costs a fixed number of queries, without a write, and returns its totals"""
+    cart = cart_factory.create(user=regular_user)
+    for item in cart.items:
+        db.session.delete(item)
+    items = [cart_item_factory.create(cart=cart, book=book, quantity=2) for book in book_factory.create_batch(50)]
+    db.session.expire_all()
+    client.set_cookie("access_token_cookie", user_token)
+    with count_queries() as queries:
+        response = client.get(url_for('cart.get_cart'))
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(data['items']) == 50
+    assert data['item_count'] == 100
+    assert Decimal(data['subtotal']) == sum(item.book.current_price * 2 for item in items)
+    # cart and user, items, books, authors, author photos, series, publishers, genres, covers
+    assert len(queries) <= 9
+    assert not any(query.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")) for query in queries)
+
+
+def test_batch_update_cart(client, regular_user, user_token, user_csrf_token, cart_factory, cart_item_factory, book_factory, count_queries):
+    """A batch of operations is applied in order with a fixed number of queries"""
+    cart = cart_factory.create(user=regular_user)
+    for item in cart.items:
+        db.session.delete(item)
+    kept, changed, removed = book_factory.create_batch(3)
+    for book in (kept, changed, removed):
+        cart_item_factory.create(cart=cart, book=book, quantity=2)
+    new_books = book_factory.create_batch(30)
+    operations = [{"op": "add", "book_id": book.id, "quantity": 1} for book in new_books]
+    operations += [
+        {"op": "add", "book_id": kept.id, "quantity": 3},
+        {"op": "set", "book_id": changed.id, "quantity": 5},
+        {"op": "remove", "book_id": removed.id},
+        {"op": "add", "book_id": new_books[0].id},
+        {"op": "set", "book_id": new_books[1].id, "quantity": 0},
+    ]
+    db.session.expire_all()
+    client.set_cookie("access_token_cookie", user_token)
+    with count_queries() as queries:
+        response = client.post(url_for('cart.batch_update_cart'), json={"operations": operations}, headers={"X-CSRF-TOKEN": user_csrf_token})
+    assert response.status_code == 200
+    quantities = {item['book']['id']: item['quantity'] for item in response.get_json()['cart']['items']}
+    expected = {book.id: 1 for book in new_books[2:]}
+    expected.update({kept.id: 5, changed.id: 5, new_books[0].id: 2})
+    assert quantities == expected
+    assert response.get_json()['cart']['item_count'] == sum(expected.values())
+    # cart, books, items, one insert, update and delete, the cart activity and the snapshot, whatever the number of lines
+    assert len(queries) <= 16
+
+
+def test_batch_update_cart_is_all_or_nothing(client, cart_factory, book_factory):
+    cart = cart_factory.create(user=None)
+    quantities = {item.book_id: item.quantity for item in cart.items}
+    book = book_factory.create()
+    with client.session_transaction() as session:
+        session['cart_id'] = cart.id
+    response = client.post(url_for('cart.batch_update_cart'), json={"operations": [
+        {"op": "add", "book_id": book.id, "quantity": 1},
+        {"op": "add", "book_id": book.id + 1000000, "quantity": 1},
+    ]})
+    assert response.status_code == 404
+    assert str(book.id + 1000000) in response.get_json()['message']
+    response = client.post(url_for('cart.batch_update_cart'), json={"operations": [{"op": "add", "book_id": book.id, "quantity": 0}]})
+    assert response.status_code == 400
+    db.session.expire_all()
+    assert {item.book_id: item.quantity for item in cart.items} == quantities
+
+
+def cart_with(cart_factory, cart_item_factory, user, lines):
+    """A cart holding exactly ``lines`` ({book: quantity})"""
+    cart = cart_factory.create(user=user)
+    for item in cart.items:
+        db.session.delete(item)
+    for book, quantity in lines.items():
+        cart_item_factory.create(cart=cart, book=book, quantity=quantity)
+    return cart
+
+
+def test_login_merges_the_guest_cart(client, user_factory, cart_factory, cart_item_factory, book_factory):
+    user = user_factory.create(password="password")
+    shared, only_user, only_guest = book_factory.create_batch(3)
+    user_cart = cart_with(cart_factory, cart_item_factory, user, {shared: 1, only_user: 2})
+    guest_cart = cart_with(cart_factory, cart_item_factory, None, {shared: 3, only_guest: 4})
+    guest_cart_id = guest_cart.id
+    with client.session_transaction() as session:
+        session['cart_id'] = guest_cart_id
+    response = client.post("/auth/login", json={"username": user.username, "password": "password"})
+    assert response.status_code == 200
+    with client.session_transaction() as session:
+        assert 'cart_id' not in session
+    db.session.expire_all()
+    assert {item.book_id: item.quantity for item in user_cart.items} == {shared.id: 4, only_user.id: 2, only_guest.id: 4}
+    assert db.session.get(Cart, guest_cart_id) is None
+
+
+def test_first_authenticated_visit_adopts_the_guest_cart(client, regular_user, user_token, cart_factory, cart_item_factory, book_factory):
+    book = book_factory.create()
+    guest_cart = cart_with(cart_factory, cart_item_factory, None, {book: 2})
+    with client.session_transaction() as session:
+        session['cart_id'] = guest_cart.id
+    client.set_cookie("access_token_cookie", user_token)
+    response = client.get(url_for('cart.get_cart'))
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['id'] == guest_cart.id
+    assert data['user']['id'] == regular_user.id
+    assert [(item['book']['id'], item['quantity']) for item in data['items']] == [(book.id, 2)]
+
+
+def test_add_to_cart_adds_to_the_line_of_the_book(client, cart_factory, cart_item_factory, book_factory):
+    book = book_factory.create()
+    cart = cart_with(cart_factory, cart_item_factory, None, {book: 2})
+    with client.session_transaction() as session:
+        session['cart_id'] = cart.id
+    for _ in range(2):
+        response = client.post(url_for('cart.add_to_cart'), json={"book_id": book.id, "quantity": 3})
+        assert response.status_code == 200
+    db.session.expire_all()
+    assert [(item.book_id, item.quantity) for item in cart.items] == [(book.id, 8)]
+    db.session.add(CartItem(cart_id=cart.id, book_id=book.id, quantity=1))
+    with pytest.raises(IntegrityError):
+        db.session.flush()
+    db.session.rollback()
+
+
+def test_anonymous_cart_is_created_with_the_first_item(client, book_factory):
+    carts = db.session.scalar(select(func.count()).select_from(Cart))
+    response = client.get(url_for('cart.get_cart'))
+    assert response.status_code == 200
+    assert response.get_json()['id'] is None
+    response = client.put(url_for('cart.remove_from_cart'), json={"book_id": 1})
+    assert response.status_code == 404
+    assert db.session.scalar(select(func.count()).select_from(Cart)) == carts
+    book = book_factory.create()
+    response = client.post(url_for('cart.add_to_cart'), json={"book_id": book.id, "quantity": 1})
+    assert response.status_code == 200
+    with client.session_transaction() as session:
+        assert session['cart_id'] == response.get_json()['cart']['id']
+    assert db.session.scalar(select(func.count()).select_from(Cart)) == carts + 1
+
+
+def test_reap_abandoned_carts(db_session, runner, cart_factory, cart_item_factory, book_factory, user_factory):
+    old, recent = datetime(2000, 1, 1), datetime(2000, 1, 30)
+    book = book_factory.create(stock=5)
+    abandoned = [cart_with(cart_factory, cart_item_factory, None, {book: 1}) for _ in range(5)]
+    for cart in abandoned:
+        cart.updated_at = old
+    kept = cart_with(cart_factory, cart_item_factory, None, {book: 1})
+    kept.updated_at = recent
+    user_cart = cart_with(cart_factory, cart_item_factory, user_factory.create(), {book: 1})
+    user_cart.updated_at = old
+    db.session.commit()
+    reservations.reserve(db.session, abandoned[0], minutes=15, now=old)
+    db.session.commit()
+    abandoned_ids = [cart.id for cart in abandoned]
+    reaped = reap_carts(db.session, timedelta(days=7), batch_size=2, now=datetime(2000, 2, 1))
+    assert reaped == 5
+    db.session.expire_all()
+    assert db.session.scalars(select(Cart.id).where(Cart.id.in_(abandoned_ids))).all() == []
+    assert db.session.scalar(select(func.count()).select_from(CartItem).where(CartItem.cart_id.in_(abandoned_ids))) == 0
+    assert db.session.get(Cart, kept.id) is not None
+    assert db.session.get(Cart, user_cart.id) is not None
+    # The stock held for the reaped cart is back
+    assert book.stock == 5
+    result = runner.invoke(args=['cart', 'reap', '--days', '36500'])
+    assert 'Deleted 0 abandoned carts' in result.output
+
+
+def test_merge_guest_cart_only_once(db_session, regular_user, cart_factory, cart_item_factory, book_factory):
+    book = book_factory.create()
+    user_cart = cart_with(cart_factory, cart_item_factory, regular_user, {book: 1})
+    guest_cart = cart_with(cart_factory, cart_item_factory, None, {book: 2})
+    guest_cart_id = guest_cart.id
+    assert merge_guest_cart(db.session, regular_user.id, guest_cart_id)
+    # A second merge of the same guest cart, e.g. by a concurrent request, finds it claimed
+    assert not merge_guest_cart(db.session, regular_user.id, guest_cart_id)
+    db.session.commit()
+    assert [(item.book_id, item.quantity) for item in user_cart.items] == [(book.id, 3)]
+
+
+@pytest.mark.parametrize("op, expected", [("add", 3), ("set", 2)])
+def test_batch_update_cart_upserts_lines_added_meanwhile(db_session, regular_user, cart_factory, cart_item_factory, book_factory, op, expected):
+    cart = cart_with(cart_factory, cart_item_factory, regular_user, {})
+    book = book_factory.create()
+
+    added = []
+
+    def add_line_first(state):
+        # Another request adds the book after the batch read the lines of the cart
+        statement = state.statement
+        if not added and getattr(statement, "is_insert", False) and statement.table is CartItem.__table__:
+            added.append(book.id)
+            state.session.connection().execute(CartItem.__table__.insert().values(cart_id=cart.id, book_id=book.id, quantity=1, in_stock=True))
+
+    event.listen(db.session, "do_orm_execute", add_line_first)
+    try:
+        apply_operations(db.session, cart, [{"op": op, "book_id": book.id, "quantity": 2}])
+    finally:
+        event.remove(db.session, "do_orm_execute", add_line_first)
+    assert added
+    db.session.commit()
+    assert [(item.book_id, item.quantity) for item in cart.items] == [(book.id, expected)]
@@ -7,7 +7,14 @@ from app import db
 from app.models import Author
 from app.schemas import AuthorSchema
 from sqlalchemy import select, func
+from datetime import datetime, timedelta
+from threading import Thread
+import time
+import sqlalchemy as sa
+import sqlalchemy.orm as so
 import pytest
+from app.models import Book, BookPopularity, Cart, CartItem, Order, StockHold
+from app.checkout import reservations
 
 
 def test_process_checkout_not_logged_in(client, cart_factory):
@@ -31,6 +38,28 @@ def test_process_checkout_not_logged_in(client, cart_factory):
     assert data['message'] == 'Checkout successful'
 
 
+def test_process_checkout_records_the_sale(client, cart_factory):
+    cart = cart_factory.create()
+    for item in cart.items:
+        item.book.stock = item.quantity + 1
+    cart.user = None
+    sold = {}
+    for item in cart.items:
+        sold[item.book_id] = sold.get(item.book_id, 0) + item.quantity
+    response = client.post(
+        url_for("checkout.process_checkout"),
+        data=json.dumps({"cart_id": cart.id, "payment_method": "stripe"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 201
+    order = db.session.get(Order, response.get_json()['order_id'])
+    assert sum(item.quantity for item in order.items) == sum(sold.values())
+    # The best-seller counters follow the order items
+    for book_id, quantity in sold.items():
+        popularity = db.session.get(BookPopularity, book_id, populate_existing=True)
+        assert (popularity.quantity_7d, popularity.quantity_all) == (quantity, quantity)
+
+
 def test_process_checkout_logged_in(client, cart_factory, regular_user, user_token, user_csrf_token):
     cart = cart_factory.create()
     # Make sure the books in the cart are in stock
@@ -90,3 +119,107 @@ def test_process_checkout_item_out_of_stock(client, cart_factory):
     data = response.get_json()
     assert 'error' in data
     assert data['error'] == f"Book '{item_out_of_stock.book.title}' is out of stock"
+
+
+def stock_engine(tmp_path):
+    """A database file of its own, shared by the threads of a test"""
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'stock.sqlite3'}", connect_args={"timeout": 30})
+    db.metadata.create_all(engine)
+    return engine
+
+
+def create_carts(engine, stock, carts):
+    """Books with ``stock`` and carts with a copy of each, returns the book and cart ids"""
+    with so.Session(engine) as session:
+        books = [Book(title=f"Book {index}", stock=amount) for index, amount in enumerate(stock)]
+        session.add_all(books)
+        session.flush()
+        cart_ids = []
+        for _ in range(carts):
+            cart = Cart(items=[CartItem(book=book, quantity=1) for book in books])
+            session.add(cart)
+            session.flush()
+            cart_ids.append(cart.id)
+        session.commit()
+        return [book.id for book in books], cart_ids
+
+
+def stock_of(engine, book_ids):
+    with so.Session(engine) as session:
+        return [session.get(Book, book_id).stock for book_id in book_ids]
+
+
+def test_holds_expire_and_give_the_stock_back(tmp_path):
+    engine = stock_engine(tmp_path)
+    book_ids, (first, second) = create_carts(engine, [1], 2)
+    now = datetime(2024, 1, 1, 12)
+    with so.Session(engine) as session:
+        expires_at = reservations.reserve(session, session.get(Cart, first), minutes=15, now=now)
+        session.commit()
+    assert expires_at == now + timedelta(minutes=15)
+    assert stock_of(engine, book_ids) == [0]
+    with so.Session(engine) as session:
+        with pytest.raises(reservations.OutOfStock) as error:
+            reservations.reserve(session, session.get(Cart, second), minutes=15, now=now + timedelta(minutes=10))
+        assert error.value.product_ids == book_ids
+        # Reserving again only renews the hold of the cart
+        reservations.reserve(session, session.get(Cart, first), minutes=15, now=now + timedelta(minutes=10))
+        session.commit()
+    assert stock_of(engine, book_ids) == [0]
+    with so.Session(engine) as session:
+        # The first cart never checked out, its hold expired
+        reservations.reserve(session, session.get(Cart, second), minutes=15, now=now + timedelta(minutes=30))
+        reservations.confirm(session, second)
+        session.commit()
+        assert session.scalar(sa.select(sa.func.count()).select_from(StockHold)) == 0
+    assert stock_of(engine, book_ids) == [0]
+
+
+def test_concurrent_checkouts_never_oversell(tmp_path, record_property):
+    """Checkouts racing for the same books sell exactly their stock"""
+    engine = stock_engine(tmp_path)
+    threads, carts_per_thread, stock = 8, 10, [30, 1000]
+    book_ids, cart_ids = create_carts(engine, stock, threads * carts_per_thread)
+    sold, refused = [], []
+
+    def checkout(cart_ids):
+        for cart_id in cart_ids:
+            with so.Session(engine) as session:
+                try:
+                    reservations.reserve(session, session.get(Cart, cart_id), minutes=15)
+                except reservations.OutOfStock:
+                    session.rollback()
+                    refused.append(cart_id)
+                    continue
+                reservations.confirm(session, cart_id)
+                session.commit()
+                sold.append(cart_id)
+
+    workers = [Thread(target=checkout, args=(cart_ids[index::threads],)) for index in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    record_property("checkouts_per_second", round(len(cart_ids) / elapsed, 1))
+    assert len(sold) == 30
+    assert len(refused) == len(cart_ids) - 30
+    assert stock_of(engine, book_ids) == [0, 1000 - 30]
+
+
+def test_hold_cart(client, book_factory, cart_factory, cart_item_factory):
+    cart = cart_factory.create(user=None)
+    for item in cart.items:
+        db.session.delete(item)
+    book = book_factory.create(stock=3)
+    cart_item_factory.create(cart=cart, book=book, quantity=2)
+    response = client.post(url_for("checkout.hold_cart"), json={"cart_id": cart.id})
+    assert response.status_code == 200
+    assert response.get_json()["cart_id"] == cart.id
+    assert book.stock == 1
+    # The checkout uses the stock held for the cart
+    response = client.post(url_for("checkout.process_checkout"), json={"cart_id": cart.id, "payment_method": "stripe"})
+    assert response.status_code == 201
+    assert book.stock == 1
+    assert db.session.scalar(sa.select(sa.func.count()).select_from(StockHold).where(StockHold.cart_id == cart.id)) == 0
@@ -1,8 +1,24 @@
 import pytest
+import json
 from datetime import datetime
 from faker import Faker
+import pandas as pd
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db
+from app.models import Book, Product, Author, AuthorPhoto, Cover, FeaturedBook, Genre, Publisher, Language, Series, Provider
+from app.models.books import book_authors, book_genres, book_publishers, book_languages, book_series, book_providers, related_books
 from app.api.populate import process_date
-from app.api.populate import merge_books
+from app.api.populate import merge_books, import_books, import_book
+from app.api.importer.bulk import CatalogImport
+from app.api.importer.authors import AuthorIndex
+from app.api.importer.sync import CatalogSync
+from app.api.importer.checkpoint import Checkpoint, RejectLog
+from app.api.importer.profiler import ImportProfiler
+from app.api.importer.providers import ProviderLinks
+from app.api.importer.rows import find_authors_by_id, find_authors_by_name, deserialize_columns
+from app.api.importer.dates import normalize_date, _parse_date
+from app.api.importer.reader import read_books, read_chunks, read_table, decode_json_column
 
 fake = Faker()
 
@@ -69,3 +85,396 @@ def test_merge_books(book_factory):
     book1.description = None
     merge_books(book1, book2)
     assert book1.description == previous_description2
+
+
+NAN = float("nan")
+
+CATALOG_TABLES = [
+    table.__table__ if hasattr(table, "__table__") else table
+    for table in (
+        Product, Book, Author, AuthorPhoto, Cover, FeaturedBook, Genre, Publisher, Language, Series, Provider,
+        book_authors, book_genres, book_publishers, book_languages, book_series, book_providers, related_books,
+    )
+]
+
+
+def book_row(**fields):
+    row = {
+        'title': None, 'isbn_10': None, 'isbn_13': None, 'publish_date': None, 'description': None,
+        'precio': 20.0, 'iva': 16.0, 'ultimo_costo': 12.5, 'costo_proveedor': 11.0, 'costo_promedio': 12.0,
+        'stock_propio': NAN, 'stock_consig': NAN, 'physical_format': None, 'number_of_pages': NAN,
+        'barra_cod': None, 'isbn': None, 'cod_art': None, 'physical_dimensions': None, 'weight': 'nan',
+        'publish_places': [], 'edition_name': None, 'subtitle': None, 'covers': [], 'genres': [],
+        'publishers': [], 'languages': [], 'series': [], 'cod_pro': NAN,
+        'author_ids_cdl': [], 'authors_ol': [], 'author_names_cdl': [], 'autor': [],
+    }
+    row.update(fields)
+    return row
+
+
+def author_row(**fields):
+    row = {
+        'summary_cdl': NAN, 'bio_ol': NAN, 'name_cdl': NAN, 'name_ol': NAN, 'name_alejandria': NAN,
+        'death_date_ol': NAN, 'birth_date_ol': NAN, 'other_names_ol': [], 'key_ol': NAN, 'id_cdl': NAN, 'photos': [],
+    }
+    row.update(fields)
+    return row
+
+
+@pytest.fixture
+def catalog_sources():
+    """ Small source files exercising the matching and merging rules of the importer """
+    books = pd.DataFrame([
+        book_row(title='Cien años de soledad', isbn_13='9780307474728', cod_art='A1', publish_date='1967-05-30',
+                 description='Macondo', covers=['https://covers/1.jpg', 'https://covers/2.jpg'],
+                 genres=['novel', 'magic realism'], publishers=['Sudamericana'], languages=['es'],
+                 cod_pro='7', author_ids_cdl=['cdl-1']),
+        # Same ISBN: merged into the first book
+        book_row(title='Cien años de soledad', isbn_13='9780307474728', subtitle='Edición conmemorativa',
+                 genres=['Novel'], series=['Clásicos'], authors_ol=['OL1A']),
+        book_row(title='El amor en los tiempos del cólera', isbn_10='0307389731', cod_art='A2',
+                 covers=['https://covers/2.jpg'], genres=['novel'], cod_pro='404', author_names_cdl=['gabriel']),
+        book_row(title='Rayuela', cod_art='A3', description='Hopscotch', covers=['https://covers/3.jpg'],
+                 publishers=['Sudamericana', 'Alfaguara'], cod_pro='7', author_names_cdl=['Julio Cortázar']),
+        book_row(title='Rayuela', cod_art='A3', languages=['es', 'en'], autor=['Cortázar, Julio']),
+        book_row(title='Ficciones', cod_art='A4', autor=['Jorge Luis Borges', '']),
+    ])
+    authors = pd.DataFrame([
+        author_row(name_cdl='Gabriel García Márquez', id_cdl='cdl-1', key_ol='OL1A', birth_date_ol='1927-03-06',
+                   photos=['https://photos/ggm.jpg', 'https://photos/ggm2.jpg'], other_names_ol=['Gabo']),
+        author_row(name_ol='Julio Florencio Cortázar', key_ol='OL2A', name_alejandria='CORTAZAR, JULIO',
+                   photos=['https://photos/ggm2.jpg']),
+    ])
+    providers = pd.DataFrame([
+        {'cod_pro': '7', 'cedula_proveedor': 'J-1', 'nombre_proveedor': 'Distribuidora', 'direccion_proveedor': NAN,
+         'telefono_proveedor': NAN, 'correo_proveedor': NAN, 'nombre_contacto_proveedor': NAN,
+         'nombre_banco_proveedor': NAN, 'titular_banco_proveedor': NAN, 'rif_banco_proveedor': NAN,
+         'cuenta_banco_proveedor': NAN, 'notas': NAN},
+    ])
+    return books, authors, providers
+
+
+def table_contents(engine):
+    """ Every catalog row, minus the columns that depend on when the rows were written """
+    ignored = {"created_at", "version", "related_computed_at"}
+    contents = {}
+    with engine.connect() as connection:
+        for table in CATALOG_TABLES:
+            columns = [column for column in table.c if column.name not in ignored]
+            contents[table.name] = connection.execute(sa.select(*columns).order_by(*table.primary_key.columns)).all()
+        contents["book_search"] = connection.execute(sa.text("SELECT rowid, * FROM book_search ORDER BY rowid")).all()
+    return contents
+
+
+def test_bulk_import_matches_row_by_row_import(app, catalog_sources):
+    books, authors, providers = catalog_sources
+    row_by_row = sa.create_engine("sqlite://")
+    bulk = sa.create_engine("sqlite://")
+    for engine in (row_by_row, bulk):
+        db.metadata.create_all(engine)
+
+    with so.Session(row_by_row) as session:
+        import_books(session, books, authors, providers, batch_size=2, limit=None)
+    catalog = CatalogImport(authors, providers)
+    catalog.add_books(books)
+    with bulk.begin() as connection:
+        catalog.write(connection, batch_size=2)
+
+    expected = table_contents(row_by_row)
+    assert table_contents(bulk) == expected
+    assert len(expected["book"]) == 4
+    assert len(expected["book_authors"]) > 0 and len(expected["featured_book"]) > 0
+
+
+def test_author_index_matches_dataframe_lookups():
+    """ The prebuilt indexes answer every lookup like the DataFrame scans they replace """
+    names = [fake.name() for _ in range(200)] + ["García Márquez, Gabriel", "GARCIA MARQUEZ", NAN, "Ana"]
+    authors = pd.DataFrame({
+        'id_cdl': [f"cdl-{i % 150}" if i % 7 else NAN for i in range(len(names))],
+        'key_ol': [f"OL{i}A" for i in range(len(names))],
+        'name_cdl': names,
+        'name_alejandria': [name.upper() if isinstance(name, str) else name for name in reversed(names)],
+    })
+    index = AuthorIndex(authors)
+    ids = ["cdl-3", "cdl-149", "cdl-7", "cdl-999", "OL5A", "OL999A"]
+    for column in ("id_cdl", "key_ol"):
+        assert index.find_authors_by_id(ids, column) == find_authors_by_id(authors, ids, column)
+    queries = [name[2:9] for name in names[:50] if isinstance(name, str)] + [
+        "garcía", "márquez", "GARCIA", "an", "a", "", "zzzzzz", "Gabriel (Gabo)", "J. R.", names[10].lower(),
+    ]
+    for column in ("name_cdl", "name_alejandria"):
+        for query in queries:
+            assert index.find_authors_by_name([query], column) == find_authors_by_name(authors, [query], column), query
+
+
+def test_bulk_import_with_workers_is_deterministic(app, catalog_sources):
+    books, authors, providers = catalog_sources
+    serial = CatalogImport(authors, providers)
+    serial.add_books(books)
+    parallel = CatalogImport(authors, providers)
+    parallel.add_books(books, workers=2)
+    assert list(parallel.books) == list(serial.books)
+    assert list(parallel.authors) == list(serial.authors)
+    assert parallel.links == serial.links
+    assert parallel.summary() == serial.summary()
+
+
+def write_tsv(df, path, json_columns=('isbn_10', 'isbn_13')):
+    """ Write a source file with the list columns as JSON, and the ISBNs quoted so they are read back as strings """
+    df = df.map(lambda value: json.dumps(value) if isinstance(value, list) else value)
+    for column in set(json_columns) & set(df.columns):
+        df[column] = df[column].map(lambda value: json.dumps(value) if isinstance(value, str) else value)
+    df.to_csv(path, sep='\t', index=False)
+    return path
+
+
+def test_decode_json_column_keeps_cells_that_are_not_json():
+    assert decode_json_column(['["a"]', '[]', '3', 'null']) == [['a'], [], 3, None]
+    assert decode_json_column(['1, 2', '"x"']) == ['1, 2', 'x']
+    assert decode_json_column(['Rayuela', '["b"]', 'Rayuela', NAN])[:3] == ['Rayuela', ['b'], 'Rayuela']
+
+
+def test_streaming_reader_matches_whole_file_read(tmp_path, catalog_sources):
+    books, authors, _ = catalog_sources
+    books_path = write_tsv(books, tmp_path / "books.csv")
+    authors_path = write_tsv(authors, tmp_path / "authors.csv")
+
+    expected = deserialize_columns(pd.read_csv(books_path, dtype={'isbn_13': str, 'isbn_10': str, 'ean': str, 'weight': str}, sep='\t'))
+    expected['weight'] = expected['weight'].astype('str')
+    chunks = list(read_books(books_path, chunksize=4))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    pd.testing.assert_frame_equal(pd.concat(chunks), expected, check_dtype=False)
+
+    expected_authors = deserialize_columns(pd.read_csv(authors_path, dtype={'id_cdl': str}, sep='\t'))
+    pd.testing.assert_frame_equal(read_table(authors_path, dtype={'id_cdl': str}, chunksize=1), expected_authors, check_dtype=False)
+
+
+def test_bulk_import_of_streamed_chunks(tmp_path, app, catalog_sources):
+    books, authors, providers = catalog_sources
+    books_path = write_tsv(books, tmp_path / "books.csv")
+    whole = CatalogImport(authors, providers)
+    whole.add_books(pd.concat(read_books(books_path)), limit=5)
+    streamed = CatalogImport(authors, providers)
+    streamed.add_books(read_books(books_path, chunksize=2), limit=5)
+    assert list(streamed.books) == list(whole.books)
+    assert streamed.links == whole.links
+    assert streamed.summary() == whole.summary()
+
+
+@pytest.mark.parametrize('populate', ['bulk', 'row_by_row'])
+def test_sync_only_writes_changed_books(app, catalog_sources, populate):
+    books, authors, providers = catalog_sources
+    engine = sa.create_engine("sqlite://")
+    db.metadata.create_all(engine)
+    if populate == 'bulk':
+        catalog = CatalogImport(authors, providers)
+        catalog.add_books(books)
+        with engine.begin() as connection:
+            catalog.write(connection)
+    else:
+        with so.Session(engine) as session:
+            import_books(session, books, authors, providers, batch_size=2, limit=None)
+
+    def sync(books):
+        with so.Session(engine) as session:
+            author_index = AuthorIndex(authors)
+            provider_links = ProviderLinks(session, providers)
+            catalog = CatalogSync(session, lambda row: import_book(session, row, authors, provider_links, author_index))
+            catalog.add_books([books])
+            provider_links.flush()
+            changed = catalog.write()
+            session.commit()
+            return changed, catalog.summary()
+
+    def versions():
+        with engine.connect() as connection:
+            return dict(connection.execute(sa.select(Product.__table__.c.id, Product.__table__.c.version)).all())
+
+    # Nothing changed since the import
+    assert sync(books) == ([], {"matched": 4, "changed": 0, "created": 0})
+    before = versions()
+
+    books = books.copy()
+    books.loc[3, 'precio'] = 12.5
+    books.loc[3, 'stock_propio'] = 3
+    books = pd.concat([books, pd.DataFrame([book_row(title='Pedro Páramo', cod_art='A5', genres=['novel'])])], ignore_index=True)
+    changed, summary = sync(books)
+    assert summary == {"matched": 4, "changed": 1, "created": 1}
+    with engine.connect() as connection:
+        rayuela = connection.execute(sa.select(Book).where(Book.title == 'Rayuela')).one()
+        assert changed == [rayuela.id]
+        assert float(rayuela.current_price) == 12.5 and rayuela.stock_alejandria == 3 and rayuela.stock == 3
+        assert connection.execute(sa.select(sa.func.count()).select_from(Book).where(Book.title == 'Pedro Páramo')).scalar() == 1
+        # Untouched fields keep their values
+        assert rayuela.description == 'Hopscotch'
+    after = versions()
+    assert {book_id for book_id in before if after[book_id] != before[book_id]} == {rayuela.id}
+
+    # Running it again is a no-op
+    assert sync(books) == ([], {"matched": 5, "changed": 0, "created": 0})
+
+
+def test_normalize_date_matches_dateutil():
+    """ The fast paths answer like the fuzzy dateutil parse """
+    dates = [
+        "2005", "March 2005", "mar. 2005", "Sept 1999", "2005-03-01", "2005-3-1", " 2016-11-23 ", "Mar 1, 2005",
+        "JUNE 30, 2010", "1 March 2005", "15 Jun., 1999", "Feb 29, 2004", "Feb 29, 2005", "2005-02-30",
+        "Spring 2001", "c. 1890", "12", "", fake.date(), fake.date(pattern="%B %Y"), fake.date(pattern="%b %d, %Y"),
+    ]
+    for value in dates:
+        assert normalize_date(value) == _parse_date(value), value
+    assert normalize_date(NAN) is None
+
+
+def test_import_resumes_from_checkpoint_and_rejects_invalid_rows(tmp_path, app, catalog_sources):
+    books, authors, providers = catalog_sources
+    # Missing title, fails validation
+    books = pd.concat([books.iloc[:2], pd.DataFrame([book_row(cod_art='A9')]), books.iloc[2:]], ignore_index=True)
+    checkpoint_path = tmp_path / "populate.checkpoint.json"
+
+    def chunks(fail_after=None):
+        for start in range(0, len(books), 2):
+            if start == fail_after:
+                raise RuntimeError("connection lost")
+            yield books.iloc[start:start + 2]
+
+    def run(engine, books, checkpoint, rejects):
+        with so.Session(engine) as session:
+            import_books(session, books, authors, providers, batch_size=2, limit=None, checkpoint=checkpoint, rejects=rejects)
+
+    interrupted = sa.create_engine("sqlite://")
+    db.metadata.create_all(interrupted)
+    rejects = RejectLog(tmp_path / "rejects.jsonl")
+    with pytest.raises(RuntimeError):
+        run(interrupted, chunks(fail_after=4), Checkpoint(checkpoint_path, "digest"), rejects)
+    assert Checkpoint(checkpoint_path, "digest").load() == 4
+    # Another source file starts over
+    assert Checkpoint(checkpoint_path, "other digest").load() == 0
+
+    checkpoint = Checkpoint(checkpoint_path, "digest")
+    checkpoint.load()
+    run(interrupted, chunks(), checkpoint, rejects)
+    assert checkpoint.row == len(books)
+    rejected = [json.loads(line) for line in open(rejects.path)]
+    assert [(reject["row"], reject["data"]["cod_art"]) for reject in rejected] == [(2, 'A9')]
+    assert "title" in rejected[0]["reason"]
+
+    uninterrupted = sa.create_engine("sqlite://")
+    db.metadata.create_all(uninterrupted)
+    run(uninterrupted, books, None, RejectLog(tmp_path / "other_rejects.jsonl"))
+    assert table_contents(interrupted) == table_contents(uninterrupted)
+
+
+def test_profiled_dry_run(app, catalog_sources):
+    books, authors, providers = catalog_sources
+    engine = sa.create_engine("sqlite://")
+    db.metadata.create_all(engine)
+    profiler = ImportProfiler()
+    with so.Session(engine) as session:
+        with profiler.attach(session):
+            import_books(session, books, authors, providers, batch_size=2, limit=None, dry_run=True)
+        session.rollback()
+    with engine.connect() as connection:
+        assert connection.execute(sa.select(sa.func.count()).select_from(Book)).scalar() == 0
+
+    assert len(profiler.books) == len(books)
+    assert {"process_book", "covers", "process_genre", "process_authors", "photos"} <= set(profiler.stages)
+    assert "commit" not in profiler.stages
+    # The provider links are written with the commits, there is none in a dry run
+    assert all(stats.statements > 0 for name, stats in profiler.stages.items() if name != "process_providers")
+    assert profiler.stages["process_providers"].statements == 0
+    assert profiler.stages["process_book"].flushes >= len(books)
+    report = profiler.report().splitlines()
+    assert report[-2].startswith("total") and report[-1] == f"{len(books)} books"
+    # Nested stages are not counted twice
+    total = sum(stats.seconds for name, stats in profiler.stages.items() if name != "providers")
+    assert sum(sum(book.values()) for book in profiler.books) == pytest.approx(total)
+
+
+def test_staging_files_read_back_like_their_sources(tmp_path, app, catalog_sources):
+    from app.api.importer.staging import write_staging
+    books, authors, providers = catalog_sources
+    books_path = write_tsv(books, tmp_path / "books.csv")
+    authors_path = write_tsv(authors, tmp_path / "authors.csv")
+    assert write_staging(lambda: read_books(books_path, chunksize=4), tmp_path / "books.arrow") == len(books)
+    write_staging(lambda: read_chunks(authors_path, dtype={'id_cdl': str}, chunksize=1), tmp_path / "authors.arrow")
+
+    expected = pd.concat(read_books(books_path))
+    chunks = list(read_books(tmp_path / "books.arrow", chunksize=5))
+    # Chunks never span the written batches
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    pd.testing.assert_frame_equal(pd.concat(chunks), expected, check_dtype=False)
+    assert chunks[0]['covers'].tolist()[0] == ['https://covers/1.jpg', 'https://covers/2.jpg']
+    pd.testing.assert_frame_equal(
+        read_table(tmp_path / "authors.arrow"), read_table(authors_path, dtype={'id_cdl': str}), check_dtype=False
+    )
+
+    staged = CatalogImport(read_table(tmp_path / "authors.arrow"), providers)
+    staged.add_books(read_books(tmp_path / "books.arrow"))
+    source = CatalogImport(read_table(authors_path, dtype={'id_cdl': str}), providers)
+    source.add_books(read_books(books_path))
+    assert list(staged.books) == list(source.books)
+    assert staged.links == source.links
+
+
+def test_provider_links_are_resolved_once(app, catalog_sources):
+    books, authors, providers = catalog_sources
+    providers = pd.concat([providers, providers.assign(cod_pro='8', cedula_proveedor='J-2')], ignore_index=True)
+    engine = sa.create_engine("sqlite://")
+    db.metadata.create_all(engine)
+    statements = []
+    sa.event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    with so.Session(engine) as session:
+        import_books(session, books, authors, providers, batch_size=2, limit=None)
+    provider_selects = sum('FROM provider' in statement for statement in statements)
+    link_inserts = sum(statement.startswith('INSERT INTO book_providers') for statement in statements)
+    with engine.connect() as connection:
+        links = connection.execute(sa.select(book_providers.c.book_id, book_providers.c.provider_id)).all()
+        codes = connection.execute(sa.select(Provider.id, Provider.alejandria_code).order_by(Provider.id)).all()
+    # Every provider of the file, whether a book refers to it or not
+    assert [code for _, code in codes] == [7, 8]
+    # Cien años de soledad and Rayuela, the 404 provider doesn't exist
+    assert sorted(provider_id for _, provider_id in links) == [codes[0].id, codes[0].id]
+    assert provider_selects == 1
+    # One per committed batch with links
+    assert link_inserts == 2
+
+    with so.Session(engine) as session:
+        # Upserted on the next import
+        ProviderLinks(session, providers.assign(nombre_proveedor='Renamed'))
+        session.commit()
+        assert session.scalars(sa.select(Provider.name).order_by(Provider.id)).all() == ['Renamed', 'Renamed']
+        assert session.scalar(sa.select(sa.func.count()).select_from(Provider)) == 2
+
+
+def test_import_refreshes_related_books_once(app, catalog_sources):
+    books, authors, providers = catalog_sources
+    engine = sa.create_engine("sqlite://")
+    db.metadata.create_all(engine)
+    statements = []
+    sa.event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    with so.Session(engine) as session:
+        import_books(session, books, authors, providers, batch_size=2, limit=None)
+    book_inserts = [i for i, statement in enumerate(statements) if statement.startswith('INSERT INTO book ')]
+    related_writes = [i for i, statement in enumerate(statements) if 'related_books' in statement]
+    # The flushes of the batches leave the related books alone, they are refreshed after the last book
+    assert related_writes and min(related_writes) > max(book_inserts)
+    with engine.connect() as connection:
+        stale = connection.execute(sa.select(sa.func.count()).where(Book.__table__.c.related_computed_at.is_(None))).scalar()
+        related = connection.execute(sa.select(sa.func.count()).select_from(related_books)).scalar()
+    assert stale == 0
+    assert related > 0
+
+
+def test_populate_only_hashes_the_sources_for_a_checkpoint(tmp_path, monkeypatch, db_session, runner, catalog_sources):
+    books, authors, providers = catalog_sources
+    for name, df in (("books.csv", books), ("authors.csv", authors), ("providers.csv", providers)):
+        write_tsv(df, tmp_path / name)
+    digests = []
+    monkeypatch.setattr("app.api.populate.source_digest", lambda *paths: digests.append(paths) or "digest")
+
+    result = runner.invoke(args=['api', 'populate', '--source_path', str(tmp_path), '--resume'])
+    assert result.exit_code != 0 and "--checkpoint_file" in result.output
+    result = runner.invoke(args=['api', 'populate', '--source_path', str(tmp_path), '--limit', '0', '--dry_run'])
+    assert result.exit_code == 0, result.output
+    assert digests == []
@@ -6,6 +6,8 @@ from random import choice
 import pytest
 from app import db
 from app.models import Book
+from app.models.books import related_books
+from app.api.books.related import refresh_related
 from app.schemas import BookSchema
 from sqlalchemy import select, func
 from urllib.parse import quote
@@ -46,3 +48,115 @@ def test_get_related_books(book_factory, author_factory, genre_factory, client,
             print(f"Book {book['id']} is not related to the initial book")
             pprint(book)
         assert has_author or has_genre
+
+
+def test_related_books_ranked_by_score(book_factory, author_factory, genre_factory, client):
+    """ Every shared author is worth 3 points and every shared genre 1 point """
+    authors = author_factory.create_batch(2)
+    genres = genre_factory.create_batch(3)
+    initial_book = book_factory.create(authors=authors, genres=genres)
+    one_genre = book_factory.create(authors=[], genres=genres[:1])
+    two_authors = book_factory.create(authors=authors, genres=[])
+    one_author_two_genres = book_factory.create(authors=authors[:1], genres=genres[:2])
+    # The list of the initial book went stale when the others were added: scored on request, not stored
+    response = client.get(url_for('api.books.get_related_books', book_id=initial_book.id))
+    assert response.status_code == 200
+    ids = [book['id'] for book in response.get_json()['books']]
+    assert ids == [two_authors.id, one_author_two_genres.id, one_genre.id]
+    stored = select(related_books.c.related_book_id, related_books.c.score).where(related_books.c.book_id == initial_book.id)
+    assert db.session.execute(stored).all() == []
+
+    refresh_related(db.session.connection(), [initial_book.id])
+    db.session.commit()
+    assert dict(db.session.execute(stored).all()) == {two_authors.id: 6, one_author_two_genres.id: 5, one_genre.id: 1}
+    response = client.get(url_for('api.books.get_related_books', book_id=initial_book.id))
+    assert [book['id'] for book in response.get_json()['books']] == ids
+
+
+def test_related_books_computed_empty(book_factory, author_factory, client):
+    """ A book related to no other has an empty list, computed once and not on every request """
+    book = book_factory.create(authors=[author_factory.create()], genres=[])
+    assert book.related_computed_at is not None
+    response = client.get(url_for('api.books.get_related_books', book_id=book.id))
+    assert response.status_code == 200
+    assert response.get_json()['books'] == []
+    db.session.refresh(book)
+    assert book.related_computed_at is not None
+
+
+@pytest.mark.parametrize('deleted', ['author', 'genre'])
+def test_deleting_author_or_genre_marks_lists_stale(book_factory, author_factory, genre_factory, client, deleted):
+    author, genre = author_factory.create(), genre_factory.create()
+    book = book_factory.create(authors=[author], genres=[genre])
+    other_book = book_factory.create(authors=[author], genres=[genre])
+    refresh_related(db.session.connection(), [book.id, other_book.id])
+    db.session.commit()
+
+    db.session.delete(author if deleted == 'author' else genre)
+    db.session.commit()
+    for stale_book in (book, other_book):
+        db.session.refresh(stale_book)
+        assert stale_book.related_computed_at is None
+    assert db.session.execute(select(related_books).where(related_books.c.book_id == book.id)).all() == []
+    # Still related by what they share
+    response = client.get(url_for('api.books.get_related_books', book_id=book.id))
+    assert [b['id'] for b in response.get_json()['books']] == [other_book.id]
+
+
+def test_related_books_follow_association_routes(book_factory, author_factory, client):
+    author = author_factory.create()
+    book = book_factory.create(authors=[author], genres=[])
+    other_book = book_factory.create(authors=[], genres=[])
+    response = client.get(url_for('api.books.get_related_books', book_id=book.id))
+    assert other_book.id not in [b['id'] for b in response.get_json().get('books', [])]
+
+    response = client.put(
+        url_for('api.books.add_authors_to_book', book_id=other_book.id),
+        data=json.dumps({"author_ids": [author.id]}),
+        content_type="application/json"
+    )
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.get_related_books', book_id=book.id))
+    assert [b['id'] for b in response.get_json()['books']] == [other_book.id]
+    response = client.get(url_for('api.books.get_related_books', book_id=other_book.id))
+    assert [b['id'] for b in response.get_json()['books']] == [book.id]
+
+    response = client.delete(url_for('api.books.remove_author_from_book', book_id=other_book.id, author_id=author.id))
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.get_related_books', book_id=book.id))
+    assert other_book.id not in [b['id'] for b in response.get_json().get('books', [])]
+
+
+def test_refresh_related_books_command(db_session, runner, book_factory, author_factory):
+    author = author_factory.create()
+    book, other_book = book_factory.create_batch(2, authors=[author], genres=[])
+    db.session.execute(related_books.delete())
+    db.session.commit()
+    result = runner.invoke(args=['api', 'refresh-related-books'])
+    assert result.exit_code == 0
+    rows = db.session.execute(
+        select(related_books.c.related_book_id).where(related_books.c.book_id == book.id)
+    ).scalars().all()
+    assert rows == [other_book.id]
+
+
+def test_refresh_related_books_command_stale(db_session, runner, book_factory, author_factory):
+    author = author_factory.create()
+    book, other_book = book_factory.create_batch(2, authors=[author], genres=[])
+    # Adding the second book left the list of the first one stale
+    db.session.refresh(book)
+    db.session.refresh(other_book)
+    assert book.related_computed_at is None
+    computed_at = other_book.related_computed_at
+    assert computed_at is not None
+
+    result = runner.invoke(args=['api', 'refresh-related-books', '--stale'])
+    assert result.exit_code == 0
+    db.session.refresh(book)
+    db.session.refresh(other_book)
+    assert book.related_computed_at is not None
+    assert other_book.related_computed_at == computed_at
+    rows = db.session.execute(
+        select(related_books.c.related_book_id).where(related_books.c.book_id == book.id)
+    ).scalars().all()
+    assert rows == [other_book.id]
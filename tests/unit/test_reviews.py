@@ -1,8 +1,10 @@
+import pytest
 from flask import url_for
 from math import isclose
 from app.schemas import BookSchema, ReviewSchema
 from app import db
-from app.models import Review
+from app.models import Review, Book
+import sqlalchemy as sa
 import json
 from pprint import pprint
 
@@ -73,3 +75,109 @@ def test_delete_review(client, review_factory, book_factory, regular_user, user_
     data = response.get_json()
     assert data['message'] == 'Review deleted successfully'
     assert db.session.query(Review).filter_by(id=review.id).first() is None
+
+
+def test_book_rating_aggregates_follow_reviews(client, book_factory, regular_user, user_token, user_csrf_token):
+    book = book_factory.create()
+    client.set_cookie("access_token_cookie", user_token)
+    headers = {"X-CSRF-TOKEN": user_csrf_token}
+    response = client.post(
+        f'/api/reviews/{book.id}',
+        data=json.dumps({"comment": "Great book", "rating": 5}),
+        content_type="application/json",
+        headers=headers
+    )
+    assert response.status_code == 201
+    assert (book.rating_count, book.rating_total, book.rating_5_count, book.average_rating) == (1, 5, 1, 5.0)
+
+    response = client.put(
+        f'/api/reviews/{book.id}',
+        data=json.dumps({"rating": 2}),
+        content_type="application/json",
+        headers=headers
+    )
+    assert response.status_code == 200
+    assert (book.rating_count, book.rating_total, book.rating_5_count, book.rating_2_count) == (1, 2, 0, 1)
+    assert book.average_rating == 2.0
+
+    response = client.delete(f'/api/reviews/{book.id}', headers=headers)
+    assert response.status_code == 200
+    assert (book.rating_count, book.rating_total, book.rating_2_count, book.average_rating) == (0, 0, 0, 0.0)
+
+
+def test_book_schema_ignores_dumped_rating_aggregates(book_factory, review_factory):
+    book = book_factory.create()
+    review_factory.create(book=book, rating=4)
+    dumped = BookSchema(only=["title", "version", "rating_avg", "rating_count", "rating_4_count"]).dump(book)
+    assert dumped["rating_count"] == 1
+    assert BookSchema(partial=True).load(dumped) == {"title": book.title}
+
+
+@pytest.mark.parametrize("rating", [9, 4.5, "4.9", True])
+def test_update_review_rejects_invalid_rating(client, review_factory, book_factory, regular_user, user_token, user_csrf_token, rating):
+    book = book_factory.create()
+    review = review_factory.create(book=book, user=regular_user, rating=3)
+    client.set_cookie("access_token_cookie", user_token)
+    response = client.put(
+        f'/api/reviews/{book.id}',
+        data=json.dumps({"rating": rating}),
+        content_type="application/json",
+        headers={"X-CSRF-TOKEN": user_csrf_token}
+    )
+    assert response.status_code == 400
+    assert book.rating_3_count == 1
+    assert review.rating == 3
+
+
+def test_get_reviews_for_book_histogram(client, review_factory, book_factory, count_queries):
+    book = book_factory.create()
+    for rating in [5, 5, 4, 1]:
+        review_factory.create(book=book, rating=rating)
+    db.session.commit()
+    with count_queries() as statements:
+        response = client.get(url_for('api.reviews.get_reviews_for_book', book_id=book.id))
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['total_count'] == 4
+    assert data['average_rating'] == 3.75
+    assert data['counts'] == [
+        {'rating': 5, 'count': 2}, {'rating': 4, 'count': 1}, {'rating': 3, 'count': 0},
+        {'rating': 2, 'count': 0}, {'rating': 1, 'count': 1}
+    ]
+    assert not any("avg(" in statement.lower() for statement in statements)
+
+
+def test_reconcile_ratings(db_session, runner, review_factory, book_factory):
+    book = book_factory.create()
+    review_factory.create_batch(3, book=book, rating=4)
+    db.session.commit()
+    db.session.execute(sa.update(Book).where(Book.id == book.id).values(rating_count=0, rating_total=0, rating_avg=0))
+    db.session.commit()
+    result = runner.invoke(args=['api', 'reconcile-ratings', '--book-id', str(book.id)])
+    assert result.exit_code == 0
+    assert 'Fixed the ratings of 1 books' in result.output
+    db.session.expire_all()
+    assert (book.rating_count, book.rating_total, book.rating_4_count, book.average_rating) == (3, 12, 3, 4.0)
+    result = runner.invoke(args=['api', 'reconcile-ratings', '--book-id', str(book.id)])
+    assert 'Fixed the ratings of 0 books' in result.output
+
+
+def test_get_books_sorted_and_filtered_by_rating(client, book_factory, review_factory):
+    best, good, bad = book_factory.create_batch(3)
+    for book, ratings in [(best, [5, 5]), (good, [5, 4]), (bad, [2, 1])]:
+        for rating in ratings:
+            review_factory.create(book=book, rating=rating)
+    db.session.commit()
+    response = client.get(url_for('api.books.get_books', sort_by="rating", min_rating=4, limit=100))
+    assert response.status_code == 200
+    books = response.get_json()["books"]
+    ids = [book["id"] for book in books]
+    assert ids.index(best.id) < ids.index(good.id)
+    assert bad.id not in ids
+    assert all(book["rating_avg"] >= 4 for book in books)
+    assert [book["rating_avg"] for book in books] == sorted([book["rating_avg"] for book in books], reverse=True)
+    # Cursor mode walks the same order
+    response = client.get(url_for('api.books.get_books', sort_by="rating", min_rating=4, limit=len(ids) - 1, cursor=""))
+    cursor = response.get_json()["cursor"]["next"]
+    response = client.get(url_for('api.books.get_books', sort_by="rating", min_rating=4, limit=len(ids) - 1, cursor=cursor))
+    assert [book["id"] for book in response.get_json()["books"]] == ids[-1:]
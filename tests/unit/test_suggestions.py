@@ -9,6 +9,15 @@ from app.schemas import BookSchema
 from sqlalchemy import select, func
 from urllib.parse import quote
 from flask import url_for
+from app.api.books.suggestions import suggestion_index
+
+
+@pytest.fixture(autouse=True)
+def fresh_suggestion_index():
+    # The index lives for the whole worker, so drop what previous (rolled back) tests left in it
+    suggestion_index.clear()
+    yield
+    suggestion_index.clear()
 
 
 def test_suggest_books_by_title(client, book_factory):
@@ -29,3 +38,73 @@ def test_suggest_books_by_title(client, book_factory):
     for author in data['authors']:
         assert 'name' in author
         assert query.lower() in author['name'].lower()
+
+
+def test_suggest_books_scoring(client, book_factory):
+    """ Exact titles beat prefixes, which beat matches in the middle of the title """
+    contains = book_factory.create(title="The Night Circus")
+    prefix = book_factory.create(title="Night Watch")
+    exact = book_factory.create(title="Night")
+    response = client.get(url_for('api.books.suggestions', q="night"))
+    assert response.status_code == 200
+    books = response.get_json()['books']
+    assert [book['id'] for book in books] == [exact.id, prefix.id, contains.id]
+    assert [book['score'] for book in books] == [18, 8, 3]
+    assert set(books[0]) == {'id', 'title', 'cover_url', 'score'}
+
+
+def test_suggest_books_by_isbn(client, book_factory):
+    book = book_factory.create()
+    response = client.get(url_for('api.books.suggestions', q=book.isbn_13))
+    assert response.status_code == 200
+    books = response.get_json()['books']
+    assert books[0]['id'] == book.id
+    assert books[0]['score'] >= 10
+
+
+def test_suggest_books_by_isbn_prefix(client, book_factory):
+    """ A partial ISBN matches from its start, not in its middle """
+    book = book_factory.create(isbn_10="0140449132", isbn_13="9780140449136")
+    response = client.get(url_for('api.books.suggestions', q="97801404"))
+    assert [b['id'] for b in response.get_json()['books']] == [book.id]
+    response = client.get(url_for('api.books.suggestions', q="0140449"))
+    assert [b['id'] for b in response.get_json()['books']] == [book.id]
+    response = client.get(url_for('api.books.suggestions', q="4044913"))
+    assert book.id not in [b['id'] for b in response.get_json()['books']]
+
+
+def test_suggest_authors_accent_insensitive(client, author_factory):
+    author = author_factory.create(name="Gabriel García Márquez")
+    response = client.get(url_for('api.books.suggestions', q="garcia mar"))
+    assert response.status_code == 200
+    authors = response.get_json()['authors']
+    assert [a['id'] for a in authors] == [author.id]
+    assert authors[0]['score'] == 3
+
+
+def test_suggestions_follow_book_updates(client, book_factory):
+    book = book_factory.create(title="Before the rename")
+    response = client.get(url_for('api.books.suggestions', q="before"))
+    assert book.id in [b['id'] for b in response.get_json()['books']]
+    response = client.put(
+        url_for("api.books.update_book", book_id=book.id),
+        data=json.dumps({"title": "Zebra crossing"}),
+        content_type="application/json",
+    )
+    assert response.status_code == 200
+    response = client.get(url_for('api.books.suggestions', q="zebra"))
+    assert [b['id'] for b in response.get_json()['books']] == [book.id]
+    response = client.get(url_for('api.books.suggestions', q="before"))
+    assert book.id not in [b['id'] for b in response.get_json()['books']]
+
+
+def test_suggestions_do_not_query_the_database(client, book_factory, count_queries):
+    book_factory.create_batch(20)
+    client.get(url_for('api.books.suggestions', q="aa"))  # warm the index
+    with count_queries() as queries:
+        response = client.get(url_for('api.books.suggestions', q="the"))
+    assert response.status_code == 200
+    assert queries == []
+    stats = suggestion_index.stats()
+    assert stats['books'] >= 20
+    assert stats['memory_bytes'] > 0